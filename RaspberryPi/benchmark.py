@@ -0,0 +1,147 @@
+'''
+@file benchmark.py
+@brief Measures the processor time of the audio engine
+
+Mixes synthetic voices with the audio engine for every combination of
+mono or stereo, looped or one-shot and pitched or unpitched samples, with
+a range of voice counts and block sizes, and measures the time of every
+mixed block. For every run it reports the time per voice frame, the median
+and 99th percentile block time and the headroom against the block deadline
+(the time the sound card takes to play the block). The results are written
+as json, to compare them between the releases.
+
+    python3 benchmark.py
+    python3 benchmark.py --voices 32 80 --blocksizes 512 --output bench.json
+'''
+
+import argparse
+import itertools
+import json
+import platform
+import time
+
+import numpy
+# Cython compiled audio engine .so file
+import samplerbox_audio
+
+from classes.music import Sound
+from classes.gui import Utilities
+from classes.render import INTERPOLATIONS
+
+# Sample rate of the audio device
+RATE = 44100
+# MIDI note of the synthetic samples
+MIDINOTE = 48
+
+def synthetic_sound(stereo, looped, seconds=4.0):
+    '''
+    Create a synthetic sample, a harmonic tone
+
+    :param stereo: True for a stereo sample, else mono
+    :param looped: True for a looped sample, else one-shot
+    :param seconds: The sample duration
+    :return: The Sound object
+    '''
+    t = numpy.arange(int(seconds * RATE)) / RATE
+    tone = numpy.sin(2 * numpy.pi * 220 * t) + 0.3 * numpy.sin(2 * numpy.pi * 660 * t)
+    channels = [tone, numpy.roll(tone, 37)] if stereo else [tone]
+    data = numpy.ascontiguousarray((numpy.stack(channels, axis=1) * 8000).astype(numpy.int16).ravel())
+    numchan = len(channels)
+    frames = len(t)
+    if looped:
+        # Loop the second half of the sample
+        loop, nframes = frames // 2, frames - 2
+    else:
+        loop, nframes = -1, frames
+    return Sound.from_array('<synthetic>', MIDINOTE, 127, data, numchan, loop, nframes, 0)
+
+def run(sound, pitched, voices, blocksize, quality, blocks, fadeout_length=30000):
+    '''
+    Measure the mix of a number of voices
+
+    :param sound: The Sound played by all the voices
+    :param pitched: True to play the voices at a different pitch from the sample
+    :param voices: The number of voices playing together
+    :param blocksize: The frames of every mixed block
+    :param quality: The interpolation
+    :param blocks: The number of blocks measured
+    :param fadeout_length: The fadeout length of the voices table
+    :return: Dictionary of the results
+    '''
+    fadeout = Utilities.calcFade1(fadeout_length)
+    fadeout = Utilities.calcFade2(fadeout)
+    fadeout = Utilities.calcFade3(fadeout, fadeout_length)
+    table = samplerbox_audio.VoiceTable(voices, Utilities.calcStretchFactor(), fadeout,
+                                        fadeout_length, blocksize, quality)
+    # A fifth up, 1.5 times the sample speed
+    note = MIDINOTE + 7 if pitched else MIDINOTE
+    outdata = numpy.zeros((blocksize, 2), numpy.int16)
+
+    # The voices start at different positions, as in a real play
+    for i in range(voices):
+        table.add(sound, note)
+        samplerbox_audio.mixaudiobuffers(table, 1 + i % 64, outdata, 1.0)
+
+    times = numpy.zeros(blocks, numpy.int64)
+    for i in range(blocks):
+        # The finished one-shot voices are replaced out of the measure
+        while len(table) < voices:
+            table.add(sound, note)
+        start = time.perf_counter_ns()
+        samplerbox_audio.mixaudiobuffers(table, blocksize, outdata, 1.0)
+        times[i] = time.perf_counter_ns() - start
+
+    deadline = blocksize / RATE * 1e9
+    p50, p99 = numpy.percentile(times, [50, 99])
+    return {
+        'voices': voices,
+        'blocksize': blocksize,
+        'ns_per_voice_frame': float(times.mean() / (voices * blocksize)),
+        'p50_us': float(p50 / 1000),
+        'p99_us': float(p99 / 1000),
+        'max_us': float(times.max() / 1000),
+        'deadline_us': deadline / 1000,
+        'headroom': float(1 - p99 / deadline)
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the processor time of the audio engine')
+    parser.add_argument('--voices', type=int, nargs='+', default=[1, 16, 32, 64, 80],
+                        help='the voice counts (default 1 16 32 64 80)')
+    parser.add_argument('--blocksizes', type=int, nargs='+', default=[256, 512, 1024],
+                        help='the block sizes (default 256 512 1024)')
+    parser.add_argument('--interpolation', choices=sorted(INTERPOLATIONS), nargs='+', default=['linear'],
+                        help='the interpolations (default linear)')
+    parser.add_argument('--blocks', type=int, default=200,
+                        help='the blocks measured for every run (default 200)')
+    parser.add_argument('--output', help='the json file to write (default the standard output)')
+    args = parser.parse_args()
+
+    results = []
+    for stereo, looped in itertools.product((False, True), (False, True)):
+        sound = synthetic_sound(stereo, looped)
+        for pitched, interpolation, voices, blocksize in itertools.product(
+                (False, True), args.interpolation, args.voices, args.blocksizes):
+            result = {
+                'channels': 2 if stereo else 1,
+                'looped': looped,
+                'pitched': pitched,
+                'interpolation': interpolation
+            }
+            result.update(run(sound, pitched, voices, blocksize, INTERPOLATIONS[interpolation], args.blocks))
+            results.append(result)
+
+    report = {
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'rate': RATE,
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
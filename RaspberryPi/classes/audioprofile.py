@@ -0,0 +1,127 @@
+'''
+@file audioprofile.py
+@brief Classes to configure the audio device stream
+'''
+
+import time
+
+import numpy
+import sounddevice
+# Cython compiled audio engine .so file
+import samplerbox_audio
+
+from classes.music import Sound
+from classes.stats import EngineStats
+
+_class_debug = False
+
+class AudioProfile():
+    '''
+    Settings of the audio device stream: the frames of every audio block,
+    the sample rate, the latency hint of the device and the output format.
+
+    Smaller blocks play the notes sooner, but leave less time to mix every
+    block: the block size can be found automatically, playing with the
+    device the voices of the max polyphony with increasing block sizes,
+    until a block size runs without xruns.
+    '''
+    # Output formats of the audio engine
+    DTYPES = ('int16', 'float32')
+
+    def __init__(self, blocksize=512, rate=44100, latency=None, dtype='int16',
+                 candidates=(64, 128, 256, 512, 1024), probe_seconds=2.0, headroom=0.3):
+        '''
+        :param blocksize: The frames of every audio block, None to probe it
+        :param rate: The sample rate, used both to play and to record
+        :param latency: The latency hint of the device: 'low', 'high', the
+        latency in seconds or None for the device default
+        :param dtype: The output format, 'int16' or 'float32'
+        :param candidates: The block sizes tried by the probe
+        :param probe_seconds: The duration of the probe of every block size
+        :param headroom: Fraction of the block duration left free by the mix
+        of a block size that passes the probe
+        '''
+        if dtype not in self.DTYPES:
+            raise ValueError('audio dtype should be one of ' + ', '.join(self.DTYPES))
+        self.blocksize = blocksize
+        self.rate = rate
+        self.latency = latency
+        self.dtype = dtype
+        self.candidates = sorted(candidates)
+        self.probe_seconds = probe_seconds
+        self.headroom = headroom
+
+    @classmethod
+    def from_settings(cls, settings):
+        '''
+        Read the profile from the "audio" section of gui.json, e.g.
+        {"blocksize": "auto", "sampleRate": 48000, "latency": "low", "dtype": "float32"}
+
+        :param settings: The dictionary of gui.json
+        :return: The AudioProfile, with the default values for the missing keys
+        '''
+        audio = settings.get('audio', {})
+        blocksize = audio.get('blocksize', 512)
+        return cls(blocksize=None if blocksize == 'auto' else int(blocksize),
+                   rate=int(audio.get('sampleRate', 44100)),
+                   latency=audio.get('latency'),
+                   dtype=audio.get('dtype', 'int16'),
+                   candidates=audio.get('probeBlocksizes', (64, 128, 256, 512, 1024)),
+                   probe_seconds=float(audio.get('probeSeconds', 2.0)))
+
+    def stream_args(self, device):
+        '''
+        :param device: The audio device id
+        :return: Dictionary of the sounddevice stream parameters of the profile,
+        except the channels and the format
+        '''
+        return {
+            'device': device,
+            'blocksize': self.blocksize,
+            'samplerate': self.rate,
+            'latency': self.latency
+        }
+
+    def probe(self, device, voices):
+        '''
+        Find the smallest block size that plays the voices of the max
+        polyphony without xruns. Every block size is played with the device
+        for probe_seconds, mixing silent voices at a different pitch from
+        the sample, so the mix costs as playing the notes.
+
+        :param device: The audio device id
+        :param voices: Function creating an empty samplerbox_audio.VoiceTable
+        for a block size
+        :return: The block size, the largest candidate if none passes
+        '''
+        frames = int(self.rate * (self.probe_seconds + 1))
+        sound = Sound.from_array('<probe>', 60, 127, numpy.zeros(2 * frames, numpy.int16),
+                                 2, 0, frames - 2, 0)
+        for blocksize in self.candidates:
+            table = voices(blocksize)
+            for i in range(table.capacity):
+                table.add(sound, 67)
+            xruns = [0]
+
+            def callback(outdata, frame_count, time_info, status):
+                if status:
+                    xruns[0] += 1
+                samplerbox_audio.mixaudiobuffers(table, frame_count, outdata, 0.0)
+
+            try:
+                stream = sounddevice.OutputStream(channels=2, dtype=self.dtype, callback=callback,
+                                                  **dict(self.stream_args(device), blocksize=blocksize))
+                with stream:
+                    time.sleep(self.probe_seconds)
+            except Exception as e:
+                if(_class_debug): print("D: block size %d cannot be opened: %s" % (blocksize, e))
+                continue
+            stats = table.stats()
+            # The mix time of the slowest blocks should leave the headroom free
+            p99 = min(EngineStats.percentile(stats['histogram'], 0.99), stats['maxtime_us'])
+            deadline = blocksize / self.rate * 1e6
+            if(_class_debug): print("D: block size %d xruns %d mix p99 %dus of %dus" %
+                                    (blocksize, xruns[0], p99, deadline))
+            if xruns[0] == 0 and p99 <= (1 - self.headroom) * deadline:
+                return blocksize
+        return self.candidates[-1]
@@ -0,0 +1,172 @@
+'''
+@file bankpack.py
+@brief Classes to write and read the packed banks
+
+A packed bank holds all the samples of a bank in a single file, already
+decoded to 16 bit frames, so the bank is loaded with a single memory map
+instead of parsing and converting every wav file.
+
+File layout (little endian):
+- header: magic, version, sample rate, number of zones, zone table offset,
+  frames offset
+- zone table: one entry for every sample with the MIDI note, layer,
+  alternate, velocity, channels, loop start, played frames and the offset
+  and number of the frames in the file
+- frames: the int16 frames of every sample, channels interleaved. The frames
+  start at a page boundary and every sample is aligned to a cache line.
+'''
+
+import os
+import mmap
+import struct
+
+import numpy
+
+from classes.music import Sound
+
+_class_debug = False
+
+class BankPack():
+    '''
+    Writes and maps the packed bank files
+    '''
+    # File identifier and format version
+    MAGIC = b'RMBANK\r\n'
+    VERSION = 2
+    # magic, version, sample rate, zones, zone table offset, frames offset
+    HEADER = struct.Struct('<8sIIIII')
+    # MIDI note, layer, alternate, velocity, channels, loop start,
+    # played frames, frames offset (bytes), number of frames
+    ZONE = struct.Struct('<hhhhhxxiiqq')
+    # Alignment of the frames section and of every sample
+    PAGE_SIZE = 4096
+    SAMPLE_ALIGN = 64
+
+    @staticmethod
+    def file_name(folder):
+        '''
+        :param folder: The bank samples folder, with the trailing separator
+        :return: The packed bank file name, next to the bank folder
+        '''
+        return folder.rstrip('/\\') + '.rmbank'
+
+    @staticmethod
+    def align(offset, alignment):
+        '''
+        :param offset: An offset in the file
+        :param alignment: The alignment, a power of two
+        :return: The first aligned offset not before offset
+        '''
+        return (offset + alignment - 1) & ~(alignment - 1)
+
+    @classmethod
+    def write(cls, packed_name, sounds):
+        '''
+        Write a packed bank. The file is written apart and renamed when
+        complete, so a player never maps a partial file.
+
+        :param packed_name: The packed bank file name
+        :param sounds: Dictionary of the Sound objects indexed by the tuple
+        (MIDI note, layer, alternate), with the samples fully in memory
+        '''
+        keys = sorted(sounds)
+        table_offset = cls.HEADER.size
+        offset = cls.align(table_offset + cls.ZONE.size * len(keys), cls.PAGE_SIZE)
+        frames_offset = offset
+
+        zones = []
+        for key in keys:
+            sound = sounds[key]
+            data = numpy.ascontiguousarray(sound.data, dtype='<i2')
+            zones.append((key, sound, data, offset))
+            offset = cls.align(offset + data.nbytes, cls.SAMPLE_ALIGN)
+
+        temp_name = packed_name + '.tmp'
+        with open(temp_name, 'wb') as file:
+            file.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, Sound.rate, len(keys), table_offset, frames_offset))
+            for (midinote, layer, alternate), sound, data, offset in zones:
+                file.write(cls.ZONE.pack(midinote, layer, alternate, sound.velocity, sound.numchan,
+                                         sound.loop, sound.nframes, offset, len(data) // sound.numchan))
+            for key, sound, data, offset in zones:
+                file.seek(offset)
+                file.write(data.tobytes())
+        os.replace(temp_name, packed_name)
+
+        if(_class_debug): print("D: packed " + str(len(keys)) + " samples in " + packed_name)
+
+    @classmethod
+    def is_current(cls, packed_name, sources):
+        '''
+        Check if a packed bank is newer than its source files
+
+        :param packed_name: The packed bank file name
+        :param sources: The names of the bank definition and sample files
+        :return: True if the packed bank exists and is newer than all the sources
+        '''
+        try:
+            packed_mtime = os.stat(packed_name).st_mtime_ns
+            return all(os.stat(source).st_mtime_ns <= packed_mtime for source in sources)
+        except OSError:
+            return False
+
+    @classmethod
+    def read(cls, packed_name):
+        '''
+        Map a packed bank in memory
+
+        :param packed_name: The packed bank file name
+        :return: Dictionary of the Sound objects indexed by the tuple
+        (MIDI note, layer, alternate), viewing the frames of the mapped file,
+        or None if the file is not a valid packed bank or it has been packed
+        at another sample rate than Sound.rate
+        '''
+        try:
+            mapped = numpy.memmap(packed_name, dtype=numpy.uint8, mode='r')
+        except (OSError, ValueError):
+            return None
+        if len(mapped) < cls.HEADER.size:
+            return None
+        magic, version, rate, count, table_offset, frames_offset = cls.HEADER.unpack_from(mapped, 0)
+        if (magic != cls.MAGIC) or (version != cls.VERSION) or (rate != Sound.rate):
+            return None
+        if table_offset + cls.ZONE.size * count > len(mapped):
+            return None
+
+        # Ask the OS to read ahead all the frames
+        if (getattr(mapped, '_mmap', None) is not None) and hasattr(mmap, 'MADV_WILLNEED'):
+            mapped._mmap.madvise(mmap.MADV_WILLNEED)
+
+        sounds = {}
+        for i in range(count):
+            (midinote, layer, alternate, velocity, numchan,
+             loop, nframes, offset, frames) = cls.ZONE.unpack_from(mapped, table_offset + cls.ZONE.size * i)
+            end = offset + frames * numchan * 2
+            if (numchan < 1) or (end > len(mapped)):
+                return None
+            data = mapped[offset:end].view('<i2')
+            sounds[midinote, layer, alternate] = Sound.from_array(packed_name, midinote, velocity, data,
+                                                                  numchan, loop, nframes, offset)
+        return sounds
+
+    @classmethod
+    def load(cls, packed_name, files, definition):
+        '''
+        Load a bank from its packed file, if the packed file is up to date
+        with the bank definition and sample files
+
+        :param packed_name: The packed bank file name
+        :param files: Dictionary of the sample files of the bank, as passed
+        to BankLoader.load()
+        :param definition: The bank definition json file name
+        :return: Dictionary of the Sound objects with the same keys of files,
+        or None if the bank should be loaded from the sample files
+        '''
+        sources = [definition] + [file for file, midinote, velocity in files.values()]
+        if not cls.is_current(packed_name, sources):
+            return None
+        sounds = cls.read(packed_name)
+        # A sample file added or removed after packing does not
+        # change the modification times of the other files
+        if (sounds is None) or (set(sounds) != set(files)):
+            return None
+        return sounds
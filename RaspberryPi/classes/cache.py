@@ -0,0 +1,152 @@
+'''
+@file cache.py
+@brief Classes to keep in memory the recently loaded banks
+'''
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy
+
+_class_debug = False
+
+class BankCache():
+    '''
+    Least recently used cache of the loaded banks key maps.
+
+    A bank is identified by its number and by the signature of its sample
+    files (names, velocities and modification times), so a bank is decoded
+    again when a sample file is recorded, added or removed. The size of the
+    cached banks is limited by a memory budget: the least recently used banks
+    are dropped when a new bank does not fit in it.
+
+    The cache can be used by more threads at the same time.
+    '''
+    def __init__(self, budget):
+        '''
+        :param budget: Max bytes of samples data kept in the cache. If zero
+        the cache is disabled
+        '''
+        self.budget = budget
+        self.used = 0
+        # Cached banks, from the least to the most recently used.
+        # Every item is the tuple (signature, key map, size)
+        self.banks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        '''
+        :return: The number of cached banks
+        '''
+        return len(self.banks)
+
+    def __contains__(self, bank):
+        '''
+        :param bank: The bank number
+        :return: True if a version of the bank is in the cache
+        '''
+        return bank in self.banks
+
+    @staticmethod
+    def signature(files):
+        '''
+        Calculate the signature of the sample files of a bank
+
+        :param files: Dictionary of the files of the bank, as passed to
+        BankLoader.load()
+        :return: The signature, changing if any of the files changes
+        '''
+        signature = []
+        for key in sorted(files):
+            file, midinote, velocity = files[key]
+            try:
+                mtime = os.stat(file).st_mtime_ns
+            except OSError:
+                mtime = None
+            signature.append((key, file, velocity, mtime))
+        return tuple(signature)
+
+    @staticmethod
+    def size(keymap):
+        '''
+        Calculate the memory used by the samples of a bank. The memory
+        mapped samples are not counted, as their pages belong to the
+        OS page cache and are released when the memory is needed.
+
+        :param keymap: The KeyMap of the bank
+        :return: The size in bytes
+        '''
+        size = 0
+        for alternates in keymap.zones_sounds:
+            for sound in alternates:
+                if not isinstance(sound.data, numpy.memmap):
+                    size += sound.data.nbytes
+        return size
+
+    def fresh(self, bank, signature):
+        '''
+        Check if a bank is in the cache with the same files, without
+        changing its use order
+
+        :param bank: The bank number
+        :param signature: The signature of the bank files
+        :return: True if the bank is cached and its files are not changed
+        '''
+        with self.lock:
+            return (bank in self.banks) and (self.banks[bank][0] == signature)
+
+    def get(self, bank, signature):
+        '''
+        Get a bank from the cache and mark it as the most recently used
+
+        :param bank: The bank number
+        :param signature: The signature of the bank files
+        :return: The KeyMap of the bank, or None if the bank is not in the cache
+        or its files have changed
+        '''
+        with self.lock:
+            if bank not in self.banks:
+                return None
+            cached, keymap, size = self.banks[bank]
+            if cached != signature:
+                # Stale version of the bank
+                del self.banks[bank]
+                self.used -= size
+                return None
+            self.banks.move_to_end(bank)
+            if(_class_debug): print("D: bank " + str(bank) + " found in the cache")
+            return keymap
+
+    def put(self, bank, signature, keymap):
+        '''
+        Add a bank to the cache as the most recently used, dropping the
+        least recently used banks until it fits in the budget.
+        A bank larger than the whole budget is not cached.
+
+        :param bank: The bank number
+        :param signature: The signature of the bank files
+        :param keymap: The KeyMap of the bank
+        '''
+        size = self.size(keymap)
+        with self.lock:
+            if bank in self.banks:
+                self.used -= self.banks.pop(bank)[2]
+            if size > self.budget:
+                return
+            while self.used + size > self.budget:
+                dropped, (cached, old_keymap, old_size) = self.banks.popitem(last=False)
+                self.used -= old_size
+                if(_class_debug): print("D: bank " + str(dropped) + " dropped from the cache")
+            self.banks[bank] = (signature, keymap, size)
+            self.used += size
+
+    def discard(self, bank):
+        '''
+        Remove a bank from the cache, if present
+
+        :param bank: The bank number
+        '''
+        with self.lock:
+            if bank in self.banks:
+                self.used -= self.banks.pop(bank)[2]
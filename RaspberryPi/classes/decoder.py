@@ -0,0 +1,75 @@
+'''
+@file decoder.py
+@brief Classes to convert the wav frames to the 16 bit format of the audio engine
+'''
+
+import numpy
+
+_class_debug = False
+
+class SampleDecoder():
+    '''
+    Converts the PCM frames of a wav file, 8, 16, 24 or 32 bit integer or
+    32 or 64 bit float, to the 16 bit integers played by the audio engine.
+
+    Every format is read with a numpy view on the frames buffer and
+    converted in a single vectorized pass. Only the 16 bit frames are
+    returned as a view, without any copy: the other formats are converted
+    to a new array. The formats with more than 16 bits are
+    rounded to 16 bits, optionally adding a TPDF dither (triangular noise
+    of +-1 LSB), so the quiet tails of the samples fade in noise instead
+    of the distortion of the truncation.
+    '''
+    def __init__(self, dither=False, seed=None):
+        '''
+        :param dither: True to add the TPDF dither reducing the formats
+        with more than 16 bits
+        :param seed: The seed of the dither noise, None for a random one
+        '''
+        self.dither = dither
+        self.rng = numpy.random.default_rng(seed)
+
+    def decode(self, data, sampwidth, ieee=False):
+        '''
+        Convert the frames
+
+        :param data: The bytes of the frames, as read from the data chunk
+        :param sampwidth: The bytes of every sample (1 to 4, 8 if float)
+        :param ieee: True if the samples are IEEE floats, full scale 1.0
+        :return: The int16 array of the samples, channels interleaved
+        '''
+        if ieee:
+            if sampwidth not in (4, 8):
+                raise ValueError('unsupported float sample width: ' + str(sampwidth))
+            samples = numpy.frombuffer(data, dtype='<f4' if sampwidth == 4 else '<f8')
+            return self.reduce(samples, 32768.0)
+        if sampwidth == 1:
+            # The 8 bit samples are unsigned
+            return ((numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int16) - 128) << 8)
+        if sampwidth == 2:
+            # View on the frames buffer, no copy
+            return numpy.frombuffer(data, dtype='<i2')
+        if sampwidth == 3:
+            # The 3 bytes of every sample are copied in the top bytes of
+            # a 32 bit integer, keeping the sign
+            raw = numpy.frombuffer(data, dtype=numpy.uint8)[:len(data) // 3 * 3].reshape(-1, 3)
+            wide = numpy.zeros((len(raw), 4), numpy.uint8)
+            wide[:, 1:] = raw
+            return self.reduce(wide.view('<i4').ravel(), 1.0 / 65536)
+        if sampwidth == 4:
+            return self.reduce(numpy.frombuffer(data, dtype='<i4'), 1.0 / 65536)
+        raise ValueError('unsupported sample width: ' + str(sampwidth))
+
+    def reduce(self, samples, scale):
+        '''
+        Round the samples to 16 bits
+
+        :param samples: The array of the samples
+        :param scale: The factor converting the samples to 16 bit units
+        :return: The int16 array of the samples
+        '''
+        scaled = samples.astype(numpy.float32) * numpy.float32(scale)
+        if self.dither:
+            # The difference of two uniform noises has a triangular distribution
+            scaled += self.rng.random(len(scaled), numpy.float32) - self.rng.random(len(scaled), numpy.float32)
+        return numpy.clip(numpy.rint(scaled), -32768, 32767).astype(numpy.int16)
@@ -0,0 +1,235 @@
+'''
+@file keymap.py
+@brief Classes to map the MIDI notes to the bank samples
+'''
+
+import os
+
+import numpy
+
+_class_debug = False
+
+# Number of MIDI notes and velocities
+MIDI_NOTES = 128
+MIDI_VELOCITIES = 128
+
+class BankLayers():
+    '''
+    Velocity layers and round robin alternates declared by a bank definition.
+
+    The bank json file can declare the optional fields
+    "layers": the list of the max velocity of every layer, from the softest
+    to the loudest, e.g. [63, 127]. The sample files of the layer n (from 1)
+    are named <note><octave>_v<n>.wav
+    "roundRobin": the max number of alternates of every sample. The first
+    alternate is the sample file, the next ones are named with the suffix
+    _r<n> (from 2), e.g. c3_v1_r2.wav
+
+    Without the layers field the bank has a single layer and the sample files
+    are named <note><octave>.wav as usual.
+    '''
+    def __init__(self, dictionary):
+        '''
+        :param dictionary: The bank definition loaded from the json file
+        '''
+        self.layered = 'layers' in dictionary
+        # Max velocity of every layer
+        self.bounds = [int(v) for v in dictionary.get('layers', [MIDI_VELOCITIES - 1])]
+        # Max number of alternates of every sample
+        self.alternates = max(1, int(dictionary.get('roundRobin', 1)))
+
+    def __len__(self):
+        '''
+        :return: The number of velocity layers
+        '''
+        return len(self.bounds)
+
+    def suffix(self, layer, alternate):
+        '''
+        Calculate the sample file name suffix of a layer and alternate
+
+        :param layer: The layer number, base zero
+        :param alternate: The alternate number, base zero
+        :return: The suffix to append to the note name
+        '''
+        suffix = ''
+        if self.layered:
+            suffix += '_v' + str(layer + 1)
+        if alternate > 0:
+            suffix += '_r' + str(alternate + 1)
+        return suffix
+
+    def file_name(self, folder, note_name, octave, layer, alternate):
+        '''
+        Calculate the sample file name of a note
+
+        :param folder: The bank samples folder, with the trailing separator
+        :param note_name: The note name, e.g. c#
+        :param octave: The octave, base zero
+        :param layer: The layer number, base zero
+        :param alternate: The alternate number, base zero
+        :return: The full path sample file
+        '''
+        return folder + note_name + str(octave + 1) + self.suffix(layer, alternate) + ".wav"
+
+    def sample_files(self, folder, note_names, velocity, midinotes):
+        '''
+        Collect the sample files of the notes of a bank. The alternates
+        of a layer stop at the first missing file.
+
+        :param folder: The bank samples folder, with the trailing separator
+        :param note_names: The names of the 12 notes of an octave
+        :param velocity: The velocity of the bank, used if it has no velocity layers
+        :param midinotes: The MIDI notes to check for a sample file
+        :return: Dictionary of the files indexed by the tuple (MIDI note, layer,
+        alternate). Every item is the tuple (file name, MIDI note, velocity)
+        '''
+        files = {}
+        for midinote in midinotes:
+            midinote = int(midinote)
+            for layer in range(len(self.bounds)):
+                layer_velocity = self.bounds[layer] if self.layered else velocity
+                for alternate in range(self.alternates):
+                    file = self.file_name(folder, note_names[midinote % 12], midinote // 12,
+                                          layer, alternate)
+                    if not os.path.isfile(file):
+                        break
+                    files[midinote, layer, alternate] = (file, midinote, layer_velocity)
+        return files
+
+    def velocity_layers(self):
+        '''
+        Calculate the layer played by every velocity. The velocities above
+        the last bound play the last layer.
+
+        :return: Array of the layer number of every MIDI velocity
+        '''
+        layers = numpy.searchsorted(self.bounds, numpy.arange(MIDI_VELOCITIES))
+        return numpy.minimum(layers, len(self.bounds) - 1)
+
+class KeyMap():
+    '''
+    Map of the MIDI notes and velocities to the sounds of a bank.
+
+    The sounds are grouped in zones, one for every sample note and velocity
+    layer. A zone has one or more round robin alternates, played in turn.
+    A 128 x 128 array gives the zone id of every note and velocity
+    (-1 if the note has no sound), so the note-on lookup is an array index.
+    The missing layers of a note play the nearest layer of the same note
+    (the softer one when two are as near), and the notes without a sample play the sample of the nearest lower note,
+    stretched by the audio engine.
+    '''
+    def __init__(self, sounds=None, layers=None):
+        '''
+        Build the map from the sounds of the bank
+
+        :param sounds: Dictionary of the Sound objects indexed by the tuple
+        (MIDI note, layer, alternate). If None the map is empty
+        :param layers: The BankLayers of the bank. If None, a single layer
+        '''
+        if sounds is None:
+            sounds = {}
+        if layers is None:
+            layers = BankLayers({})
+        self.sounds = dict(sounds)
+        self.layers = layers
+
+        # Zones of every note and layer, and their alternates
+        zone_ids = {}
+        self.zones_sounds = []
+        for key in sorted(sounds):
+            midinote, layer, alternate = key
+            if (midinote, layer) not in zone_ids:
+                zone_ids[midinote, layer] = len(self.zones_sounds)
+                self.zones_sounds.append([])
+            self.zones_sounds[zone_ids[midinote, layer]].append(sounds[key])
+        # Next alternate to play of every zone
+        self.next_alternate = [0] * len(self.zones_sounds)
+
+        # Zone id of every note and layer, -1 if missing
+        note_layer = numpy.full((MIDI_NOTES, len(layers)), -1, numpy.int16)
+        for (midinote, layer), zone in zone_ids.items():
+            note_layer[midinote, layer] = zone
+        note_layer = self.fill_nearest(note_layer)
+        note_layer = self.fill(note_layer, axis=0)
+
+        self.zones = note_layer[:, layers.velocity_layers()]
+
+        if(_class_debug): print("D: keymap with " + str(len(self.zones_sounds)) + " zones")
+
+    def __len__(self):
+        '''
+        :return: The number of zones in the map
+        '''
+        return len(self.zones_sounds)
+
+    def with_sound(self, key, sound):
+        '''
+        Build a new map with a sound added or replaced, e.g. a sample just
+        recorded. No sample is decoded again, so the new map is ready
+        in a few milliseconds and can replace the current one at once.
+
+        :param key: The tuple (MIDI note, layer, alternate) of the sound
+        :param sound: The Sound object
+        :return: The new KeyMap
+        '''
+        sounds = dict(self.sounds)
+        sounds[key] = sound
+        return KeyMap(sounds, self.layers)
+
+    @staticmethod
+    def fill(zones, axis):
+        '''
+        Assign to the items without a zone the zone of the nearest previous
+        item along an axis. The items before the first zone remain without a zone.
+
+        :param zones: 2D array of zone ids, -1 if missing
+        :param axis: The axis to fill along
+        :return: The filled array
+        '''
+        index = numpy.arange(zones.shape[axis])
+        if axis == 0:
+            index = index[:, numpy.newaxis]
+        # Index of the last item with a zone, up to every item
+        last = numpy.maximum.accumulate(numpy.where(zones >= 0, index, -1), axis=axis)
+        filled = numpy.take_along_axis(zones, numpy.maximum(last, 0), axis=axis)
+        return numpy.where(last >= 0, filled, -1).astype(numpy.int16)
+
+    @staticmethod
+    def fill_nearest(zones):
+        '''
+        Assign to the items without a zone the zone of the nearest item of
+        the same row, the previous one when the previous and the next are
+        as near. The rows without zones remain without a zone.
+
+        :param zones: 2D array of zone ids, -1 if missing
+        :return: The filled array
+        '''
+        count = zones.shape[1]
+        index = numpy.arange(count)[numpy.newaxis, :]
+        # Index of the last item with a zone up to every item, and of the
+        # first item with a zone from every item (count if none)
+        previous = numpy.maximum.accumulate(numpy.where(zones >= 0, index, -1), axis=1)
+        following = numpy.minimum.accumulate(numpy.where(zones >= 0, index, count)[:, ::-1], axis=1)[:, ::-1]
+        use_following = (following < count) & ((previous < 0) | (following - index < index - previous))
+        nearest = numpy.where(use_following, following, previous)
+        filled = numpy.take_along_axis(zones, numpy.maximum(nearest, 0), axis=1)
+        return numpy.where(nearest >= 0, filled, -1).astype(numpy.int16)
+
+    def lookup(self, midinote, velocity):
+        '''
+        Get the sound to play for a note. Every call returns the next
+        round robin alternate of the zone.
+
+        :param midinote: The MIDI note
+        :param velocity: The note velocity
+        :return: The Sound object, or None if the note has no sound
+        '''
+        if (0 <= midinote < MIDI_NOTES) and (0 <= velocity < MIDI_VELOCITIES):
+            zone = self.zones[midinote, velocity]
+            if zone >= 0:
+                alternates = self.zones_sounds[zone]
+                alternate = self.next_alternate[zone]
+                self.next_alternate[zone] = (alternate + 1) % len(alternates)
+                return alternates[alternate]
+        return None
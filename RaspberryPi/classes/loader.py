@@ -0,0 +1,73 @@
+'''
+@file loader.py
+@brief Classes to load the bank samples in parallel on a pool of workers
+'''
+
+import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from classes.music import Sound
+
+_class_debug = False
+
+class BankLoader():
+    '''
+    Decodes all the sample files of a bank at the same time on a pool
+    of worker threads.
+
+    The wav reading and the numpy conversions release the GIL for most of
+    their work, so the threads run in parallel on the Raspberry Pi cores
+    and the bank load time is close to the time needed to load the largest
+    file instead of the sum of all the files.
+    '''
+    def __init__(self, workers=None):
+        '''
+        Create the workers pool. The pool is created once and reused
+        for every bank load.
+
+        :param workers: Number of worker threads. If None, one worker per core
+        '''
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='BankLoader')
+
+    def load(self, files, interrupted):
+        '''
+        Load the sample files of a bank.
+
+        Every file is decoded by a separate task. The interrupt condition is
+        checked before every file is decoded and while waiting for the tasks
+        to complete, so a load is stopped with the granularity of a single file.
+
+        :param files: Dictionary of the files to load. Every item is the
+        tuple (file name, MIDI note, velocity)
+        :param interrupted: Function returning True when the load should be stopped
+        :return: Dictionary of the Sound objects with the same keys of files,
+        or None if the load has been interrupted
+        '''
+        def decode(file, midinote, velocity):
+            # Skip the file if the load has been interrupted while
+            # the task was waiting in the queue
+            if interrupted():
+                return None
+            if(_class_debug): print("D: decoding " + file)
+            return Sound(file, midinote, velocity)
+
+        futures = {}
+        for key, (file, midinote, velocity) in files.items():
+            futures[self.executor.submit(decode, file, midinote, velocity)] = key
+
+        sounds = {}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.05, return_when=FIRST_COMPLETED)
+            if interrupted():
+                for future in pending:
+                    future.cancel()
+                return None
+            for future in done:
+                sounds[futures[future]] = future.result()
+
+        return sounds
@@ -4,6 +4,7 @@
 '''
 
 import enum
+import mmap
 import wave
 import time
 import os
@@ -14,8 +15,8 @@ import threading
 from chunk import Chunk
 import struct
 import rtmidi_python as rtmidi
-# Cython compiled audio engine .so file
-import samplerbox_audio
+
+from classes.decoder import SampleDecoder
 
 _class_debug = False
 
@@ -30,15 +31,34 @@ class PiSynthStatus(enum.Enum):
     # The application is recording a sample
     recording = 2
 
+class SampleStorage(enum.Enum):
+    '''
+    Defines how the samples data are stored in memory, selected by the
+    sampleStorage key of gui.json. The default is memory, mmap and stream
+    are opt-in.
+    '''
+    # The samples are read from the file and kept in memory
+    memory = 'memory'
+    # The samples are memory mapped views of the wav files. The data are
+    # not copied and the OS page cache is shared between the bank loads
+    mmap = 'mmap'
+    # Only the attack of the samples is kept in memory, the rest is read
+    # from disk while playing by the stream reader
+    stream = 'stream'
+
 class Ps():
     '''
-    Makes global the playingsounds array with the current
+    Makes global the playingsounds table with the current
     sounds playing.
-    The value is initialized to empty list when the class
-    is instantiated for the first time.
+    The table is a samplerbox_audio.VoiceTable of fixed capacity,
+    created by the application when the max polyphony is known.
     '''
-    def __init__(self):
-        self.playingsounds = []
+    playingsounds = None
+
+# Format tags of the wav fmt chunk
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
 
 class waveread(wave.Wave_read):
     '''
@@ -112,6 +132,52 @@ class waveread(wave.Wave_read):
         if not self._fmt_chunk_read or not self._data_chunk:
             raise Exception('fmt chunk and/or data chunk missing')
 
+    def _read_fmt_chunk(self, chunk):
+        '''
+        Read the format chunk. Besides the integer PCM samples read by the
+        wave module, it accepts the IEEE float samples and the extensible
+        format used by most of the 24 bit and float files.
+
+        :param chunk: The fmt chunk
+        '''
+        try:
+            formattag, self._nchannels, self._framerate, avgbytespersec, blockalign, bitspersample = \
+                struct.unpack_from('<HHLLHH', chunk.read(16))
+            if formattag == WAVE_FORMAT_EXTENSIBLE:
+                # Extension size, valid bits, channel mask, then the sub format
+                # GUID, starting with the format tag
+                size, validbits, channelmask, formattag = struct.unpack_from('<HHLH', chunk.read(10))
+        except struct.error:
+            raise EOFError from None
+        if formattag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+            raise Exception('unknown format: %r' % (formattag,))
+        self._ieee = (formattag == WAVE_FORMAT_IEEE_FLOAT)
+        self._sampwidth = (bitspersample + 7) // 8
+        if not self._sampwidth:
+            raise Exception('bad sample width')
+        if not self._nchannels:
+            raise Exception('bad # of channels')
+        self._framesize = self._nchannels * self._sampwidth
+        self._comptype = 'NONE'
+        self._compname = 'not compressed'
+
+    def getieee(self):
+        '''
+        :return: True if the samples are IEEE floats, else integers
+        '''
+        return self._ieee
+
+    def getdataoffset(self):
+        '''
+        Get the position of the samples data in the file.
+
+        The data chunk position is relative to the RIFF chunk content,
+        that starts after the 8 bytes of the RIFF id and size.
+
+        :return: The offset in bytes of the data chunk content from the file start
+        '''
+        return self._data_chunk.offset + 8
+
     def getmarkers(self):
         '''
         Get the marker, if any, from the chunk currently reading
@@ -130,20 +196,27 @@ class waveread(wave.Wave_read):
 
 class PlayingSound:
     '''
-    Note sound player for MIDI
+    Note sound player for MIDI.
+
+    The playing parameters (position, fadeout, speed) are stored in the
+    voice table of the audio engine; the instance is only a handle
+    to the voice in the table.
     '''
-    def __init__(self, sound, note):
+    __slots__ = ('sound', 'note', 'voice', 'playingsounds')
+
+    def __init__(self, sound, note, arrival=0):
         '''
+        Start playing the sound in the voice table
 
-        :param sound:
-        :param note:
+        :param sound: The Sound instance to play
+        :param note: The MIDI note played
+        :param arrival: The time.monotonic_ns() of the note-on, to measure
+        its latency; 0 to skip it
         '''
         self.sound = sound
-        self.pos = 0
-        self.fadeoutpos = 0
-        self.isfadeout = False
         self.note = note
         self.playingsounds = Ps.playingsounds
+        self.voice = self.playingsounds.add(sound, note, arrival)
 
     def fadeout(self, i):
         '''
@@ -153,22 +226,30 @@ class PlayingSound:
         :return:
         '''
 
-        self.isfadeout = True
+        self.playingsounds.fadeout(self.voice)
 
     def stop(self):
         '''
-        Try to stop the current playing sound list
+        Remove the sound from the playing sounds table
 
         '''
-        try:
-            playingsounds.remove(self)
-        except:
-            pass
+        self.playingsounds.stop(self.voice)
 
 class Sound:
     '''
     Manages the MIDI sound wave samples
     '''
+    # How the samples data are stored, shared by all the sounds
+    storage = SampleStorage.memory
+    # Frames kept in memory of the streamed samples (attack)
+    attack_frames = 11025
+    # Sample rate of the audio device. The samples at another rate are
+    # played from a copy resampled by the ResampleCache, if it is set
+    rate = 44100
+    resampler = None
+    # Converts the samples of the wav files to 16 bit
+    decoder = SampleDecoder()
+
     def __init__(self, filename, midinote, velocity):
         '''
 
@@ -180,6 +261,18 @@ class Sound:
         if(_class_debug): print("D: filename " + filename)
 
         wf = waveread(filename)
+        if (Sound.resampler is not None) and (wf.getframerate() != Sound.rate):
+            cached = Sound.resampler.file_name(filename, Sound.rate)
+            if not os.path.exists(cached):
+                frames = self.frames2array(wf.readframes(wf.getnframes()), wf.getsampwidth(), wf.getnchannels(),
+                                           wf.getieee())
+                loop = tuple(wf.getloops()[0]) if wf.getloops() else None
+                Sound.resampler.write(cached, frames.reshape(-1, wf.getnchannels()),
+                                      wf.getframerate(), Sound.rate, loop, midinote)
+            wf.close()
+            # The resampled copy is played and streamed instead of the file
+            filename = cached
+            wf = waveread(filename)
         self.fname = filename
         self.midinote = midinote
         self.velocity = velocity
@@ -189,36 +282,139 @@ class Sound:
         else:
             self.loop = -1
             self.nframes = wf.getnframes()
+        # Mono samples are stored as they are and the mixer plays
+        # them on both the output channels
+        self.numchan = wf.getnchannels()
+        self.sampwidth = wf.getsampwidth()
+        self.ieee = wf.getieee()
+        self.dataoffset = wf.getdataoffset()
+        # The frames actually in the file, the loop end can be beyond
+        self.fileframes = wf.getnframes()
+        # File descriptor used to read the streamed frames
+        self.fd = None
+        self.streamed = (Sound.storage is SampleStorage.stream) and (self.nframes > Sound.attack_frames)
+        # Frames kept in memory from the loop start of a streamed sample,
+        # so after the loop wrap the reader has the time to refill the ring
+        self.loopstart = -1
+        self.loopdata = None
 
-        self.data = self.frames2array(wf.readframes(self.nframes), wf.getsampwidth(), wf.getnchannels())
+        if self.streamed:
+            self.data = self.frames2array(wf.readframes(Sound.attack_frames), wf.getsampwidth(), wf.getnchannels(),
+                                          wf.getieee())
+            if self.loop >= Sound.attack_frames:
+                wf.setpos(self.loop)
+                self.loopstart = self.loop
+                self.loopdata = numpy.ascontiguousarray(
+                    self.frames2array(wf.readframes(min(Sound.attack_frames, self.nframes - self.loop)),
+                                      wf.getsampwidth(), wf.getnchannels(), wf.getieee()))
+        elif (Sound.storage is SampleStorage.mmap) and (wf.getsampwidth() == 2) and not wf.getieee():
+            self.data = self.map2array(filename, wf.getdataoffset(),
+                                       min(self.nframes, wf.getnframes()), wf.getnchannels())
+        else:
+            self.data = self.frames2array(wf.readframes(self.nframes), wf.getsampwidth(), wf.getnchannels(),
+                                          wf.getieee())
 
         wf.close()
 
-    def play(self, note):
+    @classmethod
+    def from_array(cls, filename, midinote, velocity, data, numchan, loop, nframes, dataoffset):
+        '''
+        Create a sound from 16 bit frames already decoded, e.g. the frames
+        of a packed bank, without reading a wav file
+
+        :param filename: The file holding the frames
+        :param midinote: The MIDI note of the sample
+        :param velocity: The velocity of the sample
+        :param data: The int16 array of the frames, channels interleaved
+        :param numchan: The number of channels
+        :param loop: The loop start frame, -1 if the sample does not loop
+        :param nframes: The number of frames played (loop end + 2 if looping)
+        :param dataoffset: The offset of the frames in the file
+        :return: The new Sound instance
+        '''
+        sound = cls.__new__(cls)
+        sound.fname = filename
+        sound.midinote = midinote
+        sound.velocity = velocity
+        sound.loop = loop
+        sound.nframes = nframes
+        sound.numchan = numchan
+        sound.sampwidth = 2
+        sound.ieee = False
+        sound.dataoffset = dataoffset
+        sound.fileframes = len(data) // numchan
+        sound.fd = None
+        sound.streamed = False
+        sound.loopstart = -1
+        sound.loopdata = None
+        sound.data = data
+        return sound
+
+    def __del__(self):
+        '''
+        Close the file of the streamed frames, if it has been opened
+        '''
+        if getattr(self, 'fd', None) is not None:
+            os.close(self.fd)
+
+    def read_frames(self, start, count):
         '''
-        Append the selected note playing as an instance
-        of the Sound class
+        Read frames from the sample file. Used to stream the samples
+        not fully kept in memory.
+
+        :param start: The first frame to read
+        :param count: The number of frames to read
+        :return: The array of the frames, shorter than count at the end of the file
+        '''
+        if self.fd is None:
+            self.fd = os.open(self.fname, os.O_RDONLY)
+        count = max(0, min(count, self.fileframes - start))
+        framesize = self.sampwidth * self.numchan
+        data = os.pread(self.fd, count * framesize, self.dataoffset + start * framesize)
+        return numpy.ascontiguousarray(self.frames2array(data, self.sampwidth, self.numchan, self.ieee))
+
+    def play(self, note, arrival=0):
+        '''
+        Start playing the selected note in the voices table
 
         :param note: The selected note
-        :return:  the PlayinSound class instance with the new appaended playing note
+        :param arrival: The time.monotonic_ns() of the note-on, to measure
+        its latency; 0 to skip it
+        :return:  the PlayinSound class instance handling the new playing note
         '''
 
-        snd = PlayingSound(self, note)
-        snd.playingsounds.append(snd)
-        return snd
+        return PlayingSound(self, note, arrival)
 
-    def frames2array(self, data, sampwidth, numchan):
+    def frames2array(self, data, sampwidth, numchan, ieee=False):
         '''
+        Convert the frames read from the file to the 16 bit samples
+        played by the audio engine
 
-        :param data:
-        :param sampwidth:
-        :param numchan:
-        :return:
+        :param data: The bytes of the frames
+        :param sampwidth: The bytes of every sample
+        :param numchan: The number of channels
+        :param ieee: True if the samples are IEEE floats
+        :return: The int16 array of the samples, channels interleaved. The
+        16 bit frames are a view on data, without copy
+        '''
+        return Sound.decoder.decode(data, sampwidth, ieee)
+
+    def map2array(self, filename, offset, nframes, numchan):
+        '''
+        Map the 16 bit samples of the file data chunk in memory without
+        reading them. The pages are loaded by the OS when they are played
+        and stay in the page cache between the bank loads.
+
+        :param filename: The wav file name
+        :param offset: The data chunk offset in the file
+        :param nframes: The number of frames to map
+        :param numchan: The number of channels of the file
+        :return: The read-only array of the samples
         '''
-        if sampwidth == 2:
-            npdata = numpy.fromstring(data, dtype=numpy.int16)
-        elif sampwidth == 3:
-            npdata = samplerbox_audio.binary24_to_int16(data, len(data)/3)
-        if numchan == 1:
-            npdata = numpy.repeat(npdata, 2)
+        npdata = numpy.memmap(filename, dtype='<i2', mode='r',
+                              offset=offset, shape=(nframes * numchan,))
+        # Ask the OS to read ahead the pages, so the first time the
+        # sound is played the audio callback does not wait for the disk
+        if (getattr(npdata, '_mmap', None) is not None) and hasattr(mmap, 'MADV_WILLNEED'):
+            npdata._mmap.madvise(mmap.MADV_WILLNEED)
         return npdata
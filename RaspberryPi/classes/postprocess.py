@@ -0,0 +1,194 @@
+'''
+@file postprocess.py
+@brief Classes to prepare the recorded samples for playing
+'''
+
+import struct
+
+import numpy
+
+_class_debug = False
+
+class TakeProcessor():
+    '''
+    Processing of a recorded take before it is saved as a sample:
+    the silence before and after the sound is trimmed, the level is
+    normalized and a sustain loop is searched, so the note can be held
+    longer than the take.
+
+    The loop length is a multiple of the sound period, found by
+    autocorrelation, and the loop starts and ends on rising zero crossings
+    with the most similar waveform. A take without a periodic sustain
+    (e.g. a noise or a percussive sound) is saved without a loop and plays
+    as a one-shot. All the processing is vectorized with numpy.
+    '''
+    def __init__(self, rate, silence_db=-45.0, peak_db=-1.0, min_similarity=0.8):
+        '''
+        :param rate: The sample rate of the takes
+        :param silence_db: RMS level under the loudest part of the take
+        considered silence (dB)
+        :param peak_db: Peak level of the normalized samples (dBFS)
+        :param min_similarity: Min normalized correlation between the loop
+        start and end waveforms to accept a loop (0 to 1)
+        '''
+        self.rate = rate
+        self.silence = 10 ** (silence_db / 20)
+        self.peak = 10 ** (peak_db / 20) * 32767
+        self.min_similarity = min_similarity
+        # Sound kept before the first and after the last frame over
+        # the silence level, not to cut the attack and the release
+        self.preroll = rate * 5 // 1000
+        self.release = rate * 50 // 1000
+        # Length of the RMS level compared with the silence level, so the
+        # peaks of the background noise are not taken for the sound
+        self.level_window = max(rate * 10 // 1000, 1)
+        # Range of the periods searched (40 Hz to 2 kHz)
+        self.min_period = rate // 2000
+        self.max_period = rate // 40
+        # Length of the waveforms compared at the loop start and end
+        self.window = rate * 20 // 1000
+
+    def process(self, frames):
+        '''
+        Process a take
+
+        :param frames: The int16 frames of the take, one row per frame
+        :return: The tuple (processed int16 frames, loop), where loop is
+        the tuple (start frame, end frame) or None if no loop has been found
+        '''
+        mono = frames.astype(numpy.float32).mean(axis=1)
+        level = self.rms_level(mono)
+        peak = level.max() if len(level) else 0
+        if peak == 0:
+            return frames, None
+
+        # Trim the silence
+        loud = numpy.flatnonzero(level > peak * self.silence)
+        first = max(loud[0] - self.preroll, 0)
+        last = min(loud[-1] + self.release, len(mono))
+        frames = frames[first:last]
+        mono = mono[first:last]
+
+        # Normalize the peak level
+        gain = self.peak / numpy.abs(frames.astype(numpy.float32)).max()
+        frames = numpy.clip(numpy.rint(frames * numpy.float32(gain)), -32768, 32767).astype(numpy.int16)
+
+        return frames, self.find_loop(mono)
+
+    def rms_level(self, mono):
+        '''
+        Calculate the RMS level of the take around every frame
+
+        :param mono: The take, as a float mono signal
+        :return: The RMS level of the level_window frames centered on every frame
+        '''
+        power = numpy.concatenate(([0.0], numpy.cumsum(mono.astype(numpy.float64) ** 2)))
+        half = self.level_window // 2
+        lo = numpy.clip(numpy.arange(len(mono)) - half, 0, len(mono))
+        hi = numpy.clip(lo + self.level_window, 0, len(mono))
+        return numpy.sqrt(numpy.maximum(power[hi] - power[lo], 0) / numpy.maximum(hi - lo, 1))
+
+    def find_loop(self, mono):
+        '''
+        Search a sustain loop
+
+        :param mono: The trimmed take, as a float mono signal
+        :return: The tuple (start frame, end frame) of the loop, or None
+        '''
+        count = len(mono)
+        # The loop is searched after the attack (peak and first 20% of the
+        # sound) and before the release (last 20%)
+        start_min = max(int(numpy.argmax(numpy.abs(mono))), count // 5)
+        end_max = count * 4 // 5
+        if end_max - start_min < 4 * self.max_period + self.window:
+            return None
+
+        period = self.find_period(mono[start_min:end_max])
+        if period is None:
+            return None
+
+        # The loop starts on the first rising zero crossing
+        rising = numpy.flatnonzero((mono[:-1] < 0) & (mono[1:] >= 0)) + 1
+        starts = rising[rising >= start_min]
+        if len(starts) == 0:
+            return None
+        start = int(starts[0])
+
+        # The longest whole number of periods that fits in the sustain
+        half = period // 2
+        length = ((end_max - self.window - half - start) // period) * period
+        if length < period:
+            return None
+
+        # Compare the waveform at the loop start with the waveforms near
+        # the nominal loop end, and pick the most similar rising zero crossing
+        reference = mono[start:start + self.window]
+        lo = start + length - half
+        candidates = mono[lo:start + length + half + self.window]
+        dot = numpy.correlate(candidates, reference, mode='valid')
+        energy = numpy.convolve(candidates * candidates, numpy.ones(self.window, numpy.float32), mode='valid')
+        similarity = dot / numpy.sqrt(numpy.maximum(energy * numpy.dot(reference, reference), 1e-12))
+
+        ends = rising[(rising >= lo) & (rising < lo + len(similarity))]
+        if len(ends) == 0:
+            return None
+        best = ends[numpy.argmax(similarity[ends - lo])]
+        if similarity[best - lo] < self.min_similarity:
+            if(_class_debug): print("D: no loop, similarity " + str(similarity[best - lo]))
+            return None
+        # The last frame of the loop is followed again by the loop start
+        # frame, so it is the frame matching the start
+        return start, int(best)
+
+    def find_period(self, mono):
+        '''
+        Estimate the period of a sound by autocorrelation
+
+        :param mono: The sustain of the sound, as a float mono signal
+        :return: The period in frames, or None if the sound is not periodic
+        '''
+        size = 1 << int(numpy.ceil(numpy.log2(2 * len(mono))))
+        spectrum = numpy.fft.rfft(mono - mono.mean(), size)
+        correlation = numpy.fft.irfft(spectrum * numpy.conj(spectrum), size)[:self.max_period + 1]
+        if correlation[0] <= 0:
+            return None
+        lags = correlation[self.min_period:] / correlation[0]
+        period = self.min_period + int(numpy.argmax(lags))
+        if lags[period - self.min_period] < self.min_similarity:
+            return None
+        return period
+
+    @staticmethod
+    def write(filename, frames, rate, loop=None, midinote=60):
+        '''
+        Write a 16 bit wav file with the loop in the cue and smpl chunks,
+        as read by the waveread class
+
+        :param filename: The wav file name
+        :param frames: The int16 frames, one row per frame
+        :param rate: The sample rate
+        :param loop: The tuple (start frame, end frame) of the loop, or None
+        :param midinote: The MIDI unity note of the sample
+        '''
+        channels = frames.shape[1]
+        data = frames.astype('<i2').tobytes()
+        chunks = [b'fmt ' + struct.pack('<IHHIIHH', 16, 1, channels, rate,
+                                         rate * channels * 2, channels * 2, 16),
+                  b'data' + struct.pack('<I', len(data)) + data]
+        if len(data) % 2:
+            chunks.append(b'\x00')
+        if loop is not None:
+            start, end = loop
+            # Cue point id, position, chunk id, chunk start, block start, sample offset
+            chunks.append(b'cue ' + struct.pack('<II', 28, 1) +
+                          struct.pack('<II4sIII', 1, start, b'data', 0, 0, start))
+            # Manufacturer, product, sample period (ns), MIDI unity note, pitch
+            # fraction, SMPTE format and offset, number of loops, sampler data,
+            # then the loop: cue point id, type (forward), start, end, fraction, play count
+            chunks.append(b'smpl' + struct.pack('<I', 60) +
+                          struct.pack('<IIIIIIIII', 0, 0, 1000000000 // rate, midinote,
+                                      0, 0, 0, 1, 0) +
+                          struct.pack('<IIIIII', 1, 0, start, end, 0, 0))
+        body = b'WAVE' + b''.join(chunks)
+        with open(filename, 'wb') as file:
+            file.write(b'RIFF' + struct.pack('<I', len(body)) + body)
@@ -0,0 +1,139 @@
+'''
+@file prefetch.py
+@brief Classes to load in background the banks likely selected next
+'''
+
+import os
+import threading
+
+from classes.music import Sound
+from classes.keymap import KeyMap
+from classes.cache import BankCache
+
+_class_debug = False
+
+class BankPrefetcher():
+    '''
+    Low priority background thread decoding the banks near the current one
+    into the banks cache, so selecting the next or the previous bank is a
+    swap of the key map instead of a load from the disk.
+
+    The samples are decoded one at a time and only while the sampler is idle
+    (no voices playing and no bank loading), so the prefetch never competes
+    with the audio callback. A bank partially decoded when the sampler stops
+    being idle is decoded again from the start later.
+    '''
+    def __init__(self, cache, describe, idle, packed=None, period=0.1):
+        '''
+        :param cache: The BankCache where the banks are stored
+        :param describe: Function returning the tuple (files, BankLayers) of a
+        bank number, with the files dictionary as passed to BankLoader.load(),
+        or None if the bank does not exist
+        :param idle: Function returning True when the sampler is idle
+        :param packed: Function returning the sounds of a bank number and
+        files dictionary from the packed bank, or None if the bank is not
+        packed. If None, the banks are always decoded from the sample files
+        :param period: Pause between the checks of the idle status (s)
+        '''
+        self.cache = cache
+        self.describe = describe
+        self.idle = idle
+        self.packed = packed
+        self.period = period
+        # Banks still to prefetch, first to last
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='BankPrefetcher')
+        self.thread.daemon = True
+
+    def start(self):
+        '''
+        Start the prefetch thread
+        '''
+        self.thread.start()
+
+    def schedule(self, banks):
+        '''
+        Replace the banks to prefetch. The banks scheduled before and not
+        yet prefetched are discarded.
+
+        :param banks: List of the bank numbers, in order of priority
+        '''
+        with self.lock:
+            self.pending = list(banks)
+        self.wakeup.set()
+
+    def next_bank(self):
+        '''
+        :return: The first bank to prefetch, or None if there are no banks
+        '''
+        with self.lock:
+            if self.pending:
+                return self.pending[0]
+            return None
+
+    def done(self, bank):
+        '''
+        Remove a bank from the banks to prefetch, unless it has been
+        rescheduled meanwhile
+
+        :param bank: The bank number
+        '''
+        with self.lock:
+            if self.pending and (self.pending[0] == bank):
+                self.pending.pop(0)
+
+    def prefetch(self, bank):
+        '''
+        Decode a bank into the cache, if not already cached
+
+        :param bank: The bank number
+        :return: False if the decoding has been stopped as the sampler
+        is no more idle or the banks to prefetch have changed
+        '''
+        description = self.describe(bank)
+        if description is None:
+            return True
+        files, layers = description
+        signature = BankCache.signature(files)
+        if self.cache.fresh(bank, signature):
+            return True
+
+        # A packed bank is only mapped, with no decoding
+        sounds = None
+        if self.packed is not None:
+            sounds = self.packed(bank, files)
+        if sounds is None:
+            sounds = {}
+            for key, (file, midinote, velocity) in files.items():
+                if (not self.idle()) or (self.next_bank() != bank):
+                    return False
+                sounds[key] = Sound(file, midinote, velocity)
+
+        self.cache.put(bank, signature, KeyMap(sounds, layers))
+        if(_class_debug): print("D: bank " + str(bank) + " prefetched")
+        return True
+
+    def run(self):
+        '''
+        Prefetch thread loop
+        '''
+        # Lower the thread priority, so the decoding gets only the
+        # processor time not used by the audio and the interface.
+        # Linux sets the priority of every thread apart.
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+
+        while True:
+            bank = self.next_bank()
+            if bank is None:
+                self.wakeup.wait()
+                self.wakeup.clear()
+            elif not self.idle():
+                self.wakeup.wait(self.period)
+                self.wakeup.clear()
+            elif self.prefetch(bank):
+                self.done(bank)
@@ -0,0 +1,217 @@
+'''
+@file recorder.py
+@brief Classes to record the samples in background
+'''
+
+import os
+import queue
+import threading
+import time
+import wave
+
+import numpy
+
+_class_debug = False
+
+class FrameRing():
+    '''
+    Ring buffer of audio frames between the thread of the audio input
+    (producer) and a worker thread (consumer).
+
+    The producer only changes the written frames counter and the consumer
+    only the read frames counter, so the ring needs no locks: the audio
+    input never waits for the consumer. When the ring is full the new
+    frames are dropped and counted as an overrun.
+    '''
+    def __init__(self, frames, channels):
+        '''
+        :param frames: The ring size in frames
+        :param channels: The number of channels of every frame
+        '''
+        self.buffer = numpy.zeros((frames, channels), numpy.int16)
+        self.size = frames
+        # Total frames written and read since the ring has been created
+        self.written = 0
+        self.read = 0
+        # Number of writes with frames dropped
+        self.overruns = 0
+
+    def __len__(self):
+        '''
+        :return: The number of frames available to read
+        '''
+        return self.written - self.read
+
+    def write(self, frames):
+        '''
+        Write frames in the ring. Called by the producer only.
+
+        :param frames: Array of int16 frames, one row per frame
+        '''
+        count = min(len(frames), self.size - (self.written - self.read))
+        if count < len(frames):
+            self.overruns += 1
+        start = self.written % self.size
+        first = min(count, self.size - start)
+        self.buffer[start:start + first] = frames[:first]
+        self.buffer[:count - first] = frames[first:count]
+        self.written += count
+
+    def take(self, count=None):
+        '''
+        Read the frames available in the ring. Called by the consumer only.
+
+        :param count: Max number of frames to read. If None, all the available frames
+        :return: Array of the frames read
+        '''
+        available = self.written - self.read
+        if (count is None) or (count > available):
+            count = available
+        start = self.read % self.size
+        first = min(count, self.size - start)
+        frames = numpy.concatenate((self.buffer[start:start + first], self.buffer[:count - first]))
+        self.read += count
+        return frames
+
+    def drop(self):
+        '''
+        Discard the frames available in the ring. Called by the consumer only.
+        '''
+        self.read = self.written
+
+class SampleRecorder():
+    '''
+    Records the samples on a worker thread, so the interface does not
+    wait for the recording.
+
+    The audio input delivers the frames to feed() while a take is being
+    recorded. The frames go through a FrameRing to the worker thread,
+    writing them to the wav file as they arrive and reporting the progress
+    of the take.
+    '''
+    def __init__(self, rate, channels, ring_frames, processor=None, period=0.02, timeout=1.0):
+        '''
+        :param rate: The recording sample rate
+        :param channels: The number of recorded channels
+        :param ring_frames: The ring buffer size in frames
+        :param processor: The TakeProcessor preparing the takes before they
+        replace the samples. If None, the takes are saved as recorded
+        :param period: Pause between the reads of the ring (s)
+        :param timeout: Max time without input frames before a take is
+        stopped, e.g. if the audio device has no input (s)
+        '''
+        self.rate = rate
+        self.channels = channels
+        self.period = period
+        self.timeout = timeout
+        self.processor = processor
+        self.ring = FrameRing(ring_frames, channels)
+        # Set while a take is being recorded
+        self.recording = False
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='SampleRecorder')
+        self.thread.daemon = True
+
+    def start(self):
+        '''
+        Start the worker thread
+        '''
+        self.thread.start()
+
+    def feed(self, frames):
+        '''
+        Deliver the input frames. Called by the audio input callback,
+        the frames are kept only while a take is being recorded.
+
+        :param frames: Array of int16 frames, one row per frame
+        '''
+        if self.recording:
+            self.ring.write(frames)
+
+    def record(self, filename, seconds, progress=None, done=None):
+        '''
+        Request a take. The call returns immediately and the take is
+        recorded by the worker thread. The callbacks are called by the
+        worker thread.
+
+        :param filename: The wav file to write. It replaces the file only
+        when the take is complete
+        :param seconds: The duration of the take
+        :param progress: Function called with the fraction of the take recorded
+        :param done: Function called with the file name when the take is saved,
+        or None if the take could not be saved
+        '''
+        self.requests.put((filename, seconds, progress, done))
+
+    def take(self, filename, seconds, progress):
+        '''
+        Record a take to a wav file
+
+        :param filename: The wav file to write
+        :param seconds: The duration of the take
+        :param progress: Function called with the fraction of the take recorded
+        :return: True if the take has been saved, False if no input frames
+        have been received
+        '''
+        total = int(seconds * self.rate)
+        recorded = 0
+        overruns = self.ring.overruns
+        received = time.monotonic()
+
+        wavefile = wave.open(filename + '.tmp', 'wb')
+        wavefile.setnchannels(self.channels)
+        wavefile.setsampwidth(2)
+        wavefile.setframerate(self.rate)
+
+        self.ring.drop()
+        self.recording = True
+        while recorded < total:
+            time.sleep(self.period)
+            frames = self.ring.take(total - recorded)
+            if len(frames):
+                wavefile.writeframes(frames.astype('<i2').tobytes())
+                recorded += len(frames)
+                received = time.monotonic()
+                if progress is not None:
+                    progress(recorded / total)
+            elif time.monotonic() - received > self.timeout:
+                break
+        self.recording = False
+        wavefile.close()
+
+        if recorded < total:
+            os.remove(filename + '.tmp')
+            if(_class_debug): print("D: no input frames, recording stopped")
+            return False
+
+        if self.processor is not None:
+            wavefile = wave.open(filename + '.tmp', 'rb')
+            frames = numpy.frombuffer(wavefile.readframes(recorded), dtype='<i2').reshape(-1, self.channels)
+            wavefile.close()
+            frames, loop = self.processor.process(frames)
+            self.processor.write(filename + '.tmp', frames, self.rate, loop)
+            if(_class_debug): print("D: take processed, loop " + str(loop))
+
+        # The take replaces the previous sample, that can still be memory
+        # mapped by a playing note, so the previous file is not overwritten
+        os.replace(filename + '.tmp', filename)
+
+        if(_class_debug): print("D: recorded " + filename + " overruns " +
+                                str(self.ring.overruns - overruns))
+        return True
+
+    def run(self):
+        '''
+        Worker thread loop
+        '''
+        while True:
+            filename, seconds, progress, done = self.requests.get()
+            try:
+                if not self.take(filename, seconds, progress):
+                    filename = None
+            except (OSError, wave.Error) as error:
+                if(_class_debug): print("D: recording failed " + str(error))
+                self.recording = False
+                filename = None
+            if done is not None:
+                done(filename)
@@ -0,0 +1,312 @@
+'''
+@file render.py
+@brief Classes to render offline the notes of a bank with the audio engine
+'''
+
+import json
+import struct
+import time
+import wave
+
+import numpy
+# Cython compiled audio engine .so file
+import samplerbox_audio
+
+from classes.music import Sound, SampleStorage
+from classes.gui import Utilities
+from classes.keymap import KeyMap, BankLayers
+from classes.bankpack import BankPack
+from classes.audioprofile import AudioProfile
+from classes.resample import ResampleCache
+from classes.decoder import SampleDecoder
+
+_class_debug = False
+
+# Interpolation names used in gui.json
+INTERPOLATIONS = {
+    'none': samplerbox_audio.INTERPOLATION_NONE,
+    'linear': samplerbox_audio.INTERPOLATION_LINEAR,
+    'hermite': samplerbox_audio.INTERPOLATION_HERMITE
+}
+
+class OfflineBank():
+    '''
+    A bank loaded outside of the control panel, with the same settings,
+    to play it with the audio engine without the sound card.
+    '''
+    def __init__(self, bank, settings, loader=None):
+        '''
+        Load a bank. All the samples are read in memory, as the offline
+        voices table has no disk streaming.
+
+        :param bank: The bank number
+        :param settings: The dictionary of gui.json
+        :param loader: The BankLoader decoding the sample files. If None,
+        the bank should be packed
+        '''
+        definition = "bank" + str(bank) + ".json"
+        with open(definition) as file:
+            dictionary = json.load(file)
+
+        Sound.storage = SampleStorage.memory
+        # The samples are played at the sample rate of the audio device
+        self.rate = AudioProfile.from_settings(settings).rate
+        Sound.rate = self.rate
+        Sound.resampler = ResampleCache.from_settings(settings)
+        # Fixed dither noise, so the same notes always give the same render
+        Sound.decoder = SampleDecoder(dither=bool(settings.get('decodeDither', False)), seed=0)
+        self.bank = bank
+        self.layers = BankLayers(dictionary)
+        folder = settings['samples'] + "B" + str(bank) + "/"
+        # Only 96 notes are used (12 notes x 8 octaves)
+        self.files = self.layers.sample_files(folder, settings['note_names'],
+                                              int(dictionary['velocity']), range(96))
+        sounds = BankPack.load(BankPack.file_name(folder), self.files, definition)
+        if sounds is None:
+            if loader is None:
+                raise ValueError('bank ' + str(bank) + ' is not packed')
+            sounds = loader.load(self.files, lambda: False)
+        self.keymap = KeyMap(sounds, self.layers)
+        # Same volume calculation of the control panel, -12 dB by default
+        self.volume = 10 ** (-12.0 / 20) * 10 ** (float(dictionary['volume']) / 20)
+        self.transpose = int(dictionary['transpose'])
+
+    @staticmethod
+    def voices(settings, polyphony=None, blocksize=512, quality=None):
+        '''
+        Create a voices table with the settings of the control panel
+
+        :param settings: The dictionary of gui.json
+        :param polyphony: The max number of voices. If None, as in the settings
+        :param blocksize: The max frames of a mixed block
+        :param quality: The interpolation. If None, as in the settings
+        :return: The samplerbox_audio.VoiceTable
+        '''
+        if polyphony is None:
+            polyphony = int(settings['maxPolyphony'])
+        if quality is None:
+            quality = INTERPOLATIONS[settings.get('interpolation', 'linear')]
+        fadeout_length = int(settings['fadeoutLength'])
+        fadeout = Utilities.calcFade1(fadeout_length)
+        fadeout = Utilities.calcFade2(fadeout)
+        fadeout = Utilities.calcFade3(fadeout, fadeout_length)
+        return samplerbox_audio.VoiceTable(polyphony, Utilities.calcStretchFactor(), fadeout,
+                                           fadeout_length, blocksize, quality)
+
+class OfflineRenderer():
+    '''
+    Renders a list of timed MIDI messages with the audio engine, block after
+    block as fast as possible, instead of the sound card callback.
+
+    The notes are started at the exact frame of their messages, so the same
+    messages always give the same frames: the renders can be compared to test
+    the changes of the audio engine.
+    '''
+    def __init__(self, keymap, voices, volume, transpose=0, rate=44100, blocksize=512):
+        '''
+        :param keymap: The KeyMap of the bank to play
+        :param voices: The samplerbox_audio.VoiceTable mixing the notes
+        :param volume: The output volume
+        :param transpose: Notes added to the played notes, as the bank transpose
+        :param rate: The sample rate
+        :param blocksize: The max frames mixed at once
+        '''
+        self.keymap = keymap
+        self.voices = voices
+        self.volume = volume
+        self.transpose = transpose
+        self.rate = rate
+        self.blocksize = blocksize
+        self.playingnotes = {}
+        self.sustainplayingnotes = []
+        self.sustain = False
+        # Duration of the last render (s)
+        self.render_time = 0
+
+    def message(self, message):
+        '''
+        Process a MIDI message, as the control panel MIDI callback
+
+        :param message: The MIDI message bytes
+        '''
+        messagetype = message[0] >> 4
+        note = message[1] if len(message) > 1 else None
+        velocity = message[2] if len(message) > 2 else None
+
+        # Note on with velocity 0 is a note off
+        if messagetype == 9 and velocity == 0:
+            messagetype = 8
+
+        if messagetype == 9:
+            midinote = note + self.transpose
+            sound = self.keymap.lookup(midinote, velocity)
+            if sound is not None:
+                self.playingnotes.setdefault(midinote, []).append(self.voices.add(sound, midinote))
+        elif messagetype == 8:
+            midinote = note + self.transpose
+            for voice in self.playingnotes.get(midinote, []):
+                if self.sustain:
+                    self.sustainplayingnotes.append(voice)
+                else:
+                    self.voices.fadeout(voice)
+            self.playingnotes[midinote] = []
+        elif (messagetype == 11) and (note == 64):
+            if velocity < 64:
+                for voice in self.sustainplayingnotes:
+                    self.voices.fadeout(voice)
+                self.sustainplayingnotes = []
+                self.sustain = False
+            else:
+                self.sustain = True
+
+    def render(self, events, tail=10.0):
+        '''
+        Render the MIDI messages
+
+        :param events: List of the tuples (time in seconds, MIDI message bytes)
+        :param tail: Max seconds rendered after the last message, while
+        the notes are still playing
+        :return: The int16 stereo frames, one row per frame
+        '''
+        events = sorted(events, key=lambda event: event[0])
+        starts = [int(round(seconds * self.rate)) for seconds, message in events]
+        end = (starts[-1] if starts else 0) + int(tail * self.rate)
+
+        out = numpy.zeros((self.blocksize, 2), numpy.int16)
+        blocks = []
+        pos = 0
+        i = 0
+        started = time.perf_counter()
+        while True:
+            while (i < len(events)) and (starts[i] <= pos):
+                self.message(events[i][1])
+                i += 1
+            if (i == len(events)) and ((len(self.voices) == 0) or (pos >= end)):
+                break
+            # The block stops at the next message
+            count = self.blocksize
+            if i < len(events):
+                count = min(count, starts[i] - pos)
+            samplerbox_audio.mixaudiobuffers(self.voices, count, out, self.volume)
+            blocks.append(out[:count].copy())
+            pos += count
+        self.render_time = time.perf_counter() - started
+
+        if not blocks:
+            return numpy.zeros((0, 2), numpy.int16)
+        return numpy.concatenate(blocks)
+
+    def realtime_factor(self, frames):
+        '''
+        :param frames: The frames of the last render
+        :return: The ratio between the duration of the rendered audio and
+        the render time
+        '''
+        return (len(frames) / self.rate) / max(self.render_time, 1e-9)
+
+    @staticmethod
+    def write(filename, frames, rate=44100):
+        '''
+        Write the rendered frames to a 16 bit stereo wav file
+
+        :param filename: The wav file name
+        :param frames: The int16 stereo frames
+        :param rate: The sample rate
+        '''
+        wavefile = wave.open(filename, 'wb')
+        wavefile.setnchannels(2)
+        wavefile.setsampwidth(2)
+        wavefile.setframerate(rate)
+        wavefile.writeframes(frames.astype('<i2').tobytes())
+        wavefile.close()
+
+def read_variable(data, pos):
+    '''
+    Read a variable length number of a MIDI file
+
+    :param data: The track data
+    :param pos: The position of the number
+    :return: The tuple (number, position after the number)
+    '''
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            return value, pos
+
+def read_midi_file(filename):
+    '''
+    Read the channel messages of a standard MIDI file (format 0 or 1),
+    following the tempo changes
+
+    :param filename: The MIDI file name
+    :return: List of the tuples (time in seconds, MIDI message bytes),
+    sorted by time
+    '''
+    with open(filename, 'rb') as file:
+        data = file.read()
+    if data[:4] != b'MThd':
+        raise ValueError(filename + ' is not a MIDI file')
+    length, midi_format, ntracks, division = struct.unpack('>IHHh', data[4:14])
+    pos = 8 + length
+
+    # Messages and tempo changes of all the tracks, in ticks
+    messages = []
+    tempos = [(0, 500000)]
+    for track in range(ntracks):
+        while data[pos:pos + 4] != b'MTrk':
+            # Skip the unknown chunks
+            pos += 8 + struct.unpack('>I', data[pos + 4:pos + 8])[0]
+        end = pos + 8 + struct.unpack('>I', data[pos + 4:pos + 8])[0]
+        pos += 8
+        tick = 0
+        status = 0
+        while pos < end:
+            delta, pos = read_variable(data, pos)
+            tick += delta
+            if data[pos] & 0x80:
+                status = data[pos]
+                pos += 1
+            if status == 0xff:
+                # Meta event, 0x51 is the tempo change
+                kind = data[pos]
+                size, pos = read_variable(data, pos + 1)
+                if kind == 0x51:
+                    tempos.append((tick, int.from_bytes(data[pos:pos + 3], 'big')))
+                pos += size
+                status = 0
+            elif status in (0xf0, 0xf7):
+                # System exclusive event
+                size, pos = read_variable(data, pos)
+                pos += size
+                status = 0
+            else:
+                # Channel message, the program change and channel pressure
+                # have a single data byte
+                size = 1 if (status >> 4) in (0xc, 0xd) else 2
+                messages.append((tick, len(messages), [status] + list(data[pos:pos + size])))
+                pos += size
+        pos = end
+
+    # Convert the ticks to seconds with the tempo map
+    tempos.sort(key=lambda tempo: tempo[0])
+    if division < 0:
+        # SMPTE division: frames per second and ticks per frame
+        tick_seconds = [(0, 0.0, 1.0 / (-(division >> 8) * (division & 0xff)))]
+    else:
+        tick_seconds = []
+        seconds = 0.0
+        last_tick, last_tempo = 0, 500000
+        for tick, tempo in tempos:
+            seconds += (tick - last_tick) * last_tempo / 1e6 / division
+            tick_seconds.append((tick, seconds, tempo / 1e6 / division))
+            last_tick, last_tempo = tick, tempo
+
+    starts = [tick for tick, seconds, scale in tick_seconds]
+    events = []
+    for tick, order, message in sorted(messages):
+        tempo_tick, seconds, scale = tick_seconds[numpy.searchsorted(starts, tick, side='right') - 1]
+        events.append((seconds + (tick - tempo_tick) * scale, message))
+    return events
@@ -0,0 +1,206 @@
+'''
+@file resample.py
+@brief Classes to resample the samples to the rate of the audio device
+'''
+
+import hashlib
+import json
+import math
+import os
+import threading
+
+import numpy
+
+from classes.postprocess import TakeProcessor
+
+_class_debug = False
+
+class ResampleCache():
+    '''
+    Copies of the sample files resampled to the rate of the audio device,
+    kept on disk.
+
+    The audio engine plays every sample at the device rate, so a sample
+    recorded at another rate is converted once, when it is loaded the first
+    time, instead of in the mixer for every voice. The copy is a 16 bit wav
+    file, with the loop moved at the new rate, named after the hash of the
+    source file: a sample is converted again only if its content changes.
+    The hashes are kept in an index file of the folder, with the size and
+    the modification time of the sources, so a source file is read to hash
+    it only when it changes.
+
+    The conversion is a polyphase windowed sinc filter (Kaiser window),
+    applied to all the output frames at once with numpy.
+    '''
+    # Zero crossings of the sinc on every side of the filter
+    ZEROS = 16
+    # Shape of the Kaiser window, about 90 dB of stop band attenuation
+    BETA = 9.0
+    # Output frames calculated at once, to limit the memory used
+    CHUNK = 16384
+    # Index of the source hashes in the folder
+    INDEX = 'index.json'
+
+    def __init__(self, folder):
+        '''
+        :param folder: The folder of the resampled files, created if missing
+        '''
+        self.folder = folder
+        # Dictionary of the source file names to the list (size,
+        # modification time in ns, hash), read at the first use
+        self.hashes = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        '''
+        :param settings: The dictionary of gui.json
+        :return: The ResampleCache in the resampleCache folder, by default
+        the Resampled folder of the samples
+        '''
+        return cls(settings.get('resampleCache', settings['samples'] + 'Resampled/'))
+
+    @staticmethod
+    def source_hash(filename):
+        '''
+        :param filename: The sample file name
+        :return: The SHA-1 hex digest of the file content
+        '''
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def cached_hash(self, filename):
+        '''
+        :param filename: The sample file name
+        :return: The SHA-1 hex digest of the file content, read from the
+        index if the size and the modification time of the file match
+        '''
+        name = os.path.abspath(filename)
+        info = os.stat(name)
+        signature = [info.st_size, info.st_mtime_ns]
+        with self.lock:
+            if self.hashes is None:
+                self.hashes = self.read_index()
+            entry = self.hashes.get(name)
+        if entry is not None and entry[:2] == signature:
+            return entry[2]
+        digest = self.source_hash(name)
+        with self.lock:
+            self.hashes[name] = signature + [digest]
+            self.write_index()
+        return digest
+
+    def read_index(self):
+        '''
+        :return: The dictionary of the index file, empty if missing or invalid
+        '''
+        try:
+            with open(os.path.join(self.folder, self.INDEX)) as file:
+                hashes = json.load(file)
+            return hashes if isinstance(hashes, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def write_index(self):
+        '''
+        Write the index file, apart and renamed when complete. Called holding the lock
+        '''
+        index_name = os.path.join(self.folder, self.INDEX)
+        temp_name = "%s.%d.tmp" % (index_name, threading.get_ident())
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(temp_name, 'w') as file:
+                json.dump(self.hashes, file)
+            os.replace(temp_name, index_name)
+        except OSError as e:
+            # The hashes are calculated again at the next start
+            if(_class_debug): print("D: cannot write the resample index: %s" % e)
+
+    def file_name(self, filename, rate):
+        '''
+        :param filename: The sample file name
+        :param rate: The sample rate of the copy
+        :return: The name of the resampled copy of the file
+        '''
+        return os.path.join(self.folder, "%s-%d.wav" % (self.cached_hash(filename), rate))
+
+    @classmethod
+    def filters(cls, up, down):
+        '''
+        Calculate the polyphase filter bank
+
+        :param up: The interpolation factor
+        :param down: The decimation factor
+        :return: The tuple (filters, half width): the filters array has a row
+        for every phase, with the weights of the input frames from
+        1 - half width to half width around the output frame
+        '''
+        # The cutoff is the lower Nyquist frequency, relative to the input one
+        cutoff = min(1.0, up / down)
+        half = int(math.ceil(cls.ZEROS / cutoff))
+        taps = numpy.arange(1 - half, half + 1)
+        # Distance of every tap from the output frame, in input frames
+        x = numpy.arange(up)[:, None] / up - taps[None, :]
+        window = numpy.i0(cls.BETA * numpy.sqrt(numpy.clip(1 - (x / half) ** 2, 0, None))) / numpy.i0(cls.BETA)
+        weights = cutoff * numpy.sinc(cutoff * x) * window
+        # Unity gain at every phase
+        weights /= weights.sum(axis=1, keepdims=True)
+        return weights.astype(numpy.float32), half
+
+    @classmethod
+    def resample(cls, frames, source_rate, rate):
+        '''
+        Resample the frames
+
+        :param frames: The int16 frames, one row per frame
+        :param source_rate: The sample rate of the frames
+        :param rate: The new sample rate
+        :return: The resampled int16 frames, one row per frame
+        '''
+        divisor = math.gcd(source_rate, rate)
+        up, down = rate // divisor, source_rate // divisor
+        filters, half = cls.filters(up, down)
+
+        count = len(frames)
+        padded = numpy.zeros((count + 2 * half + 1, frames.shape[1]), numpy.float32)
+        padded[half:half + count] = frames
+        taps = numpy.arange(1 - half, half + 1) + half
+
+        total = (count * up + down - 1) // down
+        out = numpy.empty((total, frames.shape[1]), numpy.int16)
+        for start in range(0, total, cls.CHUNK):
+            position = numpy.arange(start, min(start + cls.CHUNK, total), dtype=numpy.int64) * down
+            # Input frame before every output frame and phase between the two
+            base = position // up
+            phase = position % up
+            mixed = numpy.einsum('nt,ntc->nc', filters[phase], padded[base[:, None] + taps[None, :]])
+            out[start:start + len(mixed)] = numpy.clip(numpy.rint(mixed), -32768, 32767)
+        return out
+
+    def write(self, cached, frames, source_rate, rate, loop=None, midinote=60):
+        '''
+        Resample the frames and write them to the resampled copy. The copy
+        is written apart and renamed when complete, so a loader never reads
+        a partial file.
+
+        :param cached: The name of the resampled copy
+        :param frames: The int16 frames, one row per frame
+        :param source_rate: The sample rate of the frames
+        :param rate: The new sample rate
+        :param loop: The tuple (start frame, end frame) of the loop at the
+        source rate, or None
+        :param midinote: The MIDI unity note of the sample
+        '''
+        resampled = self.resample(frames, source_rate, rate)
+        if loop is not None:
+            start, end = (int(round(frame * rate / source_rate)) for frame in loop)
+            # The player reads two frames after the loop end
+            loop = (start, min(end, len(resampled) - 2))
+        os.makedirs(self.folder, exist_ok=True)
+        temp_name = "%s.%d.tmp" % (cached, threading.get_ident())
+        TakeProcessor.write(temp_name, resampled, rate, loop, midinote)
+        os.replace(temp_name, cached)
+        if(_class_debug): print("D: resampled %d Hz to %d Hz in %s" % (source_rate, rate, cached))
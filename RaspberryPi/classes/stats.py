@@ -0,0 +1,125 @@
+'''
+@file stats.py
+@brief Classes to report the audio engine statistics
+'''
+
+import threading
+import time
+
+import numpy
+
+_class_debug = False
+
+class EngineStats():
+    '''
+    Background thread reading periodically the counters of the audio engine
+    and reporting what happened in the last period: the mix time of the
+    audio blocks, the blocks played late, the voices playing, replaced when
+    the polyphony is full and ended, and the note-on latency.
+
+    The counters are updated by the audio callback without locks or memory
+    allocations; all the calculations are done by this thread.
+    '''
+    def __init__(self, voices, period, deadline, report):
+        '''
+        :param voices: The samplerbox_audio.VoiceTable of the playing voices
+        :param period: The report period (s)
+        :param deadline: The duration of an audio block (s), the max mix time
+        :param report: Function called with the summary of every period
+        '''
+        self.voices = voices
+        self.period = period
+        self.deadline = deadline
+        self.report = report
+        self.thread = threading.Thread(target=self.run, name='EngineStats')
+        self.thread.daemon = True
+
+    def start(self):
+        '''
+        Start the statistics thread
+        '''
+        self.thread.start()
+
+    @staticmethod
+    def percentile(histogram, fraction):
+        '''
+        Estimate a percentile of the block mix time from the histogram
+
+        :param histogram: The blocks of every time bucket
+        :param fraction: The percentile, from 0 to 1
+        :return: The upper bound of the bucket of the percentile (us),
+        0 if there are no blocks
+        '''
+        total = sum(histogram)
+        if total == 0:
+            return 0
+        count = 0
+        for bucket, blocks in enumerate(histogram):
+            count += blocks
+            if count >= fraction * total:
+                return 1 << bucket
+        return 1 << (len(histogram) - 1)
+
+    def summary(self, current, previous, latencies):
+        '''
+        Calculate the statistics of a period
+
+        :param current: The engine counters at the end of the period
+        :param previous: The engine counters at the start of the period
+        :param latencies: The note-on latencies of the period (ns)
+        :return: Dictionary of the statistics
+        '''
+        if len(latencies) > 0:
+            note_p50, note_p99 = numpy.percentile(latencies, [50, 99]) / 1e6
+            note_max = latencies.max() / 1e6
+        else:
+            note_p50 = note_p99 = note_max = 0
+        histogram = [now - before for now, before in zip(current['histogram'], previous['histogram'])]
+        # The bucket bounds can be over the max time measured
+        p50 = min(self.percentile(histogram, 0.5), current['maxtime_us'])
+        p99 = min(self.percentile(histogram, 0.99), current['maxtime_us'])
+        return {
+            'blocks': current['blocks'] - previous['blocks'],
+            'p50_us': p50,
+            'p99_us': p99,
+            'max_us': current['maxtime_us'],
+            'load': p99 / (self.deadline * 1e6),
+            'voices': current['voices'],
+            'peak': current['peak'],
+            'stolen': current['stolen'] - previous['stolen'],
+            'finished': current['finished'] - previous['finished'],
+            'xruns': current['xruns'] - previous['xruns'],
+            'underflows': current['underflows'] - previous['underflows'],
+            'underruns': current['underruns'] - previous['underruns'],
+            'latency_ms': current['latency'] * 1000,
+            'notes': len(latencies),
+            'note_p50_ms': note_p50,
+            'note_p99_ms': note_p99,
+            'note_max_ms': note_max
+        }
+
+    @staticmethod
+    def format(summary):
+        '''
+        :param summary: The statistics of a period
+        :return: The statistics as a short text line
+        '''
+        return ("mix p50 %(p50_us)dus p99 %(p99_us)dus max %(max_us).0fus load %(load).0f%% | "
+                "voices %(voices)d peak %(peak)d stolen %(stolen)d ended %(finished)d | "
+                "xruns %(xruns)d underflows %(underflows)d underruns %(underruns)d | "
+                "latency %(latency_ms).1fms | notes %(notes)d p50 %(note_p50_ms).1fms "
+                "p99 %(note_p99_ms).1fms max %(note_max_ms).1fms") % dict(summary, load=summary['load'] * 100)
+
+    def run(self):
+        '''
+        Statistics thread loop
+        '''
+        previous = self.voices.stats()
+        while True:
+            time.sleep(self.period)
+            current = self.voices.stats()
+            latencies = self.voices.note_latencies(previous['probes'])
+            summary = self.summary(current, previous, latencies)
+            previous = current
+            if(_class_debug): print("D: " + self.format(summary))
+            self.report(summary)
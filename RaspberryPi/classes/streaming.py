@@ -0,0 +1,111 @@
+'''
+@file streaming.py
+@brief Classes to stream from disk the samples not kept in memory
+'''
+
+import threading
+import time
+
+_class_debug = False
+
+class StreamReader():
+    '''
+    Background thread reading from disk the frames of the streamed voices.
+
+    Only the attack of a streamed sample, and the start of its loop, are
+    kept in memory. While a voice plays the attack, the reader fills the voice
+    ring in the voice table with the next blocks of the sample, following the
+    loop if any, so the audio callback never reads the disk. After a loop wrap
+    the voice plays the loop start from memory, so the blocks that follow can
+    be read also when their ring slots were taken by the blocks of the loop end.
+    '''
+    def __init__(self, voices, lookahead, period=0.005):
+        '''
+        :param voices: The samplerbox_audio.VoiceTable of the playing voices
+        :param lookahead: Number of frames read ahead of the playing position,
+        at the sample speed
+        :param period: Pause between the checks of the voices when there is nothing to read (s)
+        '''
+        self.voices = voices
+        self.lookahead = lookahead
+        self.period = period
+        self.thread = threading.Thread(target=self.run, name='StreamReader')
+        self.thread.daemon = True
+
+    def start(self):
+        '''
+        Start the reader thread
+        '''
+        self.thread.start()
+
+    def blocks_ahead(self, sound, pos, speed):
+        '''
+        Calculate the blocks of a sample needed by a voice in the next
+        lookahead frames, following the loop, nearest first.
+        Every block goes in the ring slot block % ring blocks. Near the loop
+        end the blocks after the loop start can fall in the same slots of
+        the blocks before the loop end: the list stops at the first block
+        whose slot is taken by a nearer block, so a block needed never
+        replaces another one needed. The farther block is read when the
+        nearer one has been played.
+
+        :param sound: The Sound played by the voice
+        :param pos: The playing position (frames)
+        :param speed: The playing speed
+        :return: List of the blocks numbers
+        '''
+        block_frames = self.voices.block_frames
+        max_blocks = self.voices.ring_blocks - 1
+        # The frames of the attack and of the loop start are already in memory
+        attack = len(sound.data) // sound.numchan
+        loopstart = sound.loopstart
+        loopend = loopstart + (len(sound.loopdata) // sound.numchan if sound.loopdata is not None else 0)
+        frames = int(self.lookahead * speed)
+        # The frame before the position is read by the interpolation
+        k = max(int(pos) - 1, 0)
+        wrapped = False
+        blocks = []
+        # Block held by every ring slot used
+        slots = {}
+        while (frames > 0) and (len(blocks) < max_blocks):
+            n = min(frames, sound.nframes - k)
+            if n <= 0:
+                # Stop at the end of a one-shot sample or of an empty loop
+                if (sound.loop < 0) or wrapped:
+                    break
+                k = sound.loop + 1
+                wrapped = True
+                continue
+            wrapped = False
+            for block in range(k // block_frames, (k + n - 1) // block_frames + 1):
+                if (block + 1) * block_frames <= attack:
+                    continue
+                if (block * block_frames >= loopstart) and ((block + 1) * block_frames <= loopend):
+                    continue
+                slot = block % self.voices.ring_blocks
+                if slot in slots:
+                    if slots[slot] != block:
+                        return blocks[:max_blocks]
+                    continue
+                slots[slot] = block
+                blocks.append(block)
+            frames -= n
+            k += n
+        return blocks[:max_blocks]
+
+    def run(self):
+        '''
+        Reader thread loop
+        '''
+        block_frames = self.voices.block_frames
+        while True:
+            busy = False
+            for voice, sound, pos, speed in self.voices.streaming():
+                for block in self.blocks_ahead(sound, pos, speed):
+                    if not self.voices.block_loaded(voice, block):
+                        frames = sound.read_frames(block * block_frames, block_frames)
+                        self.voices.fill_block(voice, block, frames)
+                        busy = True
+            # Wait when all the blocks that can be scheduled are loaded
+            if not busy:
+                time.sleep(self.period)
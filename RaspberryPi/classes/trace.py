@@ -0,0 +1,112 @@
+'''
+@file trace.py
+@brief Classes to trace the sampler events in memory
+'''
+
+import array
+import itertools
+import time
+
+import numpy
+
+_class_debug = False
+
+class EventTrace():
+    '''
+    Ring buffer of the last sampler events, in binary form.
+
+    Recording an event stores its time and three numbers in preallocated
+    arrays, with no string formatting and no memory allocation, so it can be
+    called in the MIDI callback. The ring is converted to text or written
+    to a file only when it is dumped.
+    '''
+    # Event types
+    NOTE_ON = 1
+    NOTE_OFF = 2
+    NOTE_MISSING = 3
+    SUSTAIN = 4
+    PROGRAM_CHANGE = 5
+    LOAD_START = 6
+    LOAD_END = 7
+    NAMES = {
+        NOTE_ON: 'note on',
+        NOTE_OFF: 'note off',
+        NOTE_MISSING: 'note missing',
+        SUSTAIN: 'sustain',
+        PROGRAM_CHANGE: 'program change',
+        LOAD_START: 'load start',
+        LOAD_END: 'load end'
+    }
+    # Layout of the events in the dump file
+    RECORD = numpy.dtype([('time', '<i8'), ('event', 'u1'), ('note', '<i2'), ('velocity', '<i2')])
+
+    def __init__(self, size):
+        '''
+        :param size: Number of events kept in the ring
+        '''
+        self.size = size
+        # Plain arrays, faster than numpy to set a single item
+        self.times = array.array('q', bytes(8 * size))
+        self.events = array.array('B', bytes(size))
+        self.notes = array.array('h', bytes(2 * size))
+        self.velocities = array.array('h', bytes(2 * size))
+        # The counter gives every event its own slot also when the events
+        # are recorded by more threads
+        self.counter = itertools.count()
+        self.recorded = 0
+
+    def record(self, event, note=0, velocity=0):
+        '''
+        Record an event
+
+        :param event: The event type
+        :param note: The MIDI note, or the bank for the load events
+        :param velocity: The velocity, or the event value. None, as for the
+        two bytes MIDI messages, is recorded as 0
+        '''
+        i = next(self.counter)
+        slot = i % self.size
+        self.times[slot] = time.monotonic_ns()
+        self.events[slot] = event
+        self.notes[slot] = note or 0
+        self.velocities[slot] = velocity or 0
+        self.recorded = i + 1
+
+    def records(self):
+        '''
+        :return: The events in the ring as a structured array, oldest first
+        '''
+        count = min(self.recorded, self.size)
+        order = (numpy.arange(self.recorded - count, self.recorded)) % self.size
+        records = numpy.zeros(count, self.RECORD)
+        records['time'] = numpy.frombuffer(self.times, numpy.int64)[order]
+        records['event'] = numpy.frombuffer(self.events, numpy.uint8)[order]
+        records['note'] = numpy.frombuffer(self.notes, numpy.int16)[order]
+        records['velocity'] = numpy.frombuffer(self.velocities, numpy.int16)[order]
+        return records
+
+    def dump(self, filename):
+        '''
+        Write the events in the ring to a binary file, readable with
+        numpy.fromfile(filename, EventTrace.RECORD)
+
+        :param filename: The dump file name
+        '''
+        self.records().tofile(filename)
+
+    @classmethod
+    def format(cls, records):
+        '''
+        :param records: The structured array of the events
+        :return: The events as text, one per line, with the time in ms
+        from the first event
+        '''
+        if len(records) == 0:
+            return ''
+        start = records['time'][0]
+        lines = []
+        for record in records:
+            lines.append("%10.3f ms %-14s %4d %4d" % ((record['time'] - start) / 1e6,
+                                                     cls.NAMES.get(int(record['event']), '?'),
+                                                     record['note'], record['velocity']))
+        return '\n'.join(lines)
@@ -0,0 +1,173 @@
+'''
+@file latency.py
+@brief Measures the latency from the note-on to the sound output
+
+Plays synthetic notes on the sound card with the audio engine, with a
+range of block sizes, and measures for every note the time from the
+note-on to the output of its first frame: the wait for the next audio
+block, the mix and the output latency reported by the device (DAC time).
+The notes are sent by a thread at random intervals, as a player would,
+while other threads can keep the GIL busy as the panel GUI and the bank
+loader do. For every block size it reports the latency distribution and
+the blocks played late, to choose the block size of the sampler.
+
+    python3 latency.py
+    python3 latency.py --blocksizes 128 256 512 --busy 2 --output latency.json
+'''
+
+import argparse
+import json
+import platform
+import random
+import threading
+import time
+
+import numpy
+import sounddevice
+# Cython compiled audio engine .so file
+import samplerbox_audio
+
+from classes.gui import Utilities
+from benchmark import synthetic_sound, RATE, MIDINOTE
+
+def play_notes(voices, sound, rate, hold, stop):
+    '''
+    Send note-ons at random intervals, as a MIDI player, until stopped
+
+    :param voices: The samplerbox_audio.VoiceTable playing the notes
+    :param sound: The Sound played by the notes
+    :param rate: The mean number of notes per second
+    :param hold: The duration of every note (s)
+    :param stop: The threading.Event stopping the notes
+    '''
+    playing = []
+    while not stop.wait(random.expovariate(rate)):
+        note = MIDINOTE + random.randint(-12, 12)
+        playing.append((time.monotonic() + hold, voices.add(sound, note, time.monotonic_ns())))
+        while playing and playing[0][0] <= time.monotonic():
+            voices.fadeout(playing.pop(0)[1])
+
+def keep_busy(stop):
+    '''
+    Keep the GIL busy with Python code until stopped
+
+    :param stop: The threading.Event stopping the thread
+    '''
+    while not stop.is_set():
+        sum(i * i for i in range(1000))
+
+def run(sound, blocksize, seconds, rate, hold, busy, polyphony=80, device=None, fadeout_length=30000):
+    '''
+    Measure the note-on latency with a block size
+
+    :param sound: The Sound played by the notes
+    :param blocksize: The frames of every audio block
+    :param seconds: The duration of the measure
+    :param rate: The mean number of notes per second
+    :param hold: The duration of every note (s)
+    :param busy: The number of threads keeping the GIL busy
+    :param polyphony: The max number of voices
+    :param device: The sound device, None for the default one
+    :param fadeout_length: The fadeout length of the voices table
+    :return: Dictionary of the results
+    '''
+    fadeout = Utilities.calcFade1(fadeout_length)
+    fadeout = Utilities.calcFade2(fadeout)
+    fadeout = Utilities.calcFade3(fadeout, fadeout_length)
+    voices = samplerbox_audio.VoiceTable(polyphony, Utilities.calcStretchFactor(), fadeout,
+                                         fadeout_length, blocksize)
+
+    def callback(outdata, frame_count, time_info, status):
+        # Same timing of the control panel audio callback
+        if status:
+            voices.xruns += 1
+            if status.output_underflow:
+                voices.underflows += 1
+        voices.latency = time_info.outputBufferDacTime - time_info.currentTime
+        samplerbox_audio.mixaudiobuffers(voices, frame_count, outdata, 1.0)
+
+    stop = threading.Event()
+    threads = [threading.Thread(target=play_notes, args=(voices, sound, rate, hold, stop))]
+    threads += [threading.Thread(target=keep_busy, args=(stop,)) for i in range(busy)]
+
+    latencies = []
+    stream = sounddevice.OutputStream(device=device, samplerate=RATE, blocksize=blocksize,
+                                      channels=2, dtype='int16', callback=callback)
+    with stream:
+        for thread in threads:
+            thread.start()
+        # The voice table keeps only the last latencies, they are read
+        # during the measure
+        probes = 0
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            time.sleep(0.25)
+            latencies.append(voices.note_latencies(probes))
+            probes += len(latencies[-1])
+        stop.set()
+        for thread in threads:
+            thread.join()
+        output_latency = stream.latency
+
+    latencies = numpy.concatenate(latencies) / 1e6
+    result = {
+        'blocksize': blocksize,
+        'block_ms': blocksize / RATE * 1000,
+        'output_latency_ms': output_latency * 1000,
+        'notes': len(latencies),
+        'xruns': voices.xruns,
+        'underflows': voices.underflows
+    }
+    if len(latencies) > 0:
+        p50, p90, p99 = numpy.percentile(latencies, [50, 90, 99])
+        result.update({
+            'min_ms': float(latencies.min()),
+            'p50_ms': float(p50),
+            'p90_ms': float(p90),
+            'p99_ms': float(p99),
+            'max_ms': float(latencies.max()),
+            # Spread of the latency, heard as timing jitter
+            'jitter_ms': float(p99 - latencies.min())
+        })
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the latency from the note-on to the sound output')
+    parser.add_argument('--blocksizes', type=int, nargs='+', default=[128, 256, 512, 1024],
+                        help='the block sizes (default 128 256 512 1024)')
+    parser.add_argument('--seconds', type=float, default=10.0,
+                        help='the duration of every measure (default 10)')
+    parser.add_argument('--rate', type=float, default=20.0,
+                        help='the mean notes per second (default 20)')
+    parser.add_argument('--hold', type=float, default=0.5,
+                        help='the duration of every note in seconds (default 0.5)')
+    parser.add_argument('--busy', type=int, default=1,
+                        help='the threads keeping the GIL busy (default 1)')
+    parser.add_argument('--device', help='the sound device (default the system one)')
+    parser.add_argument('--output', help='the json file to write (default the standard output)')
+    args = parser.parse_args()
+
+    sound = synthetic_sound(stereo=True, looped=True)
+    results = []
+    for blocksize in args.blocksizes:
+        result = run(sound, blocksize, args.seconds, args.rate, args.hold, args.busy, device=args.device)
+        results.append(result)
+        if args.output and 'p50_ms' in result:
+            print("blocksize %(blocksize)d: %(notes)d notes, latency p50 %(p50_ms).1f ms "
+                  "p99 %(p99_ms).1f ms max %(max_ms).1f ms, %(xruns)d xruns" % result)
+
+    report = {
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'rate': RATE,
+        'notes_per_second': args.rate,
+        'busy_threads': args.busy,
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,83 @@
+'''
+@file pack_bank.py
+@brief Packs the sample banks for a fast load
+
+Converts the sample files of a bank (the bank folder Samples/B<n> and the
+bank definition bank<n>.json) in a single packed bank file next to the bank
+folder. The control panel maps the packed bank when it is newer than the
+sample files and the bank definition, else it loads the sample files as usual.
+
+Run from the folder of gui.json:
+
+    python3 pack_bank.py            pack all the banks
+    python3 pack_bank.py 0 3        pack the banks 0 and 3
+    python3 pack_bank.py --force    pack also the banks already up to date
+'''
+
+import argparse
+import json
+
+from classes.music import Sound, SampleStorage
+from classes.keymap import BankLayers
+from classes.loader import BankLoader
+from classes.bankpack import BankPack
+from classes.audioprofile import AudioProfile
+from classes.resample import ResampleCache
+from classes.decoder import SampleDecoder
+
+# Number of the sample banks (bank0.json to bank7.json)
+max_banks = 8
+
+def pack_bank(bank, samples_path, note_names, loader, force):
+    '''
+    Pack a bank
+
+    :param bank: The bank number
+    :param samples_path: Full path of the samples (bank folders)
+    :param note_names: The names of the 12 notes of an octave
+    :param loader: The BankLoader decoding the sample files
+    :param force: If True the bank is packed also if it is up to date
+    :return: The number of samples packed, 0 if the bank is up to date
+    '''
+    definition = "bank" + str(bank) + ".json"
+    with open(definition) as file:
+        dictionary = json.load(file)
+
+    layers = BankLayers(dictionary)
+    folder = samples_path + "B" + str(bank) + "/"
+    # Only 96 notes are used (12 notes x 8 octaves)
+    files = layers.sample_files(folder, note_names, int(dictionary['velocity']), range(96))
+
+    packed_name = BankPack.file_name(folder)
+    if (not force) and (BankPack.load(packed_name, files, definition) is not None):
+        return 0
+
+    sounds = loader.load(files, lambda: False)
+    BankPack.write(packed_name, sounds)
+    return len(sounds)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack the sample banks for a fast load')
+    parser.add_argument('banks', type=int, nargs='*', default=list(range(max_banks)),
+                        help='the banks to pack (default all)')
+    parser.add_argument('--force', action='store_true',
+                        help='pack also the banks already up to date')
+    args = parser.parse_args()
+
+    with open("gui.json") as file:
+        settings = json.load(file)
+
+    # The packed frames are the whole samples decoded in memory, at the
+    # sample rate of the audio device
+    Sound.storage = SampleStorage.memory
+    Sound.rate = AudioProfile.from_settings(settings).rate
+    Sound.resampler = ResampleCache.from_settings(settings)
+    Sound.decoder = SampleDecoder(dither=bool(settings.get('decodeDither', False)))
+    loader = BankLoader()
+
+    for bank in args.banks:
+        packed = pack_bank(bank, settings['samples'], settings['note_names'], loader, args.force)
+        if packed:
+            print("Bank " + str(bank) + ": " + str(packed) + " samples packed")
+        else:
+            print("Bank " + str(bank) + ": up to date")
@@ -20,7 +20,7 @@ define in the GUI configuration file gui.json
 import tkinter as tk
 import numpy as np
 from functools import partial
-from time import sleep
+from time import sleep, monotonic_ns
 from PIL import Image, ImageTk
 import json
 
@@ -28,14 +28,25 @@ import numpy
 import os
 import sounddevice
 import threading
+import signal
 import rtmidi_python as rtmidi
 import samplerbox_audio
 
-import pyaudio
-import wave
-
-from classes.music import Sound, PlayingSound, Ps
+from classes.music import Sound, PlayingSound, Ps, SampleStorage
 from classes.gui import PiSynthStatus, Utilities
+from classes.loader import BankLoader
+from classes.keymap import KeyMap, BankLayers
+from classes.streaming import StreamReader
+from classes.cache import BankCache
+from classes.prefetch import BankPrefetcher
+from classes.bankpack import BankPack
+from classes.recorder import SampleRecorder
+from classes.postprocess import TakeProcessor
+from classes.stats import EngineStats
+from classes.trace import EventTrace
+from classes.audioprofile import AudioProfile
+from classes.resample import ResampleCache
+from classes.decoder import SampleDecoder
 
 # ------------------------ Creation of the root GUI
 window = tk.Tk()
@@ -51,6 +62,12 @@ screen_height = window.winfo_screenheight()
 # or 1 (digital). In this application we use an external USB audio card
 # supporting also audio sampling, so the value will differ
 audio_device_id = 0
+# Sample rate of the audio device, used both to play and to record
+audio_rate = 44100
+# Frames of every audio block
+audio_blocksize = 512
+# Settings of the audio device stream, read from the "audio" section of gui.json
+audio_profile = AudioProfile()
 
 # --------------------------------------------------------------
 #                   Parameters & Constants
@@ -59,21 +76,37 @@ audio_device_id = 0
 # Buttons list
 button = list()
 
-# Debug flag. Set it to false to disable the debug messages
+# Debug flag. Set it to false to disable the debug messages.
+# On the hot paths (MIDI callback and bank loading) the debug messages are
+# guarded by "if(__debug__ and _debug):", so they cost a flag check when the
+# debug is disabled and they are removed running python with -O
 _debug = False
 
-def debugMsg(m):
+def debugMsg(m, *args):
     '''
-    Debug function
-    :param m: The debug message
+    Debug function. The message is formatted only if the debug is enabled.
+
+    :param m: The debug message, or a % format string
+    :param args: The values of the format string, if any
     '''
     if(_debug):
+        if(args):
+            m = m % args
         print(m)
 
+# Trace of the last MIDI and loading events, None if disabled
+event_trace = None
+# File where the event trace is dumped
+trace_file = 'trace.bin'
+
 # Samples loading thread
 LoadingThread = None
 # Sample loading IRQ
 LoadingInterrupt = False
+# Pool of workers decoding the bank samples in parallel
+bank_loader = BankLoader()
+# Number of the sample banks (bank0.json to bank7.json)
+max_banks = 8
 
 # When a button on the control panel has been pressed. Bound to the
 # corresponding mouse event on the corresponding widget button
@@ -86,11 +119,14 @@ isReleased = False
 #                         Music Presets
 # --------------------------------------------------------------
 
-samples = {}
+# Map of the MIDI notes to the samples of the current bank
+keymap = KeyMap()
+# Sample files of the current bank, as passed to BankLoader.load()
+bank_files = {}
 playingnotes = {}
 sustainplayingnotes = []
 sustain = False
-# Instance of the Ps class that makes the playingsounds array of pointers
+# The Ps class that makes the playingsounds table of voices
 # available from everywhere
 ps = Ps
 
@@ -148,6 +184,11 @@ def load_GUI_parameters():
     # 0 or 1 depending on the setting of analog output or HDMI output. The USB
     # sound board has typically the id 2
     global audio_device_id
+    # Block size, sample rate, latency hint and output format of the
+    # audio device stream
+    global audio_profile
+    global audio_rate
+    global audio_blocksize
     # List with the names of the notes to load the samples
     # Every sample file name is the same of the note that should
     # associated in the selected bank. The missing notes are
@@ -158,8 +199,6 @@ def load_GUI_parameters():
     global midi_device
     # Recording sample rate (44 or 48 KHz
     global sampling_rate
-    # Recording chunk size in bytes (will work fine with 4096)
-    global recording_chunk_size
     # Recording channels. Currently only the mono recording is
     # supported by the audio card (1 channel)
     global input_channels
@@ -168,6 +207,8 @@ def load_GUI_parameters():
     # The sample record duration (seconds)
     # The value should be included between 1 sec and 9 sec max.
     global sample_lenght
+    # Records the samples in background
+    global sample_recorder
     # The fade out duration base for the notes. This value is
     # used to calculate the fadeout of every note
     global FADEOUTLENGTH
@@ -175,6 +216,29 @@ def load_GUI_parameters():
     global FADEOUT
     # Playing speed (stretch factore)
     global SPEED
+    # How the samples are stored: read in memory (default) or, opt-in
+    # with sampleStorage, memory mapped ("mmap") or streamed ("stream")
+    global sample_storage
+    # Interpolation used to play the notes at a different pitch from the
+    # samples: none (cheapest), linear or hermite (best quality)
+    global interpolation
+    # Max number of streamed voices playing together, when the samples
+    # are streamed from disk
+    global stream_voices
+    # Disk reader of the streamed voices
+    global stream_reader
+    # Recently loaded banks kept in memory for a fast bank switch
+    global bank_cache
+    # Background loader of the banks near the current one
+    global bank_prefetcher
+    # Periodic report of the audio engine statistics, None if disabled
+    global engine_stats
+    # Show the audio engine statistics on the panel
+    global stats_overlay
+    # Trace of the last MIDI and loading events
+    global event_trace
+    # File where the event trace is dumped
+    global trace_file
 
     # Loads the parameters main dictionary
     with open("gui.json") as file:
@@ -196,12 +260,38 @@ def load_GUI_parameters():
     # Playing control parameters
     max_polyphony = int(dictionary['maxPolyphony'])
     audio_device_id = int(dictionary['audioDevice'])
+    audio_profile = AudioProfile.from_settings(dictionary)
+    audio_rate = audio_profile.rate
+    # The samples at another rate are resampled once to the device rate
+    # and the copies are kept on disk, so the engine plays them natively
+    Sound.rate = audio_rate
+    Sound.resampler = ResampleCache.from_settings(dictionary)
+    # The samples with more than 16 bits are rounded to 16 bits, with
+    # the TPDF dither if decodeDither is true
+    Sound.decoder = SampleDecoder(dither=bool(dictionary.get('decodeDither', False)))
     midi_device = dictionary['midiDevice']
     note_names = dictionary['note_names']
+    sample_storage = SampleStorage(dictionary.get('sampleStorage', 'memory'))
+    Sound.storage = sample_storage
+    interpolation = {
+        'none': samplerbox_audio.INTERPOLATION_NONE,
+        'linear': samplerbox_audio.INTERPOLATION_LINEAR,
+        'hermite': samplerbox_audio.INTERPOLATION_HERMITE
+    }[dictionary.get('interpolation', 'linear')]
+    # Only the attack of the streamed samples is kept in memory, the rest
+    # is read from disk by the stream reader while the note plays
+    Sound.attack_frames = int(dictionary.get('streamAttackMs', 250)) * audio_rate // 1000
+    stream_voices = int(dictionary.get('streamVoices', 32))
+    stream_ring_frames = int(dictionary.get('streamRingFrames', 65536))
+    # Memory budget of the banks cache (MB), zero to disable the cache
+    bank_cache = BankCache(int(dictionary.get('bankCacheMB', 256)) * 1024 * 1024)
+    # The banks near the current one are decoded in the cache while
+    # no notes are playing, so the next bank is selected immediately
+    bank_prefetcher = BankPrefetcher(bank_cache, describe_bank, sampler_idle,
+                                     packed=load_packed_bank)
 
     # Recording settings
-    sampling_rate = int(dictionary['recordSampleRate'])
-    recording_chunk_size = int(dictionary['recordChunkSize'])
+    sampling_rate = int(dictionary.get('recordSampleRate', audio_rate))
     input_channels = int(dictionary['recordChannels'])
     sample_lenght = int(dictionary['recordDuration'])
 
@@ -211,6 +301,20 @@ def load_GUI_parameters():
     elif(sample_lenght > 9):
         sample_lenght = 9
 
+    # The samples are recorded from the same audio stream playing the
+    # notes, at the same sample rate
+    if(sampling_rate != audio_rate):
+        debugMsg('Recording at the audio device rate %d', audio_rate)
+    # The takes are trimmed, normalized and looped before they are saved
+    if(dictionary.get('recordProcess', True)):
+        take_processor = TakeProcessor(audio_rate,
+                                       silence_db=float(dictionary.get('recordSilenceDb', -45)),
+                                       peak_db=float(dictionary.get('recordPeakDb', -1)))
+    else:
+        take_processor = None
+    # The ring buffer holds one second of recorded frames
+    sample_recorder = SampleRecorder(audio_rate, input_channels, audio_rate, processor=take_processor)
+
     # Initial status when starting
     synth_Status = PiSynthStatus.STANDBY
 
@@ -223,6 +327,48 @@ def load_GUI_parameters():
 
     SPEED = Utilities.calcStretchFactor()
 
+    # With the block size "auto" the audio device plays the voices of
+    # the max polyphony with increasing block sizes, and the smallest
+    # one that runs without xruns is used
+    if(audio_profile.blocksize is None):
+        audio_profile.blocksize = audio_profile.probe(
+            audio_device_id,
+            lambda blocksize: samplerbox_audio.VoiceTable(max_polyphony, SPEED, FADEOUT, FADEOUTLENGTH,
+                                                          blocksize, interpolation))
+        debugMsg('Audio block size %d', audio_profile.blocksize)
+    audio_blocksize = audio_profile.blocksize
+
+    # Table of the playing voices, limited to the max polyphony
+    # The streamed voices have a ring buffer for the frames read from disk
+    if(sample_storage is SampleStorage.stream):
+        streams = stream_voices
+    else:
+        streams = 0
+    ps.playingsounds = samplerbox_audio.VoiceTable(max_polyphony, SPEED, FADEOUT, FADEOUTLENGTH,
+                                                   blocksize=audio_blocksize, quality=interpolation, streams=streams,
+                                                   ring_frames=stream_ring_frames)
+    # Read ahead half of the ring, so the reader has the time of
+    # the other half to refill it
+    stream_reader = StreamReader(ps.playingsounds, stream_ring_frames // 2)
+
+    # The engine statistics are reported every statsPeriod seconds
+    # (0 to disable) in the debug messages and optionally on the panel
+    stats_period = float(dictionary.get('statsPeriod', 0))
+    stats_overlay = bool(dictionary.get('statsOverlay', False))
+    if(stats_period > 0):
+        engine_stats = EngineStats(ps.playingsounds, stats_period,
+                                   audio_blocksize / audio_rate, report_stats)
+    else:
+        engine_stats = None
+
+    # The last traceEvents events (0 to disable) are kept in memory and
+    # dumped to traceFile when the process receives the SIGUSR1 signal
+    trace_events = int(dictionary.get('traceEvents', 0))
+    trace_file = dictionary.get('traceFile', 'trace.bin')
+    if(trace_events > 0):
+        event_trace = EventTrace(trace_events)
+        signal.signal(signal.SIGUSR1, dump_trace)
+
     # The frame that includes all the buttons.
     # The parameters for the border and pads will center the button grid
     # on the screen. Keep them fixed! Should be recalculated if the
@@ -314,7 +460,7 @@ def klik(event, n):
     global synth_Status
 
     # n not zero
-    debugMsg("click: " +str(n) + " event " + str(event))
+    debugMsg("click: %s event %s", n, event)
 
     # List of the bank buttons to check if a bank change has been pressed
     bank_button_numbers = [15, 31, 47, 63, 79, 95, 111, 127]
@@ -536,17 +682,22 @@ def load_bank_IDs(bank):
     global globaltranspose
     # The velocity of the bank
     global globalvelocity
+    # The velocity layers and round robin alternates of the bank
+    global bank_layers
 
     # Build the Json selected bank file name
     j_name = "bank" + str(bank) + ".json"
     # Set the current bank ID
     current_bank = bank
 
-    debugMsg("Loading " + j_name)
+    debugMsg("Loading %s", j_name)
 
     with open(j_name) as file:
         dictionary = json.load(file)
 
+    # The layers define the names of the samples files
+    bank_layers = BankLayers(dictionary)
+
     # Load the notes flags for every octave.
     # There are max eight octaves and the notes are
     # listed in the traditional order c, c#, d, d#, e, f, f#, a, a#, b
@@ -561,14 +712,9 @@ def load_bank_IDs(bank):
     octave7 = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
     octave8 = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
 
-    debugMsg("Octave1 " + str(octave1) + "\n" +
-          "Octave2 " + str(octave2) + "\n" +
-          "Octave3 " + str(octave3) + "\n" +
-          "Octave4 " + str(octave4) + "\n" +
-          "Octave5 " + str(octave5) + "\n" +
-          "Octave6 " + str(octave6) + "\n" +
-          "Octave7 " + str(octave7) + "\n" +
-          "Octave8 " + str(octave8) )
+    debugMsg("Octave1 %s\nOctave2 %s\nOctave3 %s\nOctave4 %s\n"
+             "Octave5 %s\nOctave6 %s\nOctave7 %s\nOctave8 %s",
+             octave1, octave2, octave3, octave4, octave5, octave6, octave7, octave8)
 
     # Loop all the notes of every bank to see if the corresponding file
     # exists. In this case the array position is set to 1
@@ -576,62 +722,65 @@ def load_bank_IDs(bank):
         # Create the full file name of the note for every bank
         # then if the file exists, set the corresponding flag
         # # in the octave array.
-        if(os.path.isfile(get_note_file_name(0, j))):
-            debugMsg("j " + str(j) + " bFname " + get_note_file_name(0, j) + " file exists")
+        if(note_has_sample(0, j)):
+            if(__debug__ and _debug):
+                debugMsg("j %d bFname %s file exists", j, get_note_file_name(0, j))
             octave1[j] = 1
         else:
             octave1[j] = 0
 
-        if(os.path.isfile(get_note_file_name(1, j))):
-            debugMsg("j " + str(j) + " bFname " + get_note_file_name(1, j) + " file exists")
+        if(note_has_sample(1, j)):
+            if(__debug__ and _debug):
+                debugMsg("j %d bFname %s file exists", j, get_note_file_name(1, j))
             octave2[j] = 1
         else:
             octave2[j] = 0
 
-        if(os.path.isfile(get_note_file_name(2, j))):
-            debugMsg("j " + str(j) + " bFname " + get_note_file_name(2, j) + " file exists")
+        if(note_has_sample(2, j)):
+            if(__debug__ and _debug):
+                debugMsg("j %d bFname %s file exists", j, get_note_file_name(2, j))
             octave3[j] = 1
         else:
             octave3[j] = 0
 
-        if(os.path.isfile(get_note_file_name(3, j))):
-            debugMsg("j " + str(j) + " bFname " + get_note_file_name(3, j) + " file exists")
+        if(note_has_sample(3, j)):
+            if(__debug__ and _debug):
+                debugMsg("j %d bFname %s file exists", j, get_note_file_name(3, j))
             octave4[j] = 1
         else:
             octave4[j] = 0
 
-        if(os.path.isfile(get_note_file_name(4, j))):
-            debugMsg("j " + str(j) + " bFname " + get_note_file_name(4, j) + " file exists")
+        if(note_has_sample(4, j)):
+            if(__debug__ and _debug):
+                debugMsg("j %d bFname %s file exists", j, get_note_file_name(4, j))
             octave5[j] = 1
         else:
             octave5[j] = 0
 
-        if(os.path.isfile(get_note_file_name(5, j))):
-            debugMsg("j " + str(j) + " bFname " + get_note_file_name(5, j) + " file exists")
+        if(note_has_sample(5, j)):
+            if(__debug__ and _debug):
+                debugMsg("j %d bFname %s file exists", j, get_note_file_name(5, j))
             octave6[j] = 1
         else:
             octave6[j] = 0
 
-        if(os.path.isfile(get_note_file_name(6, j))):
-            debugMsg("j " + str(j) + " bFname " + get_note_file_name(6, j) + " file exists")
+        if(note_has_sample(6, j)):
+            if(__debug__ and _debug):
+                debugMsg("j %d bFname %s file exists", j, get_note_file_name(6, j))
             octave7[j] = 1
         else:
             octave7[j] = 0
 
-        if(os.path.isfile(get_note_file_name(7, j))):
-            debugMsg("j " + str(j) + " bFname " + get_note_file_name(7, j) + " file exists")
+        if(note_has_sample(7, j)):
+            if(__debug__ and _debug):
+                debugMsg("j %d bFname %s file exists", j, get_note_file_name(7, j))
             octave8[j] = 1
         else:
             octave8[j] = 0
 
-    debugMsg("Octave1 " + str(octave1) + "\n" +
-          "Octave2 " + str(octave2) + "\n" +
-          "Octave3 " + str(octave3) + "\n" +
-          "Octave4 " + str(octave4) + "\n" +
-          "Octave5 " + str(octave5) + "\n" +
-          "Octave6 " + str(octave6) + "\n" +
-          "Octave7 " + str(octave7) + "\n" +
-          "Octave8 " + str(octave8) )
+    debugMsg("Octave1 %s\nOctave2 %s\nOctave3 %s\nOctave4 %s\n"
+             "Octave5 %s\nOctave6 %s\nOctave7 %s\nOctave8 %s",
+             octave1, octave2, octave3, octave4, octave5, octave6, octave7, octave8)
 
     # Load the desired default volume for the bank samples and calculate
     # the corresponding volume for note playing
@@ -642,9 +791,8 @@ def load_bank_IDs(bank):
     globaltranspose = int(dictionary['transpose'])
     globalvelocity = int(dictionary['velocity'])
 
-    debugMsg(" Set globalvolume to " + str(globalvolume) +
-             " transpose " + str(globaltranspose) +
-             " velocity " + str(globalvelocity))
+    debugMsg(" Set globalvolume to %s transpose %s velocity %s",
+             globalvolume, globaltranspose, globalvelocity)
 
 def refresh_bank_buttons():
     '''
@@ -724,10 +872,8 @@ def refresh_bank_buttons_while_recording(btn):
     Refresh the buttons of the interface according to the current
     bank.
 
-    ***
-    NOT USED IN THIS VERSION. WORK PROPERLY IF record_sample RUNS IN S
-    SEPARATE THREAD.
-    ***
+    Called when the recording starts, the samples are recorded in
+    background by the sample recorder.
 
     :param btn: The current note button
     '''
@@ -816,49 +962,155 @@ def play_sample(btn, status):
         button[btn].config(image=b_images[5])
         MidiCallback([145, btn, 0], 0)
 
-def get_note_file_name(octave, note):
+def get_note_file_name(octave, note, layer=None, alternate=0):
     '''
     Calculate the full path note file name based on the note id and the current
     selected bank
 
     :param octave: The selected octave of the bank
     :param note: The note id
+    :param layer: The velocity layer, base zero. If None, the loudest layer
+    :param alternate: The round robin alternate, base zero
     :return: The full path note sample file
     '''
-    global note_names
     global current_bank
+    global bank_layers
+
+    if layer is None:
+        layer = len(bank_layers) - 1
+    return get_bank_file_name(current_bank, bank_layers, octave, note, layer, alternate)
+
+def get_bank_file_name(bank, layers, octave, note, layer, alternate):
+    '''
+    Calculate the full path note file name of any bank
+
+    :param bank: The bank number
+    :param layers: The BankLayers of the bank
+    :param octave: The octave of the bank
+    :param note: The note id
+    :param layer: The velocity layer, base zero
+    :param alternate: The round robin alternate, base zero
+    :return: The full path note sample file
+    '''
+    global note_names
+
+    return layers.file_name(get_bank_folder(bank), note_names[note], octave, layer, alternate)
+
+def get_bank_folder(bank):
+    '''
+    :param bank: The bank number
+    :return: The full path of the bank samples folder
+    '''
+    return samples_path + "B" + str(bank) + "/"
+
+def get_bank_files(bank, layers, velocity, midinotes):
+    '''
+    Collect the sample files of the notes of a bank
+
+    :param bank: The bank number
+    :param layers: The BankLayers of the bank
+    :param velocity: The velocity of the bank, used if it has no velocity layers
+    :param midinotes: The MIDI notes to check for a sample file
+    :return: Dictionary of the files to load, as passed to BankLoader.load()
+    '''
+    global note_names
+
+    # Every velocity layer of the note can have a sample file
+    # and a number of round robin alternates
+    files = layers.sample_files(get_bank_folder(bank), note_names, velocity, midinotes)
+    if(__debug__ and _debug):
+        for key, (file, midinote, layer_velocity) in sorted(files.items()):
+            debugMsg("midinote %d velocity %d file %s", midinote, layer_velocity, file)
+    return files
+
+def load_packed_bank(bank, files):
+    '''
+    Load a bank from its packed file (see pack_bank.py), if the packed
+    file is newer than the bank definition and sample files
+
+    :param bank: The bank number
+    :param files: Dictionary of the sample files of the bank
+    :return: Dictionary of the Sound objects with the same keys of files,
+    or None if the bank should be loaded from the sample files
+    '''
+    packed_name = BankPack.file_name(get_bank_folder(bank))
+    sounds = BankPack.load(packed_name, files, "bank" + str(bank) + ".json")
+    if sounds is not None:
+        debugMsg("Bank %d mapped from %s", bank, packed_name)
+    return sounds
+
+def describe_bank(bank):
+    '''
+    Read the definition of a bank and collect its sample files,
+    without changing the current bank. Used to prefetch the banks.
+
+    :param bank: The bank number
+    :return: The tuple (files, BankLayers), or None if the bank does not exist
+    '''
+    try:
+        with open("bank" + str(bank) + ".json") as file:
+            dictionary = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    layers = BankLayers(dictionary)
+    # Only 96 notes are used (12 notes x 8 octaves)
+    files = get_bank_files(bank, layers, int(dictionary['velocity']), range(96))
+    return files, layers
 
-    note_file_name = note_names[note] + str(octave + 1) + ".wav"
-    return samples_path + "B" + str(current_bank) + "/" + note_file_name
+def note_has_sample(octave, note):
+    '''
+    Check if a note of the current bank has a sample file in any
+    velocity layer
+
+    :param octave: The selected octave of the bank
+    :param note: The note id
+    :return: True if at least one sample file exists
+    '''
+    global bank_layers
+
+    for layer in range(len(bank_layers)):
+        if(os.path.isfile(get_note_file_name(octave, note, layer))):
+            return True
+    return False
 
 # --------------------------------------------------------------
 #                    Audio and MIDI Callback
 # --------------------------------------------------------------
 
-def AudioCallback(outdata, frame_count, time_info, status):
+def AudioCallback(indata, outdata, frame_count, time_info, status):
     '''
     Callback associated to the audio hardware. It is executed when
     a MIDI message sends the playnote features.
     The audio callback is based on the samplerbox_audio library and
     can mix up to max_polyphony different audio buffers played together.
+    The same callback delivers the input frames to the sample recorder.
 
+    :param indata: The input frames, None if the device has no input
     :param outdata:
     :param frame_count:
     :param time_info:
     :param status:
     '''
-    global globavolume
+    global globalvolume
 
-    rmlist = []
-    ps.playingsounds = ps.playingsounds[-max_polyphony:]
-    b = samplerbox_audio.mixaudiobuffers(ps.playingsounds, rmlist, frame_count, FADEOUT, FADEOUTLENGTH, SPEED)
-    for e in rmlist:
-        try:
-            ps.playingsounds.remove(e)
-        except:
-            pass
-    b *= globalvolume
-    outdata[:] = b.reshape(outdata.shape)
+    # The device reports in status the blocks it could not play in time
+    # (underflow) or that have been delayed by the audio processing
+    if status:
+        ps.playingsounds.xruns += 1
+        if status.output_underflow:
+            ps.playingsounds.underflows += 1
+    ps.playingsounds.latency = time_info.outputBufferDacTime - time_info.currentTime
+
+    # The input frames are copied in the recorder ring buffer only
+    # while a take is being recorded
+    if indata is not None:
+        sample_recorder.feed(indata)
+
+    # The engine mixes the voices in its preallocated buffer and writes
+    # the result in outdata, applying the volume. Voices beyond the max
+    # polyphony are already replaced by the table when they start.
+    samplerbox_audio.mixaudiobuffers(ps.playingsounds, frame_count, outdata, globalvolume)
 
 def MidiCallback(message, time_stamp):
     '''
@@ -869,7 +1121,10 @@ def MidiCallback(message, time_stamp):
     '''
     global playingnotes, sustain, sustainplayingnotes
     global preset, globaltranspose, globalvolume
-    global samples
+    global keymap
+
+    # Arrival time of the message, the start of the note-on latency
+    arrival = monotonic_ns()
 
     # Decode the MIDI message in its components
     messagetype = message[0] >> 4
@@ -880,9 +1135,9 @@ def MidiCallback(message, time_stamp):
     # Check if this MIDI message includes a specification of the velocity
     velocity = message[2] if len(message) > 2 else None
 
-    debugMsg("MidiCallback message " + str(message) + " messagetype " + str(messagetype) +
-             " messagechannel " + str(messagechannel) + " midinote " + str(midinote) +
-             " velocity " + str(velocity))
+    if(__debug__ and _debug):
+        debugMsg("MidiCallback message %s messagetype %s messagechannel %s midinote %s velocity %s",
+                 message, messagetype, messagechannel, midinote, velocity)
 
     # Assumes the message type (9) note on with velocity 0 is
     # a message type (8) note off
@@ -892,19 +1147,27 @@ def MidiCallback(message, time_stamp):
     # If is a message type (9) note on apply eventual octave transposition and play
     # the note
     if messagetype == 9:
-        debugMsg("messagetype is 9 (note on) globaltranspose " + str(globaltranspose))
         midinote += globaltranspose
-        try:
-            debugMsg("playing notes" + str(samples[midinote, velocity]))
-            playingnotes.setdefault(midinote, []).append(samples[midinote, velocity].play(midinote))
-        except:
-            debugMsg("Exception, pass")
-            pass
+        sound = keymap.lookup(midinote, velocity)
+        if sound is None:
+            if event_trace is not None:
+                event_trace.record(EventTrace.NOTE_MISSING, midinote, velocity)
+            if(__debug__ and _debug):
+                debugMsg("No sample for note %d", midinote)
+        else:
+            playingnotes.setdefault(midinote, []).append(sound.play(midinote, arrival))
+            if event_trace is not None:
+                event_trace.record(EventTrace.NOTE_ON, midinote, velocity)
+            if(__debug__ and _debug):
+                debugMsg("note on %d globaltranspose %d playing %s", midinote, globaltranspose, sound.fname)
 
     # Process the message type (8) note off applyin the sustain if it is active
     elif messagetype == 8:  # Note off
-        debugMsg("messagetype is 8 (note off) globaltranspose " + str(globaltranspose))
         midinote += globaltranspose
+        if event_trace is not None:
+            event_trace.record(EventTrace.NOTE_OFF, midinote, velocity)
+        if(__debug__ and _debug):
+            debugMsg("note off %d globaltranspose %d", midinote, globaltranspose)
         if midinote in playingnotes:
             for n in playingnotes[midinote]:
                 if sustain:
@@ -917,13 +1180,17 @@ def MidiCallback(message, time_stamp):
     # Process the message type (12) program change and load the
     # new group of samples.
     elif messagetype == 12:  # Program change
-        debugMsg('Program change ' + str(note))
+        if event_trace is not None:
+            event_trace.record(EventTrace.PROGRAM_CHANGE, note)
+        debugMsg('Program change %d', note)
         preset = note
         LoadSamples()
 
     # Process the message type (11) for pedal off (associated to the sustain)
     # With note 64 and velocity < 64 (typical 0)
     elif (messagetype == 11) and (note == 64) and (velocity < 64):  # sustain pedal off
+        if event_trace is not None:
+            event_trace.record(EventTrace.SUSTAIN, note, velocity)
         for n in sustainplayingnotes:
             n.fadeout(50)
         sustainplayingnotes = []
@@ -932,28 +1199,56 @@ def MidiCallback(message, time_stamp):
     # Process the message type (11) for pedal on (associated to the sustain)
     # With note 64 and velocity > 64 (typical 127)
     elif (messagetype == 11) and (note == 64) and (velocity >= 64):  # sustain pedal on
+        if event_trace is not None:
+            event_trace.record(EventTrace.SUSTAIN, note, velocity)
         sustain = True
 
 def open_sound_device():
     '''
     Open the sound device according to the application configuration
-    The function manages the exception.
+    The function manages the exception: if the device cannot be opened
+    with the audio profile, it is opened with the default block size,
+    latency and format. If it cannot be opened at all, the panel runs
+    without sound.
+
+    :return: True if the sound device has been opened
     '''
     # The sound device instant.
     global sd
-    try:
-        sd = sounddevice.OutputStream(device=audio_device_id,
-                                      blocksize=512,
-                                      samplerate=44100,
-                                      channels=2,
-                                      dtype='int16',
-                                      callback=AudioCallback)
-        # Start the sound device
-        sd.start()
-        debugMsg('Opened audio device #%i' % audio_device_id)
-    except:
-        debugMsg('Invalid audio device #%i' % audio_device_id)
-        exit(1)
+    global audio_profile, audio_blocksize
+
+    fallback = AudioProfile(rate=audio_profile.rate)
+    for profile, duplex in ((audio_profile, True), (audio_profile, False), (fallback, False)):
+        try:
+            if(duplex):
+                # A single full duplex stream plays the notes and records the
+                # samples, so a take does not open the device and the notes
+                # can be played while recording. The input is always int16,
+                # the format of the recorded samples
+                sd = sounddevice.Stream(channels=(input_channels, 2),
+                                        dtype=('int16', profile.dtype),
+                                        callback=AudioCallback,
+                                        **profile.stream_args(audio_device_id))
+            else:
+                # Output only device, the samples cannot be recorded
+                sd = sounddevice.OutputStream(channels=2,
+                                              dtype=profile.dtype,
+                                              callback=partial(AudioCallback, None),
+                                              **profile.stream_args(audio_device_id))
+            # Start the sound device
+            sd.start()
+            audio_profile = profile
+            audio_blocksize = profile.blocksize
+            debugMsg('Opened audio device #%i, %s, block size %d, rate %d, %s, latency %.1f ms',
+                     audio_device_id, 'full duplex' if duplex else 'output only', profile.blocksize,
+                     profile.rate, profile.dtype, sd.latency[1] * 1000 if duplex else sd.latency * 1000)
+            return True
+        except Exception as e:
+            debugMsg('Cannot open audio device #%i %s: %s', audio_device_id,
+                     'full duplex' if duplex else 'output only', e)
+    sd = None
+    print('Invalid audio device #%i, the panel runs without sound' % audio_device_id)
+    return False
 
 # --------------------------------------------------------------
 #                    Manage Playing Samples
@@ -975,7 +1270,7 @@ def calc_global_volume(vol):
 def LoadSamples():
     global LoadingThread
     global LoadingInterrupt
-    global samples
+    global keymap
 
     if LoadingThread:
         LoadingInterrupt = True
@@ -997,7 +1292,7 @@ def ActuallyLoad():
     global globaltranspose
     global globalvelocity
     global samples_path
-    global samples
+    global keymap
     global playingnotes
     global sustainplayingnotes
     global sustain
@@ -1009,133 +1304,230 @@ def ActuallyLoad():
     global octave6
     global octave7
     global octave8
+    global bank_layers
+    global current_bank
+    global bank_cache
+    global bank_prefetcher
+    global bank_files
     global synth_Status
 
-    ps.playingsounds = []
-    samples = {}
-
     # Button color in loading status
     button[(preset * 16) + 15].config(image=b_images[7])
+    # Audio blocks played late before the load, to check that the
+    # load does not glitch the playing notes
+    xruns = ps.playingsounds.xruns
+    if event_trace is not None:
+        event_trace.record(EventTrace.LOAD_START, current_bank)
 
     # Only 96 notes are used (12 notes x 8 octaves)
-    # instead of 127.
-    for midinote in range(0, 127):
-        if LoadingInterrupt:
+    # instead of 127. The MIDI note of every flag is its position
+    # in the octaves sequence.
+    flags = numpy.array([octave1, octave2, octave3, octave4,
+                         octave5, octave6, octave7, octave8], dtype=bool).ravel()
+    files = get_bank_files(current_bank, bank_layers, globalvelocity, numpy.flatnonzero(flags))
+
+    # A bank recently used is reused from the cache if its files
+    # are not changed since it has been loaded
+    signature = BankCache.signature(files)
+    new_keymap = bank_cache.get(current_bank, signature)
+    if new_keymap is None:
+        # A packed bank is mapped in memory at once, else all the files
+        # of the bank are decoded in parallel. The load is stopped
+        # as soon as possible if a new bank is selected meanwhile.
+        sounds = load_packed_bank(current_bank, files)
+        if sounds is None:
+            sounds = bank_loader.load(files, lambda: LoadingInterrupt)
+        if sounds is None:
             return
-        # Calculate the octave based on the note sequency
-        octave = midinote // 12
-        note = midinote % 12
-
-        if( ((octave1[note] == 1) and (octave == 0) ) or
-            ((octave2[note] == 1) and (octave == 1)) or
-            ((octave3[note] == 1) and (octave == 2)) or
-            ((octave4[note] == 1) and (octave == 3)) or
-            ((octave5[note] == 1) and (octave == 4)) or
-            ((octave6[note] == 1) and (octave == 5)) or
-            ((octave7[note] == 1) and (octave == 6)) or
-            ((octave8[note] == 1) and (octave == 7)) ):
-
-            # Calculate the file name according to the note and octave
-            # file = os.path.join(dirname, "%d.wav" % midinote)
-            file = get_note_file_name(octave, note)
-            debugMsg("midinote " + str(midinote) + " globalvelocity " +
-                     str(globalvelocity) + " file " + file)
-            samples[midinote, globalvelocity] = Sound(file, midinote, globalvelocity)
-
-    initial_keys = set(samples.keys())
-    for midinote in range(128):
-        lastvelocity = None
-        for velocity in range(128):
-            if (midinote, velocity) not in initial_keys:
-                samples[midinote, velocity] = lastvelocity
-            else:
-                if not lastvelocity:
-                    for v in range(velocity):
-                        samples[midinote, v] = samples[midinote, velocity]
-                lastvelocity = samples[midinote, velocity]
-        if not lastvelocity:
-            for velocity in range(128):
-                try:
-                    samples[midinote, velocity] = samples[midinote-1, velocity]
-                except:
-                    pass
-    if len(initial_keys) > 0:
-        debugMsg('Preset loaded: ' + str(preset))
+
+        # The key map is built apart and replaces the current one
+        # only when it is complete, so the audio callback never plays
+        # a partially loaded bank
+        new_keymap = KeyMap(sounds, bank_layers)
+        bank_cache.put(current_bank, signature, new_keymap)
+    else:
+        debugMsg('Preset from cache: %d', preset)
+
+    ps.playingsounds.clear()
+    keymap = new_keymap
+    bank_files = files
+
+    if event_trace is not None:
+        event_trace.record(EventTrace.LOAD_END, current_bank, len(keymap))
+    if len(keymap) > 0:
+        debugMsg('Preset loaded: %d', preset)
     else:
-        debugMsg('Preset empty: ' + str(preset))
+        debugMsg('Preset empty: %d', preset)
+    debugMsg('Audio xruns while loading: %d', ps.playingsounds.xruns - xruns)
 
     # Button color in normal status
     button[(preset * 16) + 15].config(image=b_images[1])
     synth_Status = PiSynthStatus.STANDBY
 
+    # The banks are usually selected in sequence: prefetch the
+    # next bank first, then the previous one
+    bank_prefetcher.schedule([bank for bank in (current_bank + 1, current_bank - 1)
+                              if 0 <= bank < max_banks])
+
+def make_stats_overlay():
+    '''
+    Create the line showing the audio engine statistics at the bottom
+    of the panel
+    '''
+    global stats_label
+
+    stats_label = tk.Label(window, text='', fg='white', bg='black', font=('Courier', 9))
+    stats_label.place(relx=0, rely=1, anchor='sw')
+
+def report_stats(summary):
+    '''
+    Report the audio engine statistics of the last period. Called by
+    the statistics thread.
+
+    :param summary: The statistics of the period
+    '''
+    global stats_overlay
+
+    text = EngineStats.format(summary)
+    debugMsg(text)
+    if(stats_overlay):
+        # The label is updated by the Tk main loop
+        window.after(0, lambda: stats_label.config(text=text))
+
+def dump_trace(signum, frame):
+    '''
+    Dump the event trace to the trace file. Called on the SIGUSR1 signal,
+    e.g. kill -USR1 <pid>
+
+    :param signum: The signal number
+    :param frame: The interrupted stack frame
+    '''
+    global trace_file
+
+    event_trace.dump(trace_file)
+    debugMsg("Event trace dumped to %s", trace_file)
+    if(__debug__ and _debug):
+        debugMsg(EventTrace.format(event_trace.records()))
+
+def sampler_idle():
+    '''
+    Check if the sampler is idle, with no notes playing and no bank loading
+    or sample recording. The banks are prefetched only when the sampler is idle.
+
+    :return: True if the sampler is idle
+    '''
+    global synth_Status
+
+    return ((len(ps.playingsounds) == 0) and
+            (synth_Status is not PiSynthStatus.LOADING) and
+            (synth_Status is not PiSynthStatus.RECORDING))
+
 # --------------------------------------------------------------
 #                           Recording
 # --------------------------------------------------------------
 
 def record_sample(btn):
-    global sampling_rate
-    global recording_chunk_size
-    global input_channels
+    '''
+    Start recording a sample on a note button. The take is recorded in
+    background by the sample recorder, while the interface keeps running.
+
+    :param btn: The note button
+    '''
     global synth_Status
     global sample_lenght
-    global audio_device_id
-    global current_bank
-    global button
-    global b_image
 
     debugMsg("Recording sample")
 
     # Initial status when starting
     synth_Status = PiSynthStatus.RECORDING
 
-    # Audio format 16-bit resolution
-    form_1 = pyaudio.paInt16
-
     # Calculate the name of the file according to the note button
     note = calc_note(btn)
     octave = calc_octave(btn)
     wav_output_filename = get_note_file_name(octave, note)
-    # Instance of the PyAudio library
-    audio = pyaudio.PyAudio()
 
-    # Create the pyaudio stream
-    stream = audio.open(format=form_1, rate=sampling_rate, channels=input_channels,
-                        input_device_index=audio_device_id, input=True,
-                        frames_per_buffer=recording_chunk_size)
+    # The recorder callbacks run on the recorder thread, the
+    # interface is updated by the Tk main loop
+    sample_recorder.record(wav_output_filename, sample_lenght,
+                           progress=lambda fraction: window.after(0, show_record_progress, btn, fraction),
+                           done=lambda file: window.after(0, record_done, btn, octave, note, file))
 
-    frames = []
+def show_record_progress(btn, fraction):
+    '''
+    Show the progress of the recording, blinking the note button
 
-    # loop through stream and append audio chunks to frame array
-    for ii in range(0, int((sampling_rate / recording_chunk_size) * sample_lenght)):
-        data = stream.read(recording_chunk_size)
-        frames.append(data)
+    :param btn: The note button
+    :param fraction: The fraction of the take recorded
+    '''
+    if(int(fraction * 10) % 2):
+        button[btn].config(image=b_images[7])
+    else:
+        button[btn].config(image=b_images[2])
 
-    debugMsg("Recording finished")
+def record_done(btn, octave, note, file):
+    '''
+    Complete the recording of a sample
 
-    # stop the stream, close it, and terminate the pyaudio instantiation
-    stream.stop_stream()
-    stream.close()
-    audio.terminate()
+    :param btn: The note button
+    :param octave: The octave of the recorded note
+    :param note: The recorded note id
+    :param file: The saved sample file, None if the take has not been saved
+    '''
+    global synth_Status
 
-    # save the audio frames as .wav file
-    wavefile = wave.open(wav_output_filename, 'wb')
-    wavefile.setnchannels(input_channels)
-    wavefile.setsampwidth(audio.get_sample_size(form_1))
-    wavefile.setframerate(sampling_rate)
-    wavefile.writeframes(b''.join(frames))
-    wavefile.close()
+    debugMsg("Recording finished")
 
-    # Reload the samples bank
-    button[btn].config(image=b_images[2])
-    load_bank_IDs(current_bank)
-    refresh_bank_buttons()
-    preset = current_bank
-    LoadSamples()
+    if(file is not None):
+        # Add the new sample to the current bank
+        refresh_recorded_sample(octave, note)
+        debugMsg("Sample saved")
+    else:
+        refresh_bank_buttons()
 
-    # Reset the status to SAMPLEMODE, ready to record a new sample
+    # Reset the status to STANDBY, ready to play the new sample
     synth_Status = PiSynthStatus.STANDBY
 
-    debugMsg("Sample saved")
+def refresh_recorded_sample(octave, note):
+    '''
+    Add a sample just recorded to the current bank. Only the new sample
+    is decoded and the key map and the note button are updated in place,
+    instead of reloading the whole bank.
+
+    :param octave: The octave of the recorded note
+    :param note: The recorded note id
+    '''
+    global keymap
+    global bank_files
+    global bank_layers
+    global globalvelocity
+    global current_bank
+    global octave1
+    global octave2
+    global octave3
+    global octave4
+    global octave5
+    global octave6
+    global octave7
+    global octave8
+
+    # The sample is recorded on the loudest layer, first alternate
+    midinote = octave * 12 + note
+    layer = len(bank_layers) - 1
+    velocity = globalvelocity if not bank_layers.layered else bank_layers.bounds[layer]
+    file = get_note_file_name(octave, note)
+
+    keymap = keymap.with_sound((midinote, layer, 0), Sound(file, midinote, velocity))
+
+    # The cached bank is updated with the new sample
+    bank_files[midinote, layer, 0] = (file, midinote, velocity)
+    bank_cache.put(current_bank, BankCache.signature(bank_files), keymap)
+
+    # Update the note flag and button
+    octaves = [octave1, octave2, octave3, octave4, octave5, octave6, octave7, octave8]
+    octaves[octave][note] = 1
+    button[get_button_id(octave, note)].config(image=b_images[5])
+
+    debugMsg("midinote %d velocity %d file %s", midinote, velocity, file)
 
 # --------------------------------------------------------------
 #                           Application
@@ -1154,11 +1546,19 @@ if __name__ == "__main__":
     # Show the first default bank settings
     refresh_bank_buttons()
 
+    sample_recorder.start()
     open_sound_device()
+    if(sample_storage is SampleStorage.stream):
+        stream_reader.start()
+    bank_prefetcher.start()
+    if(engine_stats is not None):
+        if(stats_overlay):
+            make_stats_overlay()
+        engine_stats.start()
     preset = 0
     LoadSamples()
 
-    debugMsg('midi ports ' + str(midi_in[0].ports))
+    debugMsg('midi ports %s', midi_in[0].ports)
     midi_in.append(rtmidi.MidiIn(midi_device.encode()))
     midi_in[0].callback = MidiCallback
     # midi_in[0].open_port(b'Keystation Mini 32 20:0')
@@ -0,0 +1,59 @@
+'''
+@file render_bank.py
+@brief Renders offline the notes of a bank to a wav file
+
+Plays a MIDI file, or a list of timed MIDI messages, with a bank and the
+audio engine of the control panel, as fast as possible and without the
+sound card, and writes the result in a wav file. The same notes always
+give the same file, so the renders can be compared to test the changes of
+the audio engine.
+
+Run from the folder of gui.json:
+
+    python3 render_bank.py 2 song.mid song.wav
+    python3 render_bank.py 2 notes.json notes.wav --interpolation hermite
+
+The json list of messages has an item for every message with the time in
+seconds and the message bytes, e.g. [[0.0, [144, 60, 100]], [1.0, [128, 60, 0]]]
+'''
+
+import argparse
+import json
+
+from classes.loader import BankLoader
+from classes.render import OfflineBank, OfflineRenderer, INTERPOLATIONS, read_midi_file
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Render offline the notes of a bank to a wav file')
+    parser.add_argument('bank', type=int, help='the bank number')
+    parser.add_argument('events', help='the MIDI file (.mid) or json list of timed messages')
+    parser.add_argument('output', help='the wav file to write')
+    parser.add_argument('--interpolation', choices=sorted(INTERPOLATIONS),
+                        help='the interpolation (default as in gui.json)')
+    parser.add_argument('--blocksize', type=int, default=512,
+                        help='the max frames mixed at once (default 512)')
+    parser.add_argument('--tail', type=float, default=10.0,
+                        help='max seconds rendered after the last message (default 10)')
+    args = parser.parse_args()
+
+    with open("gui.json") as file:
+        settings = json.load(file)
+
+    if args.events.lower().endswith(('.mid', '.midi')):
+        events = read_midi_file(args.events)
+    else:
+        with open(args.events) as file:
+            events = [(float(seconds), list(message)) for seconds, message in json.load(file)]
+
+    bank = OfflineBank(args.bank, settings, BankLoader())
+    quality = INTERPOLATIONS[args.interpolation] if args.interpolation else None
+    voices = OfflineBank.voices(settings, blocksize=args.blocksize, quality=quality)
+    renderer = OfflineRenderer(bank.keymap, voices, bank.volume, bank.transpose,
+                               rate=bank.rate, blocksize=args.blocksize)
+
+    frames = renderer.render(events, args.tail)
+    OfflineRenderer.write(args.output, frames, bank.rate)
+
+    print("Rendered " + str(len(events)) + " messages, " +
+          "%.2f s of audio in %.2f s, real-time factor %.1f" %
+          (len(frames) / renderer.rate, renderer.render_time, renderer.realtime_factor(frames)))
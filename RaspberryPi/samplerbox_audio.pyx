@@ -18,74 +18,1000 @@
 import cython
 import numpy
 cimport numpy
+from libc.string cimport memset, memcpy
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+from cpython.pythread cimport PyThread_type_lock, PyThread_allocate_lock, PyThread_free_lock, \
+    PyThread_acquire_lock, PyThread_release_lock, WAIT_LOCK
 
-def mixaudiobuffers(list playingsounds, list rmlist, int frame_count, numpy.ndarray FADEOUT, int FADEOUTLENGTH, numpy.ndarray SPEED):
-    cdef int i, ii, k, l, N, length, looppos, fadeoutpos
-    cdef float speed, newsz, pos, j
-    cdef numpy.ndarray b = numpy.zeros(2 * frame_count, numpy.float32)      # output buffer
-    cdef float* bb = <float *> (b.data)                                     # and its pointer
-    cdef numpy.ndarray z
+# Number of buckets of the block time histogram. The bucket n counts the
+# blocks mixed in 2^(n-1) to 2^n microseconds, the bucket 0 under 1 us
+cdef enum:
+    TIME_BUCKETS = 24
+
+# Number of the last note-on latencies kept by the voice table
+cdef enum:
+    LATENCY_PROBES = 4096
+
+# Copy of the parameters of a voice, taken by the mixer
+ctypedef struct voice_t:
+    int slot
+    long long id
+    double pos
+    int fadeoutpos
+    char isfadeout
+    int loop
+    int length
+    int numchan
+    float speed
+    short* data
+    int ring                                                                # streaming ring, -1 if resident
+    int attack                                                              # frames resident in data
+    short* loopdata                                                         # resident frames from loopstart
+    int loopstart
+    int loopframes
+    char finished
+
+# Rings of the voices streamed from disk. The ring of a voice is divided in
+# blocks; every block holds a block of frames of the sample, read by the
+# stream reader thread, and its tag is the number of that block in the sample.
+ctypedef struct streams_t:
+    short* rings                                                            # nrings * ring_frames * 2 samples
+    long long* tags                                                         # nrings * nblocks block tags, -1 if empty
+    int nrings
+    int ring_frames
+    int block_frames
+    int nblocks
+    short* scratch                                                          # frames of a span copied from the ring
+    int scratch_frames
+    long underruns                                                          # frames not yet read when played
+    PyThread_type_lock lock
+
+cdef class VoiceTable:
+    '''
+    Table of the playing voices, owned by the audio engine.
+
+    Every voice parameter is stored in a fixed C array indexed by the voice
+    slot (struct of arrays), so the mixer reads the voices without any
+    Python attribute lookup. The slots of the playing voices are listed in
+    the first count items of the active array; a voice is removed moving
+    the last active slot in its place, so adding and removing are O(1).
+    When the table is full, a new voice replaces the oldest one.
+
+    A voice is identified by a number that encodes its slot and the order
+    of the note-on, so a handle to a voice that has been replaced is
+    recognized and ignored.
+
+    The mixer copies the active voices in a snapshot and mixes it without
+    the GIL, then writes back the positions. The lock protects the table
+    while the mixer reads and updates it without the GIL.
+
+    The audio callback never releases a reference: the sounds replaced in
+    their slot are retired, with the number of the mixes started until
+    then, and released by the thread adding the voices once those mixes
+    are done.
+    '''
+    cdef public int capacity
+    cdef public int count
+    # Number of audio blocks reported late by the audio device
+    cdef public long xruns
+    # Number of audio blocks the device could not play in time (underflows)
+    cdef public long underflows
+    # Latency between the audio callback and the output of its block (s)
+    cdef public double latency
+    # Number of voices replaced by a new voice with the table full
+    cdef public long stolen
+    # Number of voices ended at the end of the sample or of the fadeout
+    cdef public long finished
+    # Max number of voices playing together
+    cdef public int peak
+    # Mixed blocks, histogram and max of the mix time of a block. Only the
+    # audio callback writes them, so they are updated without the lock
+    cdef long long blocks
+    cdef long long histogram[TIME_BUCKETS]
+    cdef long long maxtime
+    # Note-on latencies, from the arrival of the note to the output of its
+    # first frame (ns), in a ring written by the audio callback
+    cdef long long latencies[LATENCY_PROBES]
+    # Number of note-on latencies measured
+    cdef public long long probes
+    # Interpolation quality, one of the INTERPOLATION_ constants
+    cdef public int quality
+    cdef long long seq
+    cdef PyThread_type_lock lock
+    # Voices parameters, indexed by slot
+    cdef long long* ids                                                     # voice id, -1 if the slot is free
+    cdef double* pos                                                        # playing position (frames)
+    cdef int* fadeoutpos                                                    # fadeout position (frames)
+    cdef char* isfadeout
+    cdef int* loop                                                          # loop start, -1 for one-shot
+    cdef int* length                                                        # length of the sample (frames)
+    cdef int* numchan                                                       # 1 mono, 2 interleaved stereo
+    cdef float* speed                                                       # playing speed
+    cdef short** data                                                       # samples data pointer
+    cdef int* ring                                                          # streaming ring, -1 if resident
+    cdef int* attack                                                        # frames resident in data
+    cdef short** loopdata                                                   # resident frames from loopstart
+    cdef int* loopstart
+    cdef int* loopframes
+    cdef long long* arrival                                                 # note-on time (ns), 0 if mixed
+    cdef list refs                                                          # keeps alive the sounds data
+    # Active slots and position of every slot in the active list
+    cdef int* active
+    cdef int* where
+    # Free slots stack
+    cdef int* free
+    cdef int nfree
+    # Streaming rings and free rings stack
+    cdef streams_t streams
+    cdef int* freerings
+    cdef int nfreerings
+    # Voice ids, positions and speeds of the streamed voices, copied for
+    # the stream reader
+    cdef long long* streamids
+    cdef double* streampos
+    cdef float* streamspeed
+    # Snapshot of the active voices mixed by the audio callback
+    cdef voice_t* snapshot
+    # Mixes started and completed, and the (mixes started, sound) tuples of
+    # the sounds replaced while they could still be mixed
+    cdef long long mixes_started
+    cdef long long mixes_done
+    cdef list retired
+    # Global engine parameters
+    cdef numpy.ndarray SPEED
+    cdef numpy.ndarray FADEOUT
+    cdef int FADEOUTLENGTH
+    cdef numpy.ndarray mixbuf                                               # reused float mix buffer
+    cdef numpy.ndarray unity                                                # gain of the voices not fading
+
+    def __cinit__(self, int capacity, *args, **kwargs):
+        self.lock = PyThread_allocate_lock()
+        self.ring = <int *> PyMem_Malloc(capacity * sizeof(int))
+        self.attack = <int *> PyMem_Malloc(capacity * sizeof(int))
+        self.loopdata = <short **> PyMem_Malloc(capacity * sizeof(short *))
+        self.loopstart = <int *> PyMem_Malloc(capacity * sizeof(int))
+        self.loopframes = <int *> PyMem_Malloc(capacity * sizeof(int))
+        self.arrival = <long long *> PyMem_Malloc(capacity * sizeof(long long))
+        self.ids = <long long *> PyMem_Malloc(capacity * sizeof(long long))
+        self.pos = <double *> PyMem_Malloc(capacity * sizeof(double))
+        self.fadeoutpos = <int *> PyMem_Malloc(capacity * sizeof(int))
+        self.isfadeout = <char *> PyMem_Malloc(capacity * sizeof(char))
+        self.loop = <int *> PyMem_Malloc(capacity * sizeof(int))
+        self.length = <int *> PyMem_Malloc(capacity * sizeof(int))
+        self.numchan = <int *> PyMem_Malloc(capacity * sizeof(int))
+        self.speed = <float *> PyMem_Malloc(capacity * sizeof(float))
+        self.data = <short **> PyMem_Malloc(capacity * sizeof(short *))
+        self.active = <int *> PyMem_Malloc(capacity * sizeof(int))
+        self.where = <int *> PyMem_Malloc(capacity * sizeof(int))
+        self.free = <int *> PyMem_Malloc(capacity * sizeof(int))
+        self.snapshot = <voice_t *> PyMem_Malloc(capacity * sizeof(voice_t))
+        if (not self.lock or not self.ids or not self.pos or not self.fadeoutpos or not self.isfadeout or
+                not self.loop or not self.length or not self.numchan or not self.speed or not self.data or
+                not self.active or not self.where or not self.free or not self.snapshot or
+                not self.ring or not self.attack or not self.arrival or not self.loopdata or
+                not self.loopstart or not self.loopframes):
+            raise MemoryError()
+
+    def __dealloc__(self):
+        if self.lock:
+            PyThread_free_lock(self.lock)
+        PyMem_Free(self.ids)
+        PyMem_Free(self.pos)
+        PyMem_Free(self.fadeoutpos)
+        PyMem_Free(self.isfadeout)
+        PyMem_Free(self.loop)
+        PyMem_Free(self.length)
+        PyMem_Free(self.numchan)
+        PyMem_Free(self.speed)
+        PyMem_Free(self.data)
+        PyMem_Free(self.active)
+        PyMem_Free(self.where)
+        PyMem_Free(self.free)
+        PyMem_Free(self.snapshot)
+        PyMem_Free(self.streams.rings)
+        PyMem_Free(self.streams.tags)
+        PyMem_Free(self.streams.scratch)
+        PyMem_Free(self.freerings)
+        PyMem_Free(self.streamids)
+        PyMem_Free(self.streampos)
+        PyMem_Free(self.streamspeed)
+        PyMem_Free(self.ring)
+        PyMem_Free(self.attack)
+        PyMem_Free(self.loopdata)
+        PyMem_Free(self.loopstart)
+        PyMem_Free(self.loopframes)
+        PyMem_Free(self.arrival)
+
+    def __init__(self, int capacity, numpy.ndarray SPEED, numpy.ndarray FADEOUT, int FADEOUTLENGTH, int blocksize=512,
+                 int quality=QUALITY_LINEAR, int streams=0, int ring_frames=65536):
+        '''
+        :param capacity: Max number of voices playing together (polyphony)
+        :param SPEED: Playing speed (float32) for every note distance from the sample note
+        :param FADEOUT: Fadeout envelope (float32)
+        :param FADEOUTLENGTH: Duration of the fadeout (frames)
+        :param blocksize: Expected number of frames of every audio block
+        :param quality: Interpolation quality, one of the INTERPOLATION_ constants
+        :param streams: Max number of voices streamed from disk playing together
+        :param ring_frames: Size of the ring of every streamed voice (frames)
+        '''
+        cdef int i
+        self.capacity = capacity
+        self.count = 0
+
+        self.streams.lock = self.lock
+        self.streams.nrings = streams
+        self.streams.block_frames = 4096
+        self.streams.nblocks = max(2, ring_frames // self.streams.block_frames)
+        self.streams.ring_frames = self.streams.nblocks * self.streams.block_frames
+        self.streams.scratch_frames = 16384
+        self.streams.underruns = 0
+        self.streams.rings = <short *> PyMem_Malloc(max(1, streams * self.streams.ring_frames * 2) * sizeof(short))
+        self.streams.tags = <long long *> PyMem_Malloc(max(1, streams * self.streams.nblocks) * sizeof(long long))
+        self.streams.scratch = <short *> PyMem_Malloc(self.streams.scratch_frames * 2 * sizeof(short))
+        self.freerings = <int *> PyMem_Malloc(max(1, streams) * sizeof(int))
+        self.streamids = <long long *> PyMem_Malloc(max(1, streams) * sizeof(long long))
+        self.streampos = <double *> PyMem_Malloc(max(1, streams) * sizeof(double))
+        self.streamspeed = <float *> PyMem_Malloc(max(1, streams) * sizeof(float))
+        if not self.streams.rings or not self.streams.tags or not self.streams.scratch or not self.freerings:
+            raise MemoryError()
+        if not self.streamids or not self.streampos or not self.streamspeed:
+            raise MemoryError()
+        self.xruns = 0
+        self.underflows = 0
+        self.latency = 0
+        self.stolen = 0
+        self.finished = 0
+        self.peak = 0
+        self.blocks = 0
+        self.maxtime = 0
+        self.probes = 0
+        for i in range(TIME_BUCKETS):
+            self.histogram[i] = 0
+        self.quality = quality
+        self.seq = 0
+        self.mixes_started = 0
+        self.mixes_done = 0
+        self.nfree = capacity
+        for i in range(capacity):
+            self.ids[i] = -1
+            self.data[i] = NULL
+            self.loopdata[i] = NULL
+            self.loopstart[i] = -1
+            self.loopframes[i] = 0
+            self.ring[i] = -1
+            self.arrival[i] = 0
+            # Lower slots are used first
+            self.free[i] = capacity - 1 - i
+        self.nfreerings = streams
+        for i in range(streams):
+            self.freerings[i] = i
+        self.refs = [None] * capacity
+        self.retired = []
+        self.SPEED = numpy.ascontiguousarray(SPEED, numpy.float32)
+        self.FADEOUT = numpy.ascontiguousarray(FADEOUT, numpy.float32)
+        self.FADEOUTLENGTH = FADEOUTLENGTH
+        self.mixbuf = numpy.zeros(2 * blocksize, numpy.float32)
+        self.unity = numpy.ones(blocksize, numpy.float32)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def block_frames(self):
+        '''
+        Number of frames of a streaming ring block
+        '''
+        return self.streams.block_frames
+
+    @property
+    def ring_blocks(self):
+        '''
+        Number of blocks of a streaming ring
+        '''
+        return self.streams.nblocks
+
+    @property
+    def underruns(self):
+        '''
+        Number of streamed frames played before they were read from disk
+        '''
+        return self.streams.underruns
+
+    def stats(self):
+        '''
+        Read the engine counters. The counters are not reset, the changes
+        between two reads are calculated by the caller.
+
+        :return: Dictionary of the counters, with the histogram of the block
+        mix time as a list: the item n is the number of blocks mixed in
+        2^(n-1) to 2^n microseconds
+        '''
+        return {
+            'blocks': self.blocks,
+            'histogram': [self.histogram[i] for i in range(TIME_BUCKETS)],
+            'maxtime_us': self.maxtime / 1000.0,
+            'voices': self.count,
+            'peak': self.peak,
+            'stolen': self.stolen,
+            'finished': self.finished,
+            'xruns': self.xruns,
+            'underflows': self.underflows,
+            'underruns': self.streams.underruns,
+            'latency': self.latency,
+            'probes': self.probes
+        }
+
+    def note_latencies(self, long long since=0):
+        '''
+        Read the last note-on latencies: the time from the arrival of a
+        note-on to the output of the first frame of its voice.
+
+        :param since: The number of probes of a previous read, to get only
+        the latencies measured after it
+        :return: The latencies (ns) as an int64 array, oldest first. Only
+        the last LATENCY_PROBES latencies are kept
+        '''
+        cdef long long end = self.probes
+        cdef long long start = max(since, end - LATENCY_PROBES, 0)
+        cdef long long i
+        return numpy.array([self.latencies[i % LATENCY_PROBES] for i in range(start, end)], numpy.int64)
+
+    cdef void record_time(self, long long ns) noexcept nogil:
+        # Called by the audio callback only
+        cdef long long us = ns // 1000
+        cdef int bucket = 0
+        while us > 0 and bucket < TIME_BUCKETS - 1:
+            us >>= 1
+            bucket += 1
+        self.histogram[bucket] += 1
+        self.blocks += 1
+        if ns > self.maxtime:
+            self.maxtime = ns
+
+    cdef void record_latency(self, long long ns) noexcept nogil:
+        # Called by the audio callback only
+        self.latencies[self.probes % LATENCY_PROBES] = ns
+        self.probes += 1
+
+    cdef void deactivate(self, int slot) noexcept nogil:
+        # Must be called with the lock acquired
+        cdef int w = self.where[slot]
+        cdef int last = self.active[self.count - 1]
+        self.active[w] = last
+        self.where[last] = w
+        self.count -= 1
+        self.ids[slot] = -1
+        self.free[self.nfree] = slot
+        self.nfree += 1
+        if self.ring[slot] >= 0:
+            self.freerings[self.nfreerings] = self.ring[slot]
+            self.nfreerings += 1
+            self.ring[slot] = -1
+
+    cdef int slot_of(self, long long voice) noexcept nogil:
+        # Must be called with the lock acquired
+        cdef int slot
+        if voice < 0:
+            return -1
+        slot = <int> (voice % self.capacity)
+        if self.ids[slot] != voice:
+            return -1
+        return slot
+
+    cpdef long long add(self, sound, int note, long long arrival=0) except? -2:
+        '''
+        Start playing a sound, replacing the oldest voice if the table is full.
+        The references to the samples data of a finished voice are released
+        only when its slot is reused, so the audio callback never frees memory.
+
+        A sound streamed from disk gets a streaming ring, filled by the stream
+        reader, and plays from memory its resident attack and loop start.
+        If no ring is free, only the resident attack of the sound is played.
+
+        :param sound: The Sound instance to play
+        :param note: The MIDI note played
+        :param arrival: The CLOCK_MONOTONIC time (ns) of the note-on, as
+        time.monotonic_ns(), to measure the latency of the voice; 0 to skip it
+        :return: The voice id
+        '''
+        cdef int i, slot, oldest, k
+        cdef long long voice, started, done
+        cdef numpy.ndarray z = sound.data
+        cdef int nspeeds = self.SPEED.shape[0]
+        cdef int loop = sound.loop
+        cdef int length = sound.nframes
+        cdef int numchan = sound.numchan
+        cdef bint streamed = sound.streamed
+        cdef int attack = z.shape[0] // numchan
+        cdef int ring = -1
+        cdef numpy.ndarray loopdata = sound.loopdata
+
+        if not z.flags['C_CONTIGUOUS'] or z.dtype != numpy.int16:
+            raise ValueError('sound data should be a contiguous int16 array')
+        if loopdata is not None and (not loopdata.flags['C_CONTIGUOUS'] or loopdata.dtype != numpy.int16):
+            raise ValueError('sound loop data should be a contiguous int16 array')
+
+        k = note - sound.midinote
+        if k < 0:
+            k = 0
+        elif k >= nspeeds:
+            k = nspeeds - 1
+
+        PyThread_acquire_lock(self.lock, WAIT_LOCK)
+        started = self.mixes_started
+        done = self.mixes_done
+        if self.nfree == 0:
+            oldest = self.active[0]
+            for i in range(1, self.count):
+                if self.ids[self.active[i]] < self.ids[oldest]:
+                    oldest = self.active[i]
+            self.deactivate(oldest)
+            self.stolen += 1
+
+        self.nfree -= 1
+        slot = self.free[self.nfree]
+        if streamed and attack < length:
+            if self.nfreerings > 0:
+                self.nfreerings -= 1
+                ring = self.freerings[self.nfreerings]
+                for i in range(self.streams.nblocks):
+                    self.streams.tags[ring * self.streams.nblocks + i] = -1
+            else:
+                # Plays only the attack, as a one-shot
+                length = attack
+                loop = -1
+        else:
+            attack = length
+        self.ring[slot] = ring
+        self.attack[slot] = attack
+        if ring >= 0 and loopdata is not None:
+            self.loopdata[slot] = <short *> (loopdata.data)
+            self.loopstart[slot] = sound.loopstart
+            self.loopframes[slot] = loopdata.shape[0] // numchan
+        else:
+            self.loopdata[slot] = NULL
+            self.loopstart[slot] = -1
+            self.loopframes[slot] = 0
+        self.data[slot] = <short *> (z.data)
+        self.pos[slot] = 0
+        self.fadeoutpos[slot] = 0
+        self.isfadeout[slot] = 0
+        self.loop[slot] = loop
+        self.length[slot] = length
+        self.numchan[slot] = numchan
+        self.speed[slot] = (<float *> (self.SPEED.data))[k]
+        self.arrival[slot] = arrival
+        voice = self.seq * self.capacity + slot
+        self.ids[slot] = voice
+        self.seq += 1
+
+        self.where[slot] = self.count
+        self.active[self.count] = slot
+        self.count += 1
+        PyThread_release_lock(self.lock)
+
+        # The previous data of the slot may be still mixed by the audio
+        # callback: it is released after the mixes started until now
+        self.retire(self.refs[slot], started)
+        self.refs[slot] = sound
+        self.release_retired(done)
+        return voice
+
+    cdef retire(self, sound, long long started):
+        '''
+        Keep a replaced sound alive until the mixes that could read it are done
+
+        :param sound: The replaced Sound, or None
+        :param started: The number of mixes started before the replacement
+        '''
+        if sound is not None:
+            self.retired.append((started, sound))
+
+    cdef release_retired(self, long long done):
+        '''
+        Release the retired sounds no longer read by the mixer
+
+        :param done: The number of mixes completed
+        '''
+        while self.retired and self.retired[0][0] <= done:
+            self.retired.pop(0)
+
+    cpdef fadeout(self, long long voice):
+        '''
+        Start the fadeout of a voice, if it is still playing
+
+        :param voice: The voice id
+        '''
+        cdef int slot
+        PyThread_acquire_lock(self.lock, WAIT_LOCK)
+        slot = self.slot_of(voice)
+        if slot >= 0:
+            self.isfadeout[slot] = 1
+        PyThread_release_lock(self.lock)
+
+    cpdef stop(self, long long voice):
+        '''
+        Stop a voice, if it is still playing
+
+        :param voice: The voice id
+        '''
+        cdef int slot
+        PyThread_acquire_lock(self.lock, WAIT_LOCK)
+        slot = self.slot_of(voice)
+        if slot >= 0:
+            self.deactivate(slot)
+        PyThread_release_lock(self.lock)
+
+    cpdef bint playing(self, long long voice):
+        '''
+        :param voice: The voice id
+        :return: True if the voice is still playing
+        '''
+        cdef int slot
+        PyThread_acquire_lock(self.lock, WAIT_LOCK)
+        slot = self.slot_of(voice)
+        PyThread_release_lock(self.lock)
+        return slot >= 0
+
+    cpdef clear(self):
+        '''
+        Stop all the voices and release the samples data
+        '''
+        cdef int i
+        cdef long long started, done
+        PyThread_acquire_lock(self.lock, WAIT_LOCK)
+        while self.count > 0:
+            self.deactivate(self.active[self.count - 1])
+        for i in range(self.capacity):
+            self.data[i] = NULL
+            self.loopdata[i] = NULL
+        started = self.mixes_started
+        done = self.mixes_done
+        PyThread_release_lock(self.lock)
+        for i in range(self.capacity):
+            self.retire(self.refs[i], started)
+            self.refs[i] = None
+        self.release_retired(done)
+
+    cdef int take_snapshot(self, long long now) except -1:
+        '''
+        Copy the active voices in the snapshot. The data pointers are copied
+        without references: the sounds replaced during the mix are kept alive
+        by the retired list, so the audio callback never releases memory.
+
+        The voices mixed for the first time record their note-on latency:
+        the time from the note-on to the mix, plus the time from the audio
+        callback to the output of the block, as reported by the device.
+
+        :param now: The CLOCK_MONOTONIC time (ns) of the start of the mix
+        :return: The number of voices in the snapshot
+        '''
+        cdef int v, slot, n
+        cdef voice_t* snap
+        cdef long long output = <long long> (self.latency * 1e9)
+        PyThread_acquire_lock(self.lock, WAIT_LOCK)
+        n = self.count
+        for v in range(n):
+            slot = self.active[v]
+            if self.arrival[slot] != 0:
+                self.record_latency(now - self.arrival[slot] + output)
+                self.arrival[slot] = 0
+            snap = &self.snapshot[v]
+            snap.slot = slot
+            snap.id = self.ids[slot]
+            snap.pos = self.pos[slot]
+            snap.fadeoutpos = self.fadeoutpos[slot]
+            snap.isfadeout = self.isfadeout[slot]
+            snap.loop = self.loop[slot]
+            snap.length = self.length[slot]
+            snap.numchan = self.numchan[slot]
+            snap.speed = self.speed[slot]
+            snap.data = self.data[slot]
+            snap.ring = self.ring[slot]
+            snap.attack = self.attack[slot]
+            snap.loopdata = self.loopdata[slot]
+            snap.loopstart = self.loopstart[slot]
+            snap.loopframes = self.loopframes[slot]
+            snap.finished = 0
+        self.mixes_started += 1
+        PyThread_release_lock(self.lock)
+        return n
+
+    def streaming(self):
+        '''
+        List the playing voices streamed from disk. Called only by the
+        stream reader thread.
+
+        The voices are copied in C arrays holding the lock, and the Python
+        objects are created after releasing it, so the mixer waiting for
+        the lock never waits for the memory allocator.
+
+        :return: List of tuples (voice id, Sound, position, speed)
+        '''
+        cdef int v, slot, n = 0
+        PyThread_acquire_lock(self.lock, WAIT_LOCK)
+        for v in range(self.count):
+            slot = self.active[v]
+            if self.ring[slot] >= 0 and n < self.streams.nrings:
+                self.streamids[n] = self.ids[slot]
+                self.streampos[n] = self.pos[slot]
+                self.streamspeed[n] = self.speed[slot]
+                n += 1
+        PyThread_release_lock(self.lock)
+        result = []
+        for v in range(n):
+            # The sound of the slot is replaced only holding the GIL, together
+            # with the voice id: a voice replaced since the copy is skipped
+            slot = <int> (self.streamids[v] % self.capacity)
+            if self.ids[slot] == self.streamids[v]:
+                result.append((self.streamids[v], self.refs[slot], self.streampos[v], self.streamspeed[v]))
+        return result
+
+    cpdef bint block_loaded(self, long long voice, long long block):
+        '''
+        :param voice: The voice id
+        :param block: The number of the block in the sample
+        :return: True if the block is in the ring of the voice or the voice is not playing
+        '''
+        cdef int slot
+        cdef bint loaded = True
+        PyThread_acquire_lock(self.lock, WAIT_LOCK)
+        slot = self.slot_of(voice)
+        if slot >= 0 and self.ring[slot] >= 0:
+            loaded = (self.streams.tags[self.ring[slot] * self.streams.nblocks + block % self.streams.nblocks] == block)
+        PyThread_release_lock(self.lock)
+        return loaded
+
+    cpdef fill_block(self, long long voice, long long block, numpy.ndarray frames):
+        '''
+        Copy a block of frames read from disk in the ring of a voice.
+
+        :param voice: The voice id
+        :param block: The number of the block in the sample
+        :param frames: The int16 interleaved frames of the block. It can be
+        shorter than a block at the end of the sample
+        '''
+        cdef int slot, index
+        cdef int count = frames.shape[0]
+        if frames.dtype != numpy.int16 or not frames.flags['C_CONTIGUOUS']:
+            raise ValueError('frames should be a contiguous int16 array')
+        PyThread_acquire_lock(self.lock, WAIT_LOCK)
+        slot = self.slot_of(voice)
+        if slot >= 0 and self.ring[slot] >= 0:
+            if count > self.streams.block_frames * self.numchan[slot]:
+                count = self.streams.block_frames * self.numchan[slot]
+            index = self.ring[slot] * self.streams.nblocks + <int> (block % self.streams.nblocks)
+            memcpy(self.streams.rings + 2 * <long> index * self.streams.block_frames, frames.data, count * sizeof(short))
+            self.streams.tags[index] = block
+        PyThread_release_lock(self.lock)
+
+    cdef void update_from_snapshot(self, int n) noexcept nogil:
+        '''
+        Write back the positions of the mixed voices and remove the finished
+        ones. The voices stopped or replaced while mixing are skipped.
+        '''
+        cdef int v
+        cdef voice_t* snap
+        PyThread_acquire_lock(self.lock, WAIT_LOCK)
+        for v in range(n):
+            snap = &self.snapshot[v]
+            if self.ids[snap.slot] != snap.id:
+                continue
+            if snap.finished:
+                self.deactivate(snap.slot)
+                self.finished += 1
+            else:
+                self.pos[snap.slot] = snap.pos
+                self.fadeoutpos[snap.slot] = snap.fadeoutpos
+        self.mixes_done += 1
+        PyThread_release_lock(self.lock)
+
+# Interpolation quality of the resampling kernel
+cdef enum:
+    QUALITY_NONE = 0                                                        # drop-sample, cheapest
+    QUALITY_LINEAR = 1
+    QUALITY_HERMITE = 2                                                     # 4 points cubic Hermite
+
+INTERPOLATION_NONE = QUALITY_NONE
+INTERPOLATION_LINEAR = QUALITY_LINEAR
+INTERPOLATION_HERMITE = QUALITY_HERMITE
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void copyspan(short* zz, int numchan, int k0, int n, float* bb, float* fade) noexcept nogil:
+    # Sample played at its own pitch on a whole frame: no interpolation needed
+    cdef int m
+    cdef float s
+    if numchan == 1:
+        for m in range(n):
+            s = zz[k0 + m] * fade[m]
+            bb[2 * m] += s
+            bb[2 * m + 1] += s
+    else:
+        for m in range(n):
+            bb[2 * m] += zz[2 * (k0 + m)] * fade[m]
+            bb[2 * m + 1] += zz[2 * (k0 + m) + 1] * fade[m]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void nearestspan(short* zz, int numchan, double pos, float speed, int n, float* bb, float* fade) noexcept nogil:
+    cdef int m, k
+    cdef float s
+    if numchan == 1:
+        for m in range(n):
+            k = <int> (pos + m * speed)
+            s = zz[k] * fade[m]
+            bb[2 * m] += s
+            bb[2 * m + 1] += s
+    else:
+        for m in range(n):
+            k = <int> (pos + m * speed)
+            bb[2 * m] += zz[2 * k] * fade[m]
+            bb[2 * m + 1] += zz[2 * k + 1] * fade[m]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void linearspan(short* zz, int numchan, double pos, float speed, int n, float* bb, float* fade) noexcept nogil:
+    cdef int m, k
+    cdef double j
+    cdef float f, s
+    if numchan == 1:
+        for m in range(n):
+            j = pos + m * speed
+            k = <int> j
+            f = <float> (j - k)
+            s = (zz[k] + f * (zz[k + 1] - zz[k])) * fade[m]
+            bb[2 * m] += s
+            bb[2 * m + 1] += s
+    else:
+        for m in range(n):
+            j = pos + m * speed
+            k = <int> j
+            f = <float> (j - k)
+            bb[2 * m] += (zz[2 * k] + f * (zz[2 * k + 2] - zz[2 * k])) * fade[m]
+            bb[2 * m + 1] += (zz[2 * k + 1] + f * (zz[2 * k + 3] - zz[2 * k + 1])) * fade[m]
+
+@cython.cdivision(True)
+cdef inline float hermite(float xm1, float x0, float x1, float x2, float f) noexcept nogil:
+    # Catmull-Rom cubic Hermite interpolation between x0 and x1
+    cdef float c = (x1 - xm1) * 0.5
+    cdef float v = x0 - x1
+    cdef float w = c + v
+    cdef float a = w + v + (x2 - x0) * 0.5
+    cdef float b = w + a
+    return ((a * f - b) * f + c) * f + x0
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void hermitespan(short* zz, int numchan, int length, double pos, float speed, int m0, int m1,
+                             bint clamp, float* bb, float* fade) noexcept nogil:
+    # Mixes the frames m0 to m1 of the span. The neighbour frames are clamped
+    # to the sample bounds only for the first and last frames of the sample
+    cdef int m, k, km1, k1, k2
+    cdef double j
+    cdef float f, s
+    for m in range(m0, m1):
+        j = pos + m * speed
+        k = <int> j
+        f = <float> (j - k)
+        km1 = k - 1
+        k1 = k + 1
+        k2 = k + 2
+        if clamp:
+            if km1 < 0:
+                km1 = 0
+            if k1 > length - 1:
+                k1 = length - 1
+            if k2 > length - 1:
+                k2 = length - 1
+        if numchan == 1:
+            s = hermite(zz[km1], zz[k], zz[k1], zz[k2], f) * fade[m]
+            bb[2 * m] += s
+            bb[2 * m + 1] += s
+        else:
+            bb[2 * m] += hermite(zz[2 * km1], zz[2 * k], zz[2 * k1], zz[2 * k2], f) * fade[m]
+            bb[2 * m + 1] += hermite(zz[2 * km1 + 1], zz[2 * k + 1], zz[2 * k1 + 1], zz[2 * k2 + 1], f) * fade[m]
+
+@cython.cdivision(True)
+cdef void assemble(voice_t* voice, streams_t* streams, int k0, int k1) noexcept nogil:
+    '''
+    Copy the frames k0 to k1 (excluded) of a streamed voice in the scratch
+    buffer, taking them from the resident attack and loop start or from the
+    ring blocks.
+    The frames of the blocks not yet read from disk are silent.
+    '''
+    cdef int k = k0
+    cdef int numchan = voice.numchan
+    cdef int n, offset, index
+    cdef long long block
+    cdef short* dst = streams.scratch
+    PyThread_acquire_lock(streams.lock, WAIT_LOCK)
+    while k < k1:
+        if k < voice.attack:
+            n = min(k1, voice.attack) - k
+            memcpy(dst, voice.data + k * numchan, n * numchan * sizeof(short))
+        elif voice.loopstart <= k < voice.loopstart + voice.loopframes:
+            n = min(k1, voice.loopstart + voice.loopframes) - k
+            memcpy(dst, voice.loopdata + (k - voice.loopstart) * numchan, n * numchan * sizeof(short))
+        else:
+            block = k // streams.block_frames
+            offset = k - <int> (block * streams.block_frames)
+            n = min(k1 - k, streams.block_frames - offset)
+            index = voice.ring * streams.nblocks + <int> (block % streams.nblocks)
+            if streams.tags[index] == block:
+                memcpy(dst, streams.rings + (2 * <long> index * streams.block_frames) + offset * numchan,
+                       n * numchan * sizeof(short))
+            else:
+                memset(dst, 0, n * numchan * sizeof(short))
+                streams.underruns += n
+        dst += n * numchan
+        k += n
+    PyThread_release_lock(streams.lock)
+
+@cython.cdivision(True)
+cdef void mixvoice(voice_t* voice, streams_t* streams, float* bb, int frame_count, float* fadeout, float* unity,
+                   int FADEOUTLENGTH, int quality) noexcept nogil:
+    '''
+    Mix a voice in the float buffer and update its position.
+    Sets the finished flag of the voice when it has been completely played.
+
+    The block is split in spans that do not cross the loop end, so the inner
+    loops do not check the loop wrap on every frame. The fade pointer is the
+    fadeout envelope or a buffer of ones, so the same loop is used in both cases.
+
+    The position is a double, so it does not drift on long notes. At the
+    speeds that are not whole numbers the interpolated frames differ by up
+    to about 23 LSB from a float position, as used by the original kernel.
+
+    The frames of a span of a streamed voice are copied in the scratch buffer
+    and the span is mixed from there, with the positions shifted by the first
+    copied frame.
+    '''
+    cdef int N, n, i, a, b, k0, k1, base, spanlength
+    cdef int length = voice.length
+    cdef int looppos = voice.loop
+    cdef float speed = voice.speed
+    cdef double pos = voice.pos
+    cdef double spanpos
     cdef short* zz
-    cdef float* fadeout = <float *> (FADEOUT.data)
-
-    for snd in playingsounds:
-        pos = snd.pos
-        fadeoutpos = snd.fadeoutpos
-        looppos = snd.sound.loop
-        length = snd.sound.nframes
-        speed = SPEED[snd.note - snd.sound.midinote]
-        newsz = frame_count * speed
-        z = snd.sound.data
-        zz = <short *> (z.data)
-
-        N = frame_count
-
-        if ( (pos + frame_count * speed > length - 4) and (looppos == -1) ):
-            rmlist.append(snd)
-            N = <int> ((length - 4 - pos) / speed)
-
-        if (snd.isfadeout):
-            if (fadeoutpos > FADEOUTLENGTH):
-                rmlist.append(snd)   
-            ii = 0   
-            for i in range(N):
-                j = pos + ii * speed
-                ii += 1                  
-                k = <int> j
-                if (k > length - 2):
-                    pos = looppos + 1
-                    snd.pos = pos
-                    ii = 0
-                    j = pos + ii * speed   
-                    k = <int> j       
-                bb[2 * i] += (zz[2 * k] + (j - k) * (zz[2 * k + 2] - zz[2 * k])) * fadeout[fadeoutpos + i]                   # linear interpolation
-                bb[2 * i + 1] += (zz[2 * k + 1] + (j - k) * (zz[2 * k + 3] - zz[2 * k + 1])) * fadeout[fadeoutpos + i]        
-            snd.fadeoutpos += i
+    cdef float* fade
+    cdef bint wrapped
+
+    N = frame_count
+    if ( (pos + frame_count * speed > length - 4) and (looppos == -1) ):
+        voice.finished = 1
+        N = <int> ((length - 4 - pos) / speed)
+    if (voice.isfadeout):
+        if (voice.fadeoutpos > FADEOUTLENGTH):
+            voice.finished = 1
+
+    i = 0
+    wrapped = False
+    while i < N:
+        # Number of frames before the loop end (frame length - 1 is the last
+        # one that can be interpolated)
+        n = 0
+        if <int> pos <= length - 2:
+            n = <int> ((length - 1 - pos) / speed)
+            if n < N - i and pos + n * speed < length - 1:
+                n += 1
+            if n > N - i:
+                n = N - i
+            while n > 0 and <int> (pos + (n - 1) * speed) > length - 2:
+                n -= 1
+        if n == 0:
+            # Loop wrap. Stop if the loop is empty
+            if wrapped:
+                break
+            pos = looppos + 1
+            wrapped = True
+            continue
+        wrapped = False
+
+        zz = voice.data
+        spanpos = pos
+        spanlength = length
+        if voice.ring >= 0:
+            # The span should fit in the scratch buffer, with the
+            # neighbour frames used by the interpolation
+            if n * speed > streams.scratch_frames - 4:
+                n = <int> ((streams.scratch_frames - 4) / speed)
+            k0 = max(<int> pos - 1, 0)
+            k1 = min(<int> (pos + (n - 1) * speed) + 3, length)
+            assemble(voice, streams, k0, k1)
+            zz = streams.scratch
+            spanpos = pos - k0
+            spanlength = length - k0
+
+        if voice.isfadeout:
+            fade = fadeout + voice.fadeoutpos + i
+        else:
+            fade = unity
+        if speed == 1.0 and spanpos == <int> spanpos:
+            copyspan(zz, voice.numchan, <int> spanpos, n, bb + 2 * i, fade)
+        elif quality == QUALITY_NONE:
+            nearestspan(zz, voice.numchan, spanpos, speed, n, bb + 2 * i, fade)
+        elif quality == QUALITY_HERMITE:
+            # Frames with all the neighbours in the sample are mixed without clamping
+            a = 0
+            while a < n and spanpos + a * speed < 1:
+                a += 1
+            b = n
+            while b > a and <int> (spanpos + (b - 1) * speed) > spanlength - 3:
+                b -= 1
+            hermitespan(zz, voice.numchan, spanlength, spanpos, speed, 0, a, True, bb + 2 * i, fade)
+            hermitespan(zz, voice.numchan, spanlength, spanpos, speed, a, b, False, bb + 2 * i, fade)
+            hermitespan(zz, voice.numchan, spanlength, spanpos, speed, b, n, True, bb + 2 * i, fade)
+        else:
+            linearspan(zz, voice.numchan, spanpos, speed, n, bb + 2 * i, fade)
+        i += n
+        pos += n * speed
+
+    if (voice.isfadeout) and (N > 0):
+        voice.fadeoutpos += N - 1
+    voice.pos = pos
+
+def mixaudiobuffers(VoiceTable voices, int frame_count, numpy.ndarray outdata, float volume):
+    '''
+    Mix the playing voices in the interleaved stereo output buffer, int16
+    or float32 (full scale 1.0).
+
+    The active voices are copied in a snapshot, then the mix runs without
+    the GIL, so the MIDI, GUI and loader threads cannot delay it.
+    The mix is done in the float buffer of the voice table, then the volume
+    is applied and the result is saturated and converted in place in outdata.
+    The finished voices are removed from the table.
+    '''
+    cdef int i, v, n
+    cdef float sample
+    cdef bint floatout = outdata.dtype == numpy.float32
+    cdef short* out = <short *> (outdata.data)
+    cdef float* fout = <float *> (outdata.data)
+    cdef float scale = volume / 32768.0
+    cdef float* fadeout = <float *> (voices.FADEOUT.data)
+    cdef int FADEOUTLENGTH = voices.FADEOUTLENGTH
+    cdef voice_t* snapshot = voices.snapshot
 
+    cdef int quality = voices.quality
+    cdef timespec start, end
+
+    if not floatout and outdata.dtype != numpy.int16:
+        raise ValueError('outdata should be an int16 or float32 array')
+    clock_gettime(CLOCK_MONOTONIC, &start)
+    if voices.mixbuf.shape[0] < 2 * frame_count:
+        voices.mixbuf = numpy.zeros(2 * frame_count, numpy.float32)
+        voices.unity = numpy.ones(frame_count, numpy.float32)
+    cdef float* bb = <float *> (voices.mixbuf.data)                         # output buffer pointer
+    cdef float* unity = <float *> (voices.unity.data)
+
+    n = voices.take_snapshot(start.tv_sec * 1000000000LL + start.tv_nsec)
+    if n > voices.peak:
+        voices.peak = n
+
+    with nogil:
+        memset(bb, 0, 2 * frame_count * sizeof(float))
+        for v in range(n):
+            mixvoice(&snapshot[v], &voices.streams, bb, frame_count, fadeout, unity, FADEOUTLENGTH, quality)
+        voices.update_from_snapshot(n)
+
+        # Volume, saturation and conversion to the output format
+        if floatout:
+            for i in range(2 * frame_count):
+                sample = bb[i] * scale
+                if sample > 1.0:
+                    sample = 1.0
+                elif sample < -1.0:
+                    sample = -1.0
+                fout[i] = sample
         else:
-            ii = 0            
-            for i in range(N):
-                j = pos + ii * speed
-                ii += 1                  
-                k = <int> j
-                if (k > length - 2):
-                    pos = looppos + 1
-                    snd.pos = pos
-                    ii = 0
-                    j = pos + ii * speed   
-                    k = <int> j  
-                bb[2 * i] += zz[2 * k] + (j - k) * (zz[2 * k + 2] - zz[2 * k])                                               # linear interpolation
-                bb[2 * i + 1] += zz[2 * k + 1] + (j - k) * (zz[2 * k + 3] - zz[2 * k + 1])
-
-        snd.pos += ii * speed
-
-    return b
-
-def binary24_to_int16(char *data, int length):
-    cdef int i
-    res = numpy.zeros(length, numpy.int16)
-    b = <char *>((<numpy.ndarray>res).data)
-    for i in range(length):
-        b[2*i] = data[3*i+1]
-        b[2*i+1] = data[3*i+2]
-    return res
\ No newline at end of file
+            for i in range(2 * frame_count):
+                sample = bb[i] * volume
+                if sample > 32767:
+                    sample = 32767
+                elif sample < -32768:
+                    sample = -32768
+                out[i] = <short> sample
+
+        clock_gettime(CLOCK_MONOTONIC, &end)
+        voices.record_time((end.tv_sec - start.tv_sec) * 1000000000LL + (end.tv_nsec - start.tv_nsec))
@@ -0,0 +1,9 @@
+'''
+@file conftest.py
+@brief Makes the classes package of the control panel importable by the tests
+'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
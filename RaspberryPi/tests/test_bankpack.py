@@ -0,0 +1,74 @@
+'''
+@file test_bankpack.py
+@brief Tests of the packed bank format
+'''
+
+import os
+
+import numpy
+import pytest
+
+# The Sound class needs the audio and MIDI modules of the panel
+pytest.importorskip('sounddevice')
+pytest.importorskip('rtmidi_python')
+
+from classes.bankpack import BankPack
+from classes.music import Sound
+
+def make_sounds():
+    mono = numpy.arange(-1000, 1000, dtype=numpy.int16)
+    stereo = numpy.arange(3000, dtype=numpy.int16)
+    return {
+        (60, 0, 0): Sound.from_array('c.wav', 60, 127, mono, 1, -1, len(mono), 0),
+        (62, 1, 2): Sound.from_array('d.wav', 62, 64, stereo, 2, 100, 1200, 0)
+    }
+
+def test_round_trip(tmp_path):
+    packed_name = str(tmp_path / 'bank.rmbank')
+    sounds = make_sounds()
+    BankPack.write(packed_name, sounds)
+    read = BankPack.read(packed_name)
+    assert set(read) == set(sounds)
+    for key, sound in sounds.items():
+        packed = read[key]
+        assert numpy.array_equal(packed.data, sound.data)
+        assert (packed.midinote, packed.velocity, packed.numchan, packed.loop, packed.nframes) == \
+            (sound.midinote, sound.velocity, sound.numchan, sound.loop, sound.nframes)
+        # Every sample is aligned to a cache line
+        assert packed.dataoffset % BankPack.SAMPLE_ALIGN == 0
+    assert not os.path.exists(packed_name + '.tmp')
+
+def test_other_rate_is_rejected(tmp_path, monkeypatch):
+    packed_name = str(tmp_path / 'bank.rmbank')
+    BankPack.write(packed_name, make_sounds())
+    monkeypatch.setattr(Sound, 'rate', Sound.rate + 1)
+    assert BankPack.read(packed_name) is None
+
+@pytest.mark.parametrize('content', [b'', b'not a packed bank file at all'])
+def test_invalid_file_is_rejected(tmp_path, content):
+    packed_name = tmp_path / 'bank.rmbank'
+    packed_name.write_bytes(content)
+    assert BankPack.read(str(packed_name)) is None
+
+def test_truncated_file_is_rejected(tmp_path):
+    packed_name = str(tmp_path / 'bank.rmbank')
+    BankPack.write(packed_name, make_sounds())
+    with open(packed_name, 'r+b') as file:
+        file.truncate(os.path.getsize(packed_name) - 100)
+    assert BankPack.read(packed_name) is None
+
+def test_load_needs_current_sources(tmp_path):
+    packed_name = str(tmp_path / 'bank.rmbank')
+    definition = tmp_path / 'bank.json'
+    sources = {key: (str(tmp_path / ('%d.wav' % key[0])), key[0], 127) for key in make_sounds()}
+    definition.write_text('{}')
+    for file, midinote, velocity in sources.values():
+        open(file, 'wb').close()
+    BankPack.write(packed_name, make_sounds())
+    assert set(BankPack.load(packed_name, sources, str(definition))) == set(sources)
+    # A sample file missing from the pack
+    assert BankPack.load(packed_name, dict(sources, extra=sources[60, 0, 0]), str(definition)) is None
+    # A source changed after packing
+    mtime = os.stat(packed_name).st_mtime_ns + 10 ** 9
+    os.utime(str(definition), ns=(mtime, mtime))
+    assert BankPack.load(packed_name, sources, str(definition)) is None
@@ -0,0 +1,64 @@
+'''
+@file test_decoder.py
+@brief Tests of the conversion of the wav frames to 16 bit samples
+'''
+
+import numpy
+import pytest
+
+from classes.decoder import SampleDecoder
+
+EXPECTED = numpy.array([0, 1, -1, 16384, -16384, 32767, -32768], numpy.int16)
+
+def test_16_bit_is_a_view():
+    data = EXPECTED.astype('<i2').tobytes()
+    samples = SampleDecoder().decode(data, 2)
+    assert samples.dtype == numpy.int16
+    assert not samples.flags['OWNDATA']
+    assert numpy.array_equal(samples, EXPECTED)
+
+def test_8_bit_is_unsigned():
+    data = bytes([128, 129, 127, 0, 255])
+    samples = SampleDecoder().decode(data, 1)
+    assert numpy.array_equal(samples, [0, 256, -256, -32768, 32512])
+
+def test_24_bit():
+    values = EXPECTED.astype(numpy.int32) * 256
+    data = b''.join(int(v).to_bytes(3, 'little', signed=True) for v in values)
+    assert numpy.array_equal(SampleDecoder().decode(data, 3), EXPECTED)
+
+def test_24_bit_rounds():
+    # 1.5 and -1.5 LSB of 16 bits round to even, as numpy.rint
+    data = b''.join(int(v).to_bytes(3, 'little', signed=True) for v in (384, -384, 127))
+    assert numpy.array_equal(SampleDecoder().decode(data, 3), [2, -2, 0])
+
+def test_32_bit():
+    data = (EXPECTED.astype('<i4') * 65536).tobytes()
+    assert numpy.array_equal(SampleDecoder().decode(data, 4), EXPECTED)
+
+@pytest.mark.parametrize('width, dtype', [(4, '<f4'), (8, '<f8')])
+def test_float(width, dtype):
+    data = (EXPECTED.astype(dtype) / 32768).tobytes()
+    assert numpy.array_equal(SampleDecoder().decode(data, width, ieee=True), EXPECTED)
+
+def test_float_is_clipped():
+    data = numpy.array([1.5, -1.5], '<f4').tobytes()
+    assert numpy.array_equal(SampleDecoder().decode(data, 4, ieee=True), [32767, -32768])
+
+def test_dither_is_triangular():
+    data = numpy.zeros(100000, '<i4').tobytes()
+    samples = SampleDecoder(dither=True, seed=0).decode(data, 4)
+    assert set(numpy.unique(samples)) <= {-1, 0, 1}
+    # The triangular noise of +-1 LSB rounds to +-1 with probability 1/4
+    assert abs(samples.astype(float).var() - 0.25) < 0.01
+    assert abs(samples.mean()) < 0.01
+
+def test_dither_is_repeatable():
+    data = numpy.arange(-5000, 5000, dtype='<i4').tobytes()
+    first = SampleDecoder(dither=True, seed=1).decode(data, 4)
+    assert numpy.array_equal(first, SampleDecoder(dither=True, seed=1).decode(data, 4))
+
+@pytest.mark.parametrize('width, ieee', [(5, False), (2, True)])
+def test_unsupported_width(width, ieee):
+    with pytest.raises(ValueError):
+        SampleDecoder().decode(b'', width, ieee)
@@ -0,0 +1,152 @@
+'''
+@file test_engine.py
+@brief Tests of the mix of the voices by the audio engine
+'''
+
+from types import SimpleNamespace
+
+import numpy
+import pytest
+
+samplerbox_audio = pytest.importorskip('samplerbox_audio')
+
+BLOCK = 256
+# Playing speeds of the notes 60 to 64, the sample note is 60
+SPEED = numpy.array([1.0, 0.5, 1.5, 0.75, 2 ** (1 / 12)], numpy.float32)
+FADEOUT_LENGTH = 1000
+FADEOUT = numpy.append(numpy.linspace(1.0, 0.0, FADEOUT_LENGTH),
+                       numpy.zeros(FADEOUT_LENGTH)).astype(numpy.float32)
+
+def make_sound(data, numchan=1, loop=-1):
+    '''
+    :param data: The frames, channels interleaved
+    :param numchan: The number of channels
+    :param loop: The loop start frame, -1 for a one-shot sample
+    :return: A resident sound as created by the Sound class
+    '''
+    data = numpy.ascontiguousarray(data, numpy.int16)
+    return SimpleNamespace(data=data, numchan=numchan, loop=loop, nframes=len(data) // numchan,
+                           midinote=60, streamed=False, loopstart=-1, loopdata=None)
+
+def make_voices(quality=samplerbox_audio.INTERPOLATION_LINEAR):
+    return samplerbox_audio.VoiceTable(4, SPEED, FADEOUT, FADEOUT_LENGTH, BLOCK, quality)
+
+def render(voices, blocks):
+    '''
+    :return: The int16 stereo frames of the mixed blocks
+    '''
+    out = []
+    for i in range(blocks):
+        outdata = numpy.zeros((BLOCK, 2), numpy.int16)
+        samplerbox_audio.mixaudiobuffers(voices, BLOCK, outdata, 1.0)
+        out.append(outdata)
+    return numpy.concatenate(out)
+
+def tone(frames, seed=0):
+    return numpy.random.default_rng(seed).integers(-10000, 10000, frames).astype(numpy.int16)
+
+def test_mono_copy():
+    data = tone(4 * BLOCK)
+    voices = make_voices()
+    voices.add(make_sound(data), 60)
+    out = render(voices, 2)
+    assert numpy.array_equal(out[:, 0], data[:2 * BLOCK])
+    assert numpy.array_equal(out[:, 1], data[:2 * BLOCK])
+
+def test_stereo_copy():
+    data = tone(8 * BLOCK)
+    voices = make_voices()
+    voices.add(make_sound(data, numchan=2), 60)
+    assert numpy.array_equal(render(voices, 2), data.reshape(-1, 2)[:2 * BLOCK])
+
+@pytest.mark.parametrize('note', [61, 62, 63, 64])
+def test_linear(note):
+    data = tone(4 * BLOCK)
+    voices = make_voices()
+    voices.add(make_sound(data), note)
+    out = render(voices, 2)
+    positions = numpy.arange(2 * BLOCK) * numpy.float64(SPEED[note - 60])
+    expected = numpy.interp(positions, numpy.arange(len(data)), data)
+    # The output is truncated to int16, after the float32 interpolation
+    assert numpy.abs(out[:, 0] - expected).max() < 1.5
+
+@pytest.mark.parametrize('note', [61, 62, 63])
+def test_none(note):
+    data = tone(4 * BLOCK)
+    voices = make_voices(samplerbox_audio.INTERPOLATION_NONE)
+    voices.add(make_sound(data), note)
+    out = render(voices, 2)
+    positions = (numpy.arange(2 * BLOCK) * numpy.float64(SPEED[note - 60])).astype(int)
+    assert numpy.array_equal(out[:, 0], data[positions])
+
+def catmull_rom(data, position):
+    k = int(position)
+    f = position - k
+    xm1, x0, x1, x2 = (float(data[min(max(i, 0), len(data) - 1)]) for i in (k - 1, k, k + 1, k + 2))
+    return x0 + 0.5 * f * (x1 - xm1 + f * (2 * xm1 - 5 * x0 + 4 * x1 - x2 + f * (3 * (x0 - x1) + x2 - xm1)))
+
+@pytest.mark.parametrize('note', [61, 62, 64])
+def test_hermite(note):
+    data = tone(4 * BLOCK)
+    voices = make_voices(samplerbox_audio.INTERPOLATION_HERMITE)
+    voices.add(make_sound(data), note)
+    out = render(voices, 2)
+    speed = numpy.float64(SPEED[note - 60])
+    expected = [catmull_rom(data, m * speed) for m in range(2 * BLOCK)]
+    assert numpy.abs(out[:, 0] - expected).max() < 1.5
+
+def test_hermite_keeps_a_ramp():
+    data = numpy.arange(0, 4 * BLOCK * 10, 10)
+    voices = make_voices(samplerbox_audio.INTERPOLATION_HERMITE)
+    voices.add(make_sound(data), 61)
+    out = render(voices, 2)
+    assert numpy.abs(out[1:, 0] - numpy.arange(1, 2 * BLOCK) * 5).max() <= 1
+
+@pytest.mark.parametrize('numchan', [1, 2])
+def test_loop_start_is_played_once_per_wrap(numchan):
+    frames, loop = 300, 100
+    data = tone(frames * numchan).reshape(frames, numchan)
+    # The frame after the loop end is the loop start frame
+    data[frames - 2] = data[loop]
+    voices = make_voices()
+    voices.add(make_sound(data.ravel(), numchan, loop), 60)
+    out = render(voices, 8)
+    # The first pass plays the frames to the loop end, every wrap continues
+    # from the frame after the loop start
+    passes = [data[:frames - 1]] + [data[loop + 1:frames - 1]] * (8 * BLOCK // (frames - 2 - loop))
+    expected = numpy.concatenate(passes)[:8 * BLOCK]
+    if numchan == 1:
+        expected = numpy.repeat(expected, 2, axis=1)
+    assert numpy.array_equal(out, expected)
+    assert voices.count == 1
+
+def test_one_shot_ends():
+    data = tone(BLOCK + 100)
+    voices = make_voices()
+    voices.add(make_sound(data), 60)
+    out = render(voices, 3)
+    assert numpy.array_equal(out[:BLOCK + 96, 0], data[:BLOCK + 96])
+    assert not out[BLOCK + 96:].any()
+    assert voices.count == 0 and voices.finished == 1
+
+def test_fadeout():
+    data = tone(16 * BLOCK)
+    voices = make_voices()
+    voice = voices.add(make_sound(data, loop=0), 60)
+    render(voices, 1)
+    voices.fadeout(voice)
+    out = render(voices, 1)
+    expected = data[BLOCK:2 * BLOCK] * FADEOUT[:BLOCK]
+    assert numpy.abs(out[:, 0] - expected).max() < 1.01
+    # The voice ends after the fadeout
+    render(voices, FADEOUT_LENGTH // BLOCK + 2)
+    assert voices.count == 0
+
+def test_float_output():
+    data = tone(4 * BLOCK)
+    voices = make_voices()
+    voices.add(make_sound(data), 61)
+    outdata = numpy.zeros((BLOCK, 2), numpy.float32)
+    samplerbox_audio.mixaudiobuffers(voices, BLOCK, outdata, 1.0)
+    expected = numpy.interp(numpy.arange(BLOCK) * 0.5, numpy.arange(len(data)), data) / 32768
+    assert numpy.abs(outdata[:, 0] - expected).max() < 1e-6
@@ -0,0 +1,27 @@
+'''
+@file test_keymap.py
+@brief Tests of the map of the MIDI notes to the bank samples
+'''
+
+from classes.keymap import BankLayers, KeyMap
+
+LAYERS = BankLayers({'layers': [31, 63, 95, 127]})
+
+def test_missing_layer_plays_the_nearest_layer():
+    keymap = KeyMap({(60, 0, 0): 'soft', (60, 3, 0): 'loud'}, LAYERS)
+    assert [keymap.lookup(60, velocity) for velocity in (10, 40, 80, 120)] == \
+        ['soft', 'soft', 'loud', 'loud']
+
+def test_missing_layer_plays_the_softer_layer_when_as_near():
+    keymap = KeyMap({(60, 0, 0): 'soft', (60, 2, 0): 'loud'}, LAYERS)
+    assert [keymap.lookup(60, velocity) for velocity in (10, 40, 80, 120)] == \
+        ['soft', 'soft', 'loud', 'loud']
+
+def test_missing_notes_play_the_lower_note():
+    keymap = KeyMap({(60, 0, 0): 'c', (64, 0, 0): 'e'})
+    assert keymap.lookup(59, 100) is None
+    assert [keymap.lookup(note, 100) for note in (60, 63, 64, 127)] == ['c', 'c', 'e', 'e']
+
+def test_round_robin_alternates():
+    keymap = KeyMap({(60, 0, 0): 'a', (60, 0, 1): 'b'})
+    assert [keymap.lookup(60, 100) for i in range(3)] == ['a', 'b', 'a']
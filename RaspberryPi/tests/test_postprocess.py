@@ -0,0 +1,45 @@
+'''
+@file test_postprocess.py
+@brief Tests of the processing of the recorded takes
+'''
+
+import numpy
+
+from classes.postprocess import TakeProcessor
+
+RATE = 44100
+
+def make_take(noise=0.0, seed=0):
+    '''
+    One second of silence, a decaying 220 Hz tone of two seconds and two
+    seconds of silence, with an optional background noise
+    '''
+    t = numpy.arange(2 * RATE) / RATE
+    tone = 16000 * numpy.sin(2 * numpy.pi * 220 * t) * numpy.exp(-t)
+    take = numpy.concatenate((numpy.zeros(RATE), tone, numpy.zeros(2 * RATE)))
+    take += numpy.random.default_rng(seed).normal(0, noise, len(take))
+    return numpy.rint(take).astype(numpy.int16).reshape(-1, 1)
+
+def test_silence_is_trimmed():
+    frames, loop = TakeProcessor(RATE).process(make_take())
+    assert 2 * RATE <= len(frames) < 2.2 * RATE
+
+def test_silence_is_trimmed_over_the_noise():
+    # Background noise at about -64 dBFS
+    frames, loop = TakeProcessor(RATE).process(make_take(noise=20.0))
+    assert 2 * RATE <= len(frames) < 2.2 * RATE
+
+def test_loud_noise_is_kept():
+    # Background noise only 30 dB under the tone is not silence
+    take = make_take(noise=16000 / numpy.sqrt(2) * 10 ** (-30 / 20))
+    frames, loop = TakeProcessor(RATE).process(take)
+    assert len(frames) > 4.9 * RATE
+
+def test_peak_is_normalized():
+    frames, loop = TakeProcessor(RATE, peak_db=-1.0).process(make_take(noise=20.0))
+    assert abs(numpy.abs(frames.astype(numpy.int32)).max() - 32767 * 10 ** (-1 / 20)) <= 1
+
+def test_silent_take_is_unchanged():
+    take = numpy.zeros((RATE, 1), numpy.int16)
+    frames, loop = TakeProcessor(RATE).process(take)
+    assert len(frames) == RATE and loop is None
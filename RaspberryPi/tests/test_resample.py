@@ -0,0 +1,44 @@
+'''
+@file test_resample.py
+@brief Tests of the resampling of the samples to the device rate
+'''
+
+import os
+
+import numpy
+
+from classes.resample import ResampleCache
+
+def test_hash_is_read_once(tmp_path, monkeypatch):
+    source = tmp_path / 'sample.wav'
+    source.write_bytes(b'frames')
+    cache = ResampleCache(str(tmp_path / 'Resampled'))
+    calls = []
+    original = ResampleCache.source_hash
+    monkeypatch.setattr(ResampleCache, 'source_hash',
+                        staticmethod(lambda name: calls.append(name) or original(name)))
+    first = cache.file_name(str(source), 48000)
+    assert cache.file_name(str(source), 48000) == first
+    # A new cache reads the hash from the index of the folder
+    assert ResampleCache(str(tmp_path / 'Resampled')).file_name(str(source), 48000) == first
+    assert len(calls) == 1
+
+def test_hash_follows_the_content(tmp_path):
+    source = tmp_path / 'sample.wav'
+    source.write_bytes(b'frames')
+    cache = ResampleCache(str(tmp_path))
+    first = cache.file_name(str(source), 48000)
+    source.write_bytes(b'other frames')
+    assert cache.file_name(str(source), 48000) != first
+    assert os.path.basename(cache.file_name(str(source), 48000)).startswith(
+        ResampleCache.source_hash(str(source)))
+
+def test_resample_keeps_a_tone():
+    rate, source_rate = 48000, 44100
+    t = numpy.arange(source_rate) / source_rate
+    frames = (10000 * numpy.sin(2 * numpy.pi * 1000 * t)).astype(numpy.int16).reshape(-1, 1)
+    out = ResampleCache.resample(frames, source_rate, rate)
+    assert len(out) == rate
+    expected = 10000 * numpy.sin(2 * numpy.pi * 1000 * numpy.arange(rate) / rate)
+    # Away from the edges, where the filter reads the padding
+    assert numpy.abs(out[1000:-1000, 0] - expected[1000:-1000]).max() <= 3
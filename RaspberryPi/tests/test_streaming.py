@@ -0,0 +1,70 @@
+'''
+@file test_streaming.py
+@brief Tests of the lookahead of the stream reader
+'''
+
+from types import SimpleNamespace
+
+import numpy
+
+from classes.streaming import StreamReader
+
+BLOCK_FRAMES = 4096
+RING_BLOCKS = 16
+
+def make_reader(lookahead=RING_BLOCKS * BLOCK_FRAMES // 2):
+    voices = SimpleNamespace(block_frames=BLOCK_FRAMES, ring_blocks=RING_BLOCKS)
+    return StreamReader(voices, lookahead)
+
+def make_sound(nframes, loop=-1, attack=11025, loopframes=0, numchan=1):
+    loopdata = numpy.zeros(loopframes * numchan, numpy.int16) if loopframes else None
+    return SimpleNamespace(data=numpy.zeros(attack * numchan, numpy.int16), numchan=numchan,
+                           nframes=nframes, loop=loop, loopstart=loop if loopframes else -1,
+                           loopdata=loopdata)
+
+def test_one_shot_blocks_follow_the_position():
+    reader = make_reader()
+    blocks = reader.blocks_ahead(make_sound(400000), 50000, 1.0)
+    first = (50000 - 1) // BLOCK_FRAMES
+    assert blocks == list(range(first, first + len(blocks)))
+    assert 0 < len(blocks) < RING_BLOCKS
+
+def test_attack_blocks_are_not_read():
+    reader = make_reader()
+    blocks = reader.blocks_ahead(make_sound(400000), 0, 1.0)
+    assert min(blocks) == 11025 // BLOCK_FRAMES
+
+def test_one_shot_stops_at_the_end():
+    reader = make_reader()
+    assert reader.blocks_ahead(make_sound(40000), 39000, 1.0) == [9]
+
+def test_loop_blocks_never_share_a_ring_slot():
+    # Loops whose length in blocks is a multiple of the ring, or close to it,
+    # put the blocks of the loop end and of the loop start in the same slots
+    reader = make_reader()
+    for loopstart, loopend in ((0, 65536), (65536, 131072), (4000, 70000), (12000, 139000), (0, 30000)):
+        sound = make_sound(loopend + 2, loopstart)
+        for pos in range(loopstart + 1, loopend + 2, 997):
+            for speed in (0.5, 1.0, 1.5, 4.0):
+                blocks = reader.blocks_ahead(sound, pos, speed)
+                slots = [block % RING_BLOCKS for block in blocks]
+                assert len(slots) == len(set(slots))
+                assert len(blocks) < RING_BLOCKS
+
+def test_loop_lookahead_follows_the_wrap():
+    reader = make_reader()
+    sound = make_sound(30002, 0)
+    blocks = reader.blocks_ahead(sound, 29000, 1.0)
+    # Loop end blocks first, then the blocks after the loop start
+    assert blocks[0] == 7
+    assert 3 in blocks
+    assert blocks.index(7) < blocks.index(3)
+
+def test_resident_loop_start_is_not_read():
+    reader = make_reader()
+    sound = make_sound(131074, 65536, loopframes=11025)
+    blocks = reader.blocks_ahead(sound, 130000, 1.0)
+    # Blocks 16 and 17 are in memory, 18 only in part
+    assert 16 not in blocks and 17 not in blocks
+    assert 18 in blocks
+    assert 31 in blocks and 32 in blocks
@@ -0,0 +1,22 @@
+'''
+@file test_trace.py
+@brief Tests of the ring of the sampler events
+'''
+
+from classes.trace import EventTrace
+
+def test_ring_keeps_the_last_events():
+    trace = EventTrace(4)
+    for note in range(6):
+        trace.record(EventTrace.NOTE_ON, note, 100)
+    records = trace.records()
+    assert list(records['note']) == [2, 3, 4, 5]
+    assert list(records['velocity']) == [100] * 4
+
+def test_missing_velocity_is_zero():
+    # The two bytes MIDI messages have no velocity
+    trace = EventTrace(4)
+    trace.record(EventTrace.PROGRAM_CHANGE, 3, None)
+    records = trace.records()
+    assert records['note'][0] == 3 and records['velocity'][0] == 0
+    assert 'program change' in EventTrace.format(records)